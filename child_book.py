@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''
+File: child_book.py
+Project: green
+Created: 2026-10-19 17:05:40
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 插画工厂的统一命令入口，子命令按需加载对应脚本，本地工具不加载 requests/PIL/pandas；
+             守护进程运行时命令交给它执行
+'''
+
+import os
+import sys
+import argparse
+import importlib
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+# 子命令: (模块名, 入口函数, 说明)
+COMMANDS = {
+    'gen': ('child_book_1_gen', 'main', '从绘图提示词生成小图'),
+    'upscale': ('child_book_2_upscale', 'main', '把小图放大成高清图'),
+    'ppi': ('child_book_3_ppi', 'process_images', '把高清图调整到客户要求的分辨率'),
+    'organize': ('child_book_4_organize', 'main', '把成品图按项目整理'),
+    'deliver': ('child_book_5_deliver', 'main', '把PPI结果编码成印刷交付文件（TIFF/JPEG）'),
+    'pipeline': ('child_book_p_pipeline', 'main', '生成、挑选、放大、PPI、整理一次跑完'),
+    'ps': ('child_book_f_ps', 'main', '复制需要人工PS修改的高清图'),
+    'fix': ('child_book_f_fix', 'main', '复制需要插画师修改的高清图'),
+    'crop': ('child_book_m_crop', 'main', '从高清图裁剪局部用于精修'),
+    'paste': ('child_book_m_paste', 'main', '把精修过的局部贴回原图'),
+    'review': ('child_book_r_review', 'main', '从缩略图缓存生成审图联系表'),
+    'queue': ('child_book_q_queue', 'main', '多本书共用实例，按项目公平排队生成和放大'),
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='child-book', description='AI插画工厂命令行')
+    parser.add_argument('--local', action='store_true', help='不使用守护进程，在当前进程执行')
+    subparsers = parser.add_subparsers(dest='command', metavar='<命令>')
+    for name, (_, _, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text, description=help_text)
+    daemon_parser = subparsers.add_parser('daemon', help='管理常驻工作进程', description='管理常驻工作进程')
+    daemon_parser.add_argument('action', choices=['start', 'stop', 'status', 'run'],
+                               help='start 后台启动；stop 停止；status 查看状态；run 前台运行')
+    return parser
+
+def run_daemon_action(action):
+    import child_book_d_daemon as daemon
+
+    if action == 'run':
+        return daemon.serve(COMMANDS)
+    if action == 'start':
+        return daemon.start_background()
+    reply = daemon.daemon_request({'action': action})
+    if reply is None:
+        print("守护进程未运行")
+        return 1 if action == 'status' else 0
+    if action == 'status':
+        for key, value in reply['status'].items():
+            print(f"{key}: {value}")
+    else:
+        print("守护进程已停止")
+    return reply.get('exit', 0)
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    if args.command == 'daemon':
+        return run_daemon_action(args.action)
+
+    # 守护进程在运行时交给它执行，模块、连接和缓存都是热的
+    if not args.local:
+        from child_book_d_daemon import daemon_request
+        reply = daemon_request({'action': 'run', 'command': args.command},
+                               on_output=lambda text: print(text, end='', flush=True),
+                               on_error=lambda text: print(text, end='', file=sys.stderr, flush=True))
+        if reply is not None:
+            if reply.get('error'):
+                print(reply['error'])
+            return reply['exit']
+
+    # 只在执行时导入对应脚本，其他子命令的依赖不会被加载
+    module_name, func_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    result = getattr(module, func_name)()
+    return result if isinstance(result, int) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
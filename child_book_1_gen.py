@@ -9,9 +9,9 @@ Description: 使用RunComfy工作流生成不同风格的图片
 
 import os
 import sys
+import math
 import time
 from datetime import datetime
-import pandas as pd
 
 current_dir = os.path.dirname(__file__)
 sys.path.insert(0, os.path.dirname(current_dir))
@@ -21,20 +21,22 @@ from child_book_utils import *
 # 机器类型常量
 MACHINE_TYPE = "medium"
 
-# 生成配置
+# 生成配置（draft_count 为草稿模式下每个场景的种子数）
 GEN_CONFIG = {
-    'watercolor': {'batch_size': 4},
-    'flat': {'batch_size': 2}
+    'watercolor': {'batch_size': 4, 'draft_count': 8},
+    'flat': {'batch_size': 2, 'draft_count': 6}
 }
 
-# 主函数
-def main():
-    # 记录开始时间
-    start_time = time.time()
-    start_datetime = datetime.now()
-    print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
-    
-    # 确定输入 CSV 和输出目录 
+# 生成模式：'full' 直接按完整质量批量生成；'draft' 每个种子出一张草稿并记录到草稿清单；
+# 'final' 把草稿清单中挑中的草稿用同一种子按完整质量重新生成
+GEN_MODE = 'full'
+
+def resolve_gen_paths():
+    """确定输入 CSV 和保存目录，Retry 表优先
+
+    返回:
+    - (input_csv_path, save_dir)
+    """
     input_csv_path = None
     output_folder_name = None
 
@@ -54,58 +56,243 @@ def main():
     save_dir = os.path.join(BASE_PATH, output_folder_name)
     os.makedirs(save_dir, exist_ok=True)
     print(f"图片将保存至: {save_dir}")
-    
-    # 从 CSV 读取提示词 
+    return input_csv_path, save_dir
+
+def load_prompts(input_csv_path):
+    """从 CSV 流式读取提示词，逐个产出 {"name", "style", "prompt"} 字典
+
+    表头在调用时立即检查，缺列或文件不存在时退出；之后每解析一行就产出一个场景，
+    第一个场景不用等整张表读完就可以开始生成。
+    """
     try:
-        df = pd.read_csv(input_csv_path, encoding='utf-8')
-        # 检查必需的列是否存在
-        required_columns = ['file name', 'style', 'final prompt']
-        if not all(col in df.columns for col in required_columns):
-            print(f"错误: CSV 文件 {input_csv_path} 缺少必需的列 ({required_columns})")
+        records = read_sheet(input_csv_path, required_columns=['file name', 'style', 'final prompt'])
+    except SheetError as e:
+        print(f"错误: {e}")
+        exit(1)
+    print(f"开始从 {os.path.basename(input_csv_path)} 读取 prompts")
+
+    def scenes():
+        for record in records:
+            yield {
+                "name": record['file name'],
+                "style": record['style'],
+                "prompt": record['final prompt']
+            }
+
+    return scenes()
+
+def generate_scene(scene, instance_url, save_dir, front=False):
+    """按场景风格生成图片
+    
+    参数:
+    - scene: load_prompts 产出的场景字典
+    - instance_url: ComfyUI实例URL
+    - save_dir: 生成图片保存的目录
+    - front: 插到 ComfyUI 队列最前面（Retry 表的返工场景）
+    
+    返回:
+    - 生成的图片文件路径列表，不支持的风格返回None
+    """
+    style = scene['style']
+    
+    # 根据风格选择生成函数
+    if style == 'flat':
+        generate_func = runcomfy_flat
+    elif style == 'watercolor':
+        generate_func = runcomfy_watercolor
+    else:
+        print(f"不支持的风格: {style}")
+        return None
+    
+    # 使用选定的函数执行生成操作
+    generated_files = generate_func(
+        prompt=scene['prompt'],
+        instance_url=instance_url,
+        batch_size=GEN_CONFIG[style]['batch_size'],  # 根据风格设置批量大小
+        save_dir=save_dir,
+        output_name=scene['name'],  # 使用场景名作为文件名前缀
+        front=front
+    )
+    print(f"\n场景 {scene['name']} 的图片已保存至:")
+    for file in generated_files:
+        print(f"- {file}")
+    return generated_files
+
+def generate_func_for(style):
+    """风格对应的生成函数，不支持的风格返回None"""
+    return {'flat': runcomfy_flat, 'watercolor': runcomfy_watercolor}.get(style)
+
+def draft_scene(scene, instance_url, draft_dir=GEN_DRAFT_DIR):
+    """为场景生成 draft_count 张草稿，每张单独一个种子，返回草稿记录列表
+
+    每张草稿 batch_size=1，定稿时用记录的种子就能单独复现挑中的那一张。
+    """
+    style = scene['style']
+    generate_func = generate_func_for(style)
+    width, height = DRAFT_RESOLUTION or ('', '')
+    records = []
+    for index in range(1, GEN_CONFIG[style]['draft_count'] + 1):
+        seed = generate_seed()
+        draft_name = f"{scene['name']}_{index}"
+        job_start = time.time()
+        try:
+            generated_files = generate_func(
+                prompt=scene['prompt'],
+                instance_url=instance_url,
+                save_dir=draft_dir,
+                output_name=draft_name,
+                seed=seed,
+                steps=DRAFT_STEPS,
+                size=DRAFT_RESOLUTION
+            )
+        except Exception as e:
+            print(f"草稿 {draft_name} 生成失败: {e}")
+            continue
+        if not generated_files:
+            continue
+        records.append({
+            'file name': draft_name, 'scene': scene['name'], 'style': style, 'seed': seed,
+            'steps': DRAFT_STEPS, 'width': width, 'height': height,
+            'seconds': f"{time.time() - job_start:.1f}", 'prompt': scene['prompt'], 'pick': ''
+        })
+    print(f"场景 {scene['name']} 生成草稿 {len(records)} 张: {draft_dir}")
+    return records
+
+def pending_finals(drafts, save_dir):
+    """挑中但还没有定稿的草稿记录（save_dir 中已有同名文件的算已定稿）"""
+    finished = {os.path.splitext(file)[0] for file in os.listdir(save_dir)} if os.path.exists(save_dir) else set()
+    return [record for records in drafts.values() for record in records
+            if record['picked'] and record['file name'] not in finished]
+
+def finalize_drafts(drafts, instance_url, save_dir):
+    """把挑中的草稿用同一种子按完整质量重新生成，输出文件名与草稿相同
+
+    已经定稿过的草稿跳过。
+
+    返回:
+    - (定稿的场景数, 定稿图片数, 节省的GPU秒数)；本次没有定稿时节省为None
+    """
+    final_seconds = 0.0
+    final_count = 0
+    finalized = {}
+    for record in pending_finals(drafts, save_dir):
+        scene_name = record['scene']
+        generate_func = generate_func_for(record['style'])
+        if not generate_func:
+            print(f"不支持的风格: {record['style']}")
+            continue
+        print(f"\n定稿 {record['file name']} (种子 {record['seed']})")
+        job_start = time.time()
+        try:
+            generated_files = generate_func(
+                prompt=record['prompt'],
+                instance_url=instance_url,
+                save_dir=save_dir,
+                output_name=record['file name'],
+                seed=record['seed']
+            )
+        except Exception as e:
+            print(f"定稿 {record['file name']} 失败: {e}")
+            continue
+        if generated_files:
+            final_seconds += time.time() - job_start
+            final_count += 1
+            finalized[scene_name] = finalized.get(scene_name, 0) + 1
+
+    if not final_count:
+        return 0, 0, None
+
+    # 对照：这些场景的所有候选都按 full 模式的批量（GEN_CONFIG）完整质量出图，
+    # 每批耗时取事件日志里同风格、同批量的实测平均值；没有记录时按本次定稿（批量1）的单张耗时估算
+    # 两遍生成：所有草稿的实测耗时 + 定稿耗时
+    seconds_per_image = final_seconds / final_count
+    candidate_count = 0
+    full_seconds = 0.0
+    baselines = {}
+    for scene_name in finalized:
+        style = drafts[scene_name][0]['style']
+        batch_size = GEN_CONFIG[style]['batch_size']
+        if style not in baselines:
+            baselines[style] = batch_job_seconds(style, batch_size)
+        job_seconds, _ = baselines[style]
+        count = len(drafts[scene_name])
+        candidate_count += count
+        full_seconds += math.ceil(count / batch_size) * job_seconds if job_seconds else count * seconds_per_image
+    draft_seconds = sum(record['seconds'] for scene_name in finalized for record in drafts[scene_name])
+    saved = full_seconds - draft_seconds - final_seconds
+    print(f"定稿 {final_count} 张（{len(finalized)} 个场景，{candidate_count} 张草稿）："
+          f"全部完整质量约 {full_seconds:.0f} 秒，两遍生成 {draft_seconds + final_seconds:.0f} 秒，节省GPU {saved:.0f} 秒")
+    log_event('draft_savings', scenes=len(finalized), drafts=candidate_count, finals=final_count,
+              draft_seconds=round(draft_seconds, 1), final_seconds=round(final_seconds, 1),
+              full_seconds=round(full_seconds, 1), gpu_seconds_saved=round(saved, 1),
+              baseline={style: {'batch_size': GEN_CONFIG[style]['batch_size'], 'samples': samples,
+                                'job_seconds': round(seconds, 1) if seconds else None}
+                        for style, (seconds, samples) in baselines.items()})
+    return len(finalized), final_count, saved
+
+# 主函数
+def main():
+    # 记录开始时间
+    start_time = time.time()
+    start_datetime = datetime.now()
+    print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    gpu_seconds_saved = None
+    front = False
+    if GEN_MODE == 'final':
+        # 定稿的提示词和种子都来自草稿清单，结果保存到默认生成目录
+        try:
+            drafts = load_drafts()
+        except SheetError as e:
+            print(f"错误: {e}")
             exit(1)
-            
-        # 清理数据：移除 final prompt 为空的行
-        df.dropna(subset=['final prompt'], inplace=True)
-        df = df[df['final prompt'].str.strip() != '']
+        input_csv_path = GEN_DRAFT_CSV_PATH
+        save_dir = GEN_OUTPUT_DEFAULT_DIR
+        # 没有待定稿的草稿时不启动实例
+        if not pending_finals(drafts, save_dir):
+            print(f"{os.path.basename(GEN_DRAFT_CSV_PATH)} 中没有待定稿的草稿（在 pick 列填 1 标记挑中的草稿）")
+            return
+        os.makedirs(save_dir, exist_ok=True)
+        prompts = []
+    else:
+        # 确定输入 CSV 和输出目录 
+        input_csv_path, save_dir = resolve_gen_paths()
+        # Retry 表是客户退回的返工场景，插到实例队列最前面，共用实例上正在排队的批量放大往后让
+        if input_csv_path == GEN_RETRY_CSV_PATH:
+            front = True
+            print("返工场景加急：提交到 ComfyUI 队列最前面")
         
-        # 将数据转换为所需的字典列表格式
-        prompts = df.apply(
-            lambda row: {
-                "name": row['file name'],
-                "style": row['style'],
-                "prompt": row['final prompt']
-            },
-            axis=1
-        ).tolist()
-
-        if not prompts:
-            print(f"从 {input_csv_path} 读取到 0 个有效的 prompt。请检查文件内容。")
-            exit(1)
+        # 从 CSV 读取提示词 
+        prompts = load_prompts(input_csv_path)
+    scene_count = 0
+    if GEN_MODE == 'draft':
+        drafted = set(load_drafts()) if os.path.exists(GEN_DRAFT_CSV_PATH) else set()
 
-        print(f"从 {os.path.basename(input_csv_path)} 加载了 {len(prompts)} 个 prompts.")
-
-    except FileNotFoundError:
-        print(f"错误：无法找到文件 {input_csv_path}")
-        exit(1)
-    except pd.errors.EmptyDataError:
-        print(f"错误：文件 {input_csv_path} 为空")
-        exit(1)
-    except Exception as e:
-        print(f"读取 CSV 文件 {input_csv_path} 时出错: {e}")
-        exit(1)
+    # 实例生命周期管理
+    lifecycle = InstanceLifecycleManager(
+        idle_timeout=INSTANCE_IDLE_TIMEOUT,
+        keep_warm=INSTANCE_KEEP_WARM,
+        price_per_hour=RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
+    )
 
     # 使用RunComfy工作流生成图片
     try:
-        # 获取或创建RunComfy实例
-        instance_url = runcomfy_service.get_or_create_instance(
+        # 获取或创建RunComfy实例，并登记租约
+        instance_url = lifecycle.acquire(
             create_new_instance=True,  # 设置为True将创建新实例
             server_type=MACHINE_TYPE,
             estimated_duration=7200
         )
         print(f"获取到RunComfy实例: {instance_url}")
+        # 新实例先预热生成模板，第一个场景不承担模型加载时间
+        warm_up_instance(instance_url, list(GEN_CONFIG), created=lifecycle.created, machine_type=MACHINE_TYPE)
         
-        # 处理每个提示词
+        if GEN_MODE == 'final':
+            scene_count, _, gpu_seconds_saved = finalize_drafts(drafts, instance_url, save_dir)
+
+        # 处理每个提示词（边读表边生成）
         for scene in prompts:
+            scene_count += 1
             style = scene['style']
             print(f"\n开始生成场景: {scene['name']} (风格: {style})")
             
@@ -115,77 +302,67 @@ def main():
                 continue
                 
             try:
-                # 根据风格选择生成函数
-                if style == 'flat':
-                    generate_func = runcomfy_flat
-                elif style == 'watercolor':
-                    generate_func = runcomfy_watercolor
+                if GEN_MODE == 'draft':
+                    # 已有草稿的场景跳过，要重新出草稿时先删掉清单中该场景的行
+                    if scene['name'] in drafted:
+                        print(f"场景 {scene['name']} 已有草稿，跳过")
+                        continue
+                    append_draft_records(draft_scene(scene, instance_url))
                 else:
-                    print(f"不支持的风格: {style}")
-                    continue
-                
-                # 使用选定的函数执行生成操作
-                generated_files = generate_func(
-                    prompt=scene['prompt'],
-                    instance_url=instance_url,
-                    batch_size=GEN_CONFIG[style]['batch_size'],  # 根据风格设置批量大小
-                    save_dir=save_dir,
-                    output_name=scene['name']  # 使用场景名作为文件名前缀
-                )
-                print(f"\n场景 {scene['name']} 的图片已保存至:")
-                for file in generated_files:
-                    print(f"- {file}")
+                    generate_scene(scene, instance_url, save_dir, front=front)
             except Exception as e:
                 print(f"生成场景 {scene['name']} 失败: {e}")
                 continue  # 继续处理下一个场景
         
-        # 处理完成后关闭实例
-        try:
-            runcomfy_service.stop_instance()
-            print("\n已关闭RunComfy实例")
-        except Exception as e:
-            print(f"\n关闭实例失败: {e}")
-            
     except Exception as e:
         print(f"处理失败: {e}")
-        # 发生错误时也尝试关闭实例
+    finally:
+        # 释放实例：没有其他脚本使用时进入保温窗口，到期自动停机
         try:
-            runcomfy_service.stop_instance()
-            print("\n已关闭RunComfy实例")
+            lifecycle.release()
         except Exception as e:
-            print(f"\n关闭实例失败: {e}")
+            print(f"\n释放实例失败: {e}")
     
+    if scene_count == 0 and GEN_MODE != 'final':
+        print(f"从 {input_csv_path} 读取到 0 个有效的 prompt。请检查文件内容。")
+
     # 记录结束时间并计算耗时
     end_time = time.time()
     end_datetime = datetime.now()
     duration_minutes = (end_time - start_time) / 60
     
-    # 计算实际计费时间（扣除启动时间）
-    billable_minutes = calculate_billable_minutes(duration_minutes)
+    # 按实例实际的创建/就绪/停止时间结算计费，费用按任务耗时分摊到每张图
+    script_type = 'gen' if GEN_MODE == 'full' else f'gen-{GEN_MODE}'
+    billing = lifecycle.meter.settle(script_type)
+    billable_minutes = billing['billed_seconds'] / 60
     
     # 计算机器使用成本
     machine_price_per_hour = RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
-    estimated_cost = billable_minutes * (machine_price_per_hour / 60)
+    estimated_cost = billing['cost']
     
     print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"结束运行时间: {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"总运行时间: {duration_minutes:.2f} 分钟")
-    print(f"实际计费时间: {billable_minutes:.2f} 分钟")
+    print(f"实际计费时间: {billable_minutes:.2f} 分钟（启动 {billing['boot_seconds'] / 60:.2f}，空闲 {billing['idle_seconds'] / 60:.2f}）")
     print(f"使用机器类型: {MACHINE_TYPE}")
     print(f"计费方式: {RUNCOMFY_BILLING_TYPE}")
     print(f"预估使用成本: ${estimated_cost:.2f}")
+    if billing['cost_per_image']:
+        print(f"单张成本: ${billing['cost_per_image']:.4f}（{billing['images']} 张）")
 
     # 记录脚本执行日志
     log_script_execution(
-        script_type='gen',
-        image_count=len(prompts),
+        script_type=script_type,
+        image_count=scene_count,
         start_time=start_datetime,
         end_time=end_datetime,
         billable_minutes=billable_minutes,
         billing_type=RUNCOMFY_BILLING_TYPE,
         machine_type=MACHINE_TYPE,
         machine_price_per_hour=machine_price_per_hour,
-        estimated_cost=estimated_cost
+        estimated_cost=estimated_cost,
+        billing=billing,
+        gpu_seconds_saved=gpu_seconds_saved
     )
 
 if __name__ == "__main__":
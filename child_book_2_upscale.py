@@ -11,6 +11,7 @@ import os
 import sys
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 current_dir = os.path.dirname(__file__)
 sys.path.insert(0, os.path.dirname(current_dir))
@@ -20,10 +21,42 @@ from child_book_utils import *
 # 机器类型常量
 MACHINE_TYPE = "medium"
 
+# 本地预处理配置：开启后在本地进程池里完成缩小和放大到 8MP（节点263/133/134/34，模型放大以 lanczos 代替），
+# 转成无损WebP上传，GPU 只做分块重绘，不再为模型放大计费；上一张在GPU上时下一张已在本地处理。
+# 代价是上传量约为原图的 8 倍以上：上传带宽足够、模型放大在账单中占比明显时开启（可用 b_throughput 对比）。
+# 关闭时上传原图，在GPU上执行完整的放大工作流（nmkdSiaxCX 模型放大）
+UPSCALE_PREPROCESS = False
+PREPROCESS_WORKERS = 2
+PREPROCESS_FORMAT = 'webp'  # 'webp' 或 'png'
+
+# 同时在实例上的放大任务数：一张在GPU上执行时，下一张已经上传并在 ComfyUI 队列里等着，
+# 上一张的结果同时在下载，GPU 不用等上传和下载。1 表示逐张串行
+UPSCALE_IN_FLIGHT = 2
+
 # 指定默认保存目录
 save_dir = UPSCALE_OUTPUT_DIR
 os.makedirs(save_dir, exist_ok=True)
 
+def upscale_job(image_path, instance_url, preprocess_future=None):
+    """放大一张图片（在线程池中执行），预处理结果用完后删除，返回放大后的文件路径"""
+    base_name_with_ext = os.path.basename(image_path)
+    print(f"\n开始处理图片: {base_name_with_ext}")
+    preprocessed_path = None
+    if preprocess_future:
+        preprocessed_path = preprocess_future.result()
+        print(f"预处理完成: {os.path.basename(preprocessed_path)} ({os.path.getsize(image_path) / 1024:.0f}KB -> {os.path.getsize(preprocessed_path) / 1024:.0f}KB)")
+
+    # 使用实例执行放大操作
+    upscaled_file = runcomfy_upscale(
+        image_path=image_path,
+        instance_url=instance_url,
+        save_dir=save_dir,
+        preprocessed_path=preprocessed_path
+    )
+    if preprocessed_path and os.path.exists(preprocessed_path):
+        os.remove(preprocessed_path)
+    return upscaled_file
+
 # 主函数
 def main():
     # 记录开始时间
@@ -33,78 +66,100 @@ def main():
     
     src_dir = UPSCALE_SRC_DIR
     
-    # 获取src目录下的所有图片文件
-    image_files = []
-    for file in os.listdir(src_dir):
-        if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-            image_files.append(os.path.join(src_dir, file))
+    # 按挑选结果规划：只放大挑中的候选图，已放大过的跳过
+    picks = load_picks()
+    plan = plan_upscale(src_dir, save_dir, picks)
+    image_files = plan['todo'] + plan['existing'] + plan['rejected']
     
     if not image_files:
         print(f"在 {src_dir} 目录下没有找到图片文件")
         exit(1)
         
-    # 按文件名排序
-    image_files.sort()
-        
-    print(f"找到 {len(image_files)} 个图片文件:")
-    for image_file in image_files:
+    print(f"找到 {len(image_files)} 个图片文件，待放大 {len(plan['todo'])} 个:")
+    for image_file in plan['todo']:
         print(f"- {os.path.basename(image_file)}")
+    for image_file in plan['existing']:
+        print(f"文件 {os.path.basename(image_file)} 的放大版本已存在于目标目录，跳过放大。")
+    if picks is not None:
+        print(f"未挑中 {len(plan['rejected'])} 个候选图，跳过放大。")
+        for name in plan['missing']:
+            print(f"警告：挑选的 {name} 在 {src_dir} 中不存在")
     print()
+    # 历史平均耗时最长的风格先放大，结尾不会只剩一张慢图
+    model = upscale_time_model(denoise_only=UPSCALE_PREPROCESS)
+    ordered_jobs = order_upscale_jobs(plan['todo'], model)
+    pending_files = [image_path for image_path, _ in ordered_jobs]
+    if ordered_jobs:
+        per_style = '，'.join(f"{style} {seconds:.0f} 秒" for style, seconds in sorted(model[0].items())) or f"平均 {model[1]:.0f} 秒"
+        print(f"放大耗时模型: {per_style}（{model[2]} 条记录），"
+              f"预计GPU {sum(seconds for _, seconds in ordered_jobs) / 60:.1f} 分钟，同时在实例上 {UPSCALE_IN_FLIGHT} 张")
+    upscaled_count = 0
+    upscale_seconds = 0.0
+
+    # 实例生命周期管理
+    lifecycle = InstanceLifecycleManager(
+        idle_timeout=INSTANCE_IDLE_TIMEOUT,
+        keep_warm=INSTANCE_KEEP_WARM,
+        price_per_hour=RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
+    )
 
     # 使用RunComfy工作流放大图片
     try:
-        # 获取或创建RunComfy实例
-        instance_url = runcomfy_service.get_or_create_instance(
+        # 获取或创建RunComfy实例，并登记租约
+        instance_url = lifecycle.acquire(
             create_new_instance=True,  # 设置为True将创建新实例
             server_type=MACHINE_TYPE,
             estimated_duration=14400
         )
         print(f"获取到RunComfy实例: {instance_url}")
+        # 新实例先预热放大模板，第一张图不承担模型加载时间
+        if pending_files:
+            warm_up_instance(instance_url, ['upscale'], created=lifecycle.created, machine_type=MACHINE_TYPE)
         
-        # 处理每一张图片
-        for image_path in image_files:
-            base_name_with_ext = os.path.basename(image_path)
-            base_name_no_ext = os.path.splitext(base_name_with_ext)[0]
-            
-            # 检查目标目录中是否已存在以 base_name_no_ext 开头的文件
-            found_existing = False
-            for existing_file in os.listdir(save_dir):
-                if existing_file.startswith(base_name_no_ext):
-                    print(f"文件 {base_name_with_ext} 的放大版本 ({existing_file}) 已存在于目标目录，跳过放大。")
-                    found_existing = True
-                    break
-            
-            if found_existing:
-                continue
-
-            print(f"\n开始处理图片: {base_name_with_ext}")
-            try:
-                # 使用实例执行放大操作
-                upscaled_file = runcomfy_upscale(
-                    image_path=image_path, 
-                    instance_url=instance_url,
-                    save_dir=save_dir
+        # 预处理任务提交到进程池，GPU处理当前图片时本地同时准备后面的图片
+        preprocess_pool = None
+        preprocess_futures = {}
+        if UPSCALE_PREPROCESS and pending_files:
+            megapixels = upscale_target_megapixels()
+            print(f"启用本地预处理（放大到 {megapixels}MP，GPU只做重绘），进程数: {PREPROCESS_WORKERS}")
+            preprocess_pool = process_pool(max_workers=PREPROCESS_WORKERS)
+            for image_path in pending_files:
+                preprocess_futures[image_path] = preprocess_pool.submit(
+                    preprocess_upscale_input, image_path, UPSCALE_PREPROCESS_DIR,
+                    megapixels=megapixels, file_format=PREPROCESS_FORMAT
                 )
-                print(f"放大后的图片已保存至: {upscaled_file}")
-            except Exception as e:
-                print(f"处理图片 {base_name_with_ext} 失败: {e}")
-                continue
         
-        # 处理完成后关闭实例
+        # 按顺序提交到线程池，线程数即同时在实例上的任务数：
+        # 上一张在GPU上执行时下一张已上传排队，结果下载与下一张的GPU执行重叠
+        upscale_pool = ThreadPoolExecutor(max_workers=UPSCALE_IN_FLIGHT, thread_name_prefix='upscale')
         try:
-            runcomfy_service.stop_instance()
-            print("\n已关闭RunComfy实例")
-        except Exception as e:
-            print(f"\n关闭实例失败: {e}")
-            
+            upscale_start = time.time()
+            futures = {
+                upscale_pool.submit(upscale_job, image_path, instance_url, preprocess_futures.get(image_path)): image_path
+                for image_path in pending_files
+            }
+            for future in as_completed(futures):
+                try:
+                    upscaled_file = future.result()
+                    upscaled_count += 1
+                    print(f"放大后的图片已保存至: {upscaled_file}")
+                except Exception as e:
+                    print(f"处理图片 {os.path.basename(futures[future])} 失败: {e}")
+            # 多张同时在实例上时单张耗时互相重叠，放大耗时按整段墙钟时间计
+            upscale_seconds = time.time() - upscale_start
+        finally:
+            upscale_pool.shutdown(wait=True, cancel_futures=True)
+            if preprocess_pool:
+                preprocess_pool.shutdown(wait=False, cancel_futures=True)
+        
     except Exception as e:
         print(f"处理失败: {e}")
-        # 发生错误时也尝试关闭实例
+    finally:
+        # 释放实例：没有其他脚本使用时进入保温窗口，到期自动停机
         try:
-            runcomfy_service.stop_instance()
-            print("\n已关闭RunComfy实例")
+            lifecycle.release()
         except Exception as e:
-            print(f"\n关闭实例失败: {e}")
+            print(f"\n释放实例失败: {e}")
     
     # 记录结束时间并计算耗时
     end_time = time.time()
@@ -114,20 +169,27 @@ def main():
     # 按风格整理放大后的图片
     organize_images_by_style()
     
-    # 计算实际计费时间（扣除启动时间）
-    billable_minutes = calculate_billable_minutes(duration_minutes)
+    # 按实例实际的创建/就绪/停止时间结算计费，费用按任务耗时分摊到每张图
+    billing = lifecycle.meter.settle('upscale')
+    billable_minutes = billing['billed_seconds'] / 60
     
     # 计算机器使用成本
     machine_price_per_hour = RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
-    estimated_cost = billable_minutes * (machine_price_per_hour / 60)
+    estimated_cost = billing['cost']
     
     print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"结束运行时间: {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"总运行时间: {duration_minutes:.2f} 分钟")
-    print(f"实际计费时间: {billable_minutes:.2f} 分钟")
+    print(f"实际计费时间: {billable_minutes:.2f} 分钟（启动 {billing['boot_seconds'] / 60:.2f}，空闲 {billing['idle_seconds'] / 60:.2f}）")
     print(f"使用机器类型: {MACHINE_TYPE}")
     print(f"计费方式: {RUNCOMFY_BILLING_TYPE}")
     print(f"预估使用成本: ${estimated_cost:.2f}")
+    if billing['cost_per_image']:
+        print(f"单张成本: ${billing['cost_per_image']:.4f}（{billing['images']} 张）")
+
+    # 记录挑选节省的放大成本
+    if picks is not None:
+        log_selection_savings('upscale', len(plan['rejected']), upscaled_count, upscale_seconds, machine_price_per_hour)
 
     # 记录脚本执行日志
     log_script_execution(
@@ -139,7 +201,8 @@ def main():
         billing_type=RUNCOMFY_BILLING_TYPE,
         machine_type=MACHINE_TYPE,
         machine_price_per_hour=machine_price_per_hour,
-        estimated_cost=estimated_cost
+        estimated_cost=estimated_cost,
+        billing=billing
     )
 
 if __name__ == "__main__":
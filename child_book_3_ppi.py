@@ -9,7 +9,7 @@ Description:
 
 import os
 import sys
-from PIL import Image
+from concurrent.futures import as_completed
 
 current_dir = os.path.dirname(__file__)
 sys.path.insert(0, os.path.dirname(current_dir))
@@ -20,12 +20,46 @@ from child_book_utils import *
 MAX_SHORT_SIDE = 1772  # 短边最大值
 MIN_WIDTH = 1772  # 纵向图片的最小宽度
 
+# 并行处理：缩放按条带进行，每个条带的缓冲（MB）；进程数按图片尺寸估算的内存峰值、可用内存和 CPU 核数自动决定
+PPI_STRIP_MB = 16
+PPI_WORKERS = None  # 指定时作为进程数上限
+
+def estimate_memory_mb(src_path):
+    """单张图片处理的内存峰值估计（MB）：解码后的源图 + 缩放结果 + 条带缓冲"""
+    src_mb = decoded_image_mb(src_path)
+    if MAX_SHORT_SIDE is None:
+        return src_mb
+    with Image.open(src_path) as image:
+        area_ratio = (MAX_SHORT_SIDE / min(image.size)) ** 2
+    return src_mb + decoded_image_mb(src_path, area_ratio) + PPI_STRIP_MB
+
+def process_image(src_path, temp_path, dst_path, strip_mb=PPI_STRIP_MB):
+    """
+    处理单张图片：限制短边后设置 PPI 为 450
+
+    :param str src_path: 源图片路径
+    :param str temp_path: 缩放结果的临时路径
+    :param str dst_path: 最终输出路径
+    :param int strip_mb: 按条带缩放时每个条带的缓冲大小（MB）
+    """
+    # 步骤1: 使用scale_image限制图片短边
+    if MAX_SHORT_SIDE is not None:
+        scale_image(src_path, temp_path, MAX_SHORT_SIDE, MIN_WIDTH, mode=2, strip_mb=strip_mb)
+        process_path = temp_path
+    else:
+        process_path = src_path
+    
+    # 步骤2: 设置PPI为450（透明背景会在 set_image_ppi 中转为不透明）
+    set_image_ppi(process_path, dst_path, target_ppi=450)
+
 def process_images():
     """
     处理下载目录中 PPI_SRC_DIR 文件夹及其子文件夹里的所有图片：
     1. 使用 scale_image 限制图片短边
     2. 设置 PPI 为 450
     3. 在输出和临时目录中保持原始子目录结构
+
+    图片在进程池中并行处理，进程数由最大一张图的内存峰值估计（estimate_memory_mb）和可用内存决定，内存小的机器也不会换页。
     """
     # 源目录和目标目录
     src_folder = PPI_SRC_DIR
@@ -41,7 +75,8 @@ def process_images():
     
     print(f"开始处理目录: {src_folder}")
     
-    # 递归遍历源目录中的所有文件和子目录
+    # 递归遍历源目录中的所有文件和子目录，收集待处理的图片
+    jobs = []
     for root, dirs, files in os.walk(src_folder):
         # 计算当前目录相对于源目录的路径
         relative_dir = os.path.relpath(root, src_folder)
@@ -54,36 +89,31 @@ def process_images():
             
         for filename in files:
             if filename.lower().endswith(image_extensions):
-                # 构建完整的文件路径
-                src_path = os.path.join(root, filename)
-                
-                # 临时文件路径
-                temp_path = os.path.join(current_temp_dir, filename)
-                
-                # 最终输出文件路径
-                dst_path = os.path.join(current_output_dir, filename)
-                
-                try:
-                    print(f"处理图片: {os.path.join(relative_dir, filename) if relative_dir != '.' else filename}")
-                    
-                    # 步骤1: 使用scale_image限制图片短边
-                    if MAX_SHORT_SIDE is not None:
-                        scale_image(src_path, temp_path, MAX_SHORT_SIDE, MIN_WIDTH, mode=2)
-                        process_path = temp_path
-                    else:
-                        process_path = src_path
-                    
-                    # 步骤2: 设置PPI为450
-                    with Image.open(process_path) as img:
-                        # 如果是透明背景转为不透明，先将Alpha通道删除
-                        if img.mode == 'RGBA':
-                            img = img.convert('RGB')
-                        set_image_ppi(process_path, dst_path, target_ppi=450)
-                    
-                    print(f"成功处理: {os.path.join(relative_dir, filename) if relative_dir != '.' else filename} -> {os.path.join(os.path.basename(output_folder), relative_dir, filename) if relative_dir != '.' else os.path.join(os.path.basename(output_folder), filename)}")
-                    
-                except Exception as e:
-                    print(f"处理 {os.path.join(relative_dir, filename) if relative_dir != '.' else filename} 时出错: {e}")
+                # 源文件、临时文件和最终输出文件路径
+                jobs.append((
+                    os.path.join(relative_dir, filename) if relative_dir != '.' else filename,
+                    os.path.join(root, filename),
+                    os.path.join(current_temp_dir, filename),
+                    os.path.join(current_output_dir, filename)
+                ))
+    
+    if not jobs:
+        print(f"在 {src_folder} 目录下没有找到图片文件")
+        return
+    
+    job_memory_mb = max(estimate_memory_mb(src_path) for _, src_path, _, _ in jobs)
+    workers = min(memory_bounded_workers(job_memory_mb, PPI_WORKERS), len(jobs))
+    print(f"共 {len(jobs)} 张图片，并行进程数: {workers}（每张图片内存峰值约 {job_memory_mb + PROCESS_BASE_MB:.0f}MB）")
+    
+    with process_pool(max_workers=workers) as pool:
+        futures = {pool.submit(process_image, src_path, temp_path, dst_path): name for name, src_path, temp_path, dst_path in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                print(f"成功处理: {name} -> {os.path.join(os.path.basename(output_folder), name)}")
+            except Exception as e:
+                print(f"处理 {name} 时出错: {e}")
     
     print(f"所有图片处理完成。输出目录: {output_folder}")
 
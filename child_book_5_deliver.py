@@ -0,0 +1,157 @@
+'''
+File: child_book_5_deliver.py
+Project: green
+Created: 2026-10-19 19:10:44
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 5号程序，把PPI处理后的图片按客户规格编码成印刷交付文件（TIFF/JPEG），嵌入DPI和ICC，
+             在进程池中并行编码，统计节省的字节数和编码吞吐
+'''
+
+import os
+import sys
+import time
+from concurrent.futures import as_completed
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from child_book_utils import *
+
+# 交付目录，每种格式一个子目录，保持源目录的子目录结构
+DELIVER_SRC_DIR = PPI_OUTPUT_DIR
+DELIVER_OUTPUT_DIR = os.path.join(BASE_PATH, 'child-book-deliver')
+
+# TIFF 标签：Predictor=2（水平差分），LZW/Deflate 压缩后的文件约小一半，Photoshop 和印厂软件都支持
+TIFF_PREDICTOR_TAG = 317
+TIFF_HORIZONTAL_DIFFERENCING = 2
+
+# 各格式的压缩预设
+DELIVERY_PRESETS = {
+    'tiff-lzw': {'format': 'TIFF', 'ext': '.tif', 'options': {'compression': 'tiff_lzw', 'tiffinfo': {TIFF_PREDICTOR_TAG: TIFF_HORIZONTAL_DIFFERENCING}}},
+    'tiff-deflate': {'format': 'TIFF', 'ext': '.tif', 'options': {'compression': 'tiff_adobe_deflate', 'tiffinfo': {TIFF_PREDICTOR_TAG: TIFF_HORIZONTAL_DIFFERENCING}}},
+    'jpeg': {'format': 'JPEG', 'ext': '.jpg', 'options': {'quality': 95, 'subsampling': 0, 'optimize': True}},
+}
+
+# 客户要求的格式，可以同时输出多种
+DELIVERY_FORMATS = ['tiff-lzw']
+
+# 嵌入的分辨率和色彩配置文件（None 表示保留源图自带的ICC）
+DELIVERY_PPI = 450
+DELIVERY_ICC_PATH = None
+
+# 进程数按图片尺寸估算的内存峰值（解码后的源图 + 转成RGB的副本）、可用内存和 CPU 核数自动决定
+DELIVERY_WORKERS = None  # 指定时作为进程数上限
+
+def encode_delivery(src_path, dst_path, preset_name, ppi=DELIVERY_PPI, icc_path=DELIVERY_ICC_PATH):
+    """按预设编码一张交付文件
+
+    该函数运行在独立进程中，只使用可序列化的参数。
+
+    :param str src_path: 源图片路径
+    :param str dst_path: 输出路径
+    :param str preset_name: DELIVERY_PRESETS 中的预设名
+    :param int ppi: 嵌入的DPI
+    :param str icc_path: 嵌入的ICC文件，None 表示保留源图的ICC
+    :return: (源文件字节数, 输出字节数, 像素数, 编码耗时秒)
+    :rtype: tuple
+    """
+    preset = DELIVERY_PRESETS[preset_name]
+    start_time = time.perf_counter()
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with Image.open(src_path) as image:
+        icc_profile = image.info.get('icc_profile')
+        if icc_path:
+            with open(icc_path, 'rb') as f:
+                icc_profile = f.read()
+        # 印刷交付不需要Alpha通道
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        options = dict(preset['options'], dpi=(ppi, ppi))
+        if icc_profile:
+            options['icc_profile'] = icc_profile
+        pixels = image.width * image.height
+        # 先写临时文件再改名，中断时不会留下半个交付文件
+        temp_path = f"{dst_path}.tmp"
+        image.save(temp_path, preset['format'], **options)
+    os.replace(temp_path, dst_path)
+    return os.path.getsize(src_path), os.path.getsize(dst_path), pixels, time.perf_counter() - start_time
+
+def deliver_images(src_dir=None, output_dir=None, formats=None):
+    """把 src_dir 下的图片编码成 formats 中的每种交付格式
+
+    输出已存在且比源图新的跳过，重复运行只编码新增或修改过的图片。
+
+    返回:
+        dict: {预设名: {'count', 'src_bytes', 'dst_bytes', 'pixels', 'seconds'}}
+    """
+    src_dir = src_dir or DELIVER_SRC_DIR
+    output_dir = output_dir or DELIVER_OUTPUT_DIR
+    formats = formats or DELIVERY_FORMATS
+    if not os.path.exists(src_dir):
+        print(f"错误：源目录不存在: {src_dir}")
+        return {}
+
+    # 收集任务：(预设名, 源图路径, 输出路径)
+    jobs = []
+    skipped = 0
+    for src_path in sorted(list_files(src_dir)):
+        relative_path = os.path.relpath(src_path, src_dir)
+        for preset_name in formats:
+            dst_path = os.path.join(output_dir, preset_name, os.path.splitext(relative_path)[0] + DELIVERY_PRESETS[preset_name]['ext'])
+            if os.path.exists(dst_path) and os.path.getmtime(dst_path) >= os.path.getmtime(src_path):
+                skipped += 1
+                continue
+            jobs.append((preset_name, src_path, dst_path))
+
+    if skipped:
+        print(f"{skipped} 个交付文件已是最新，跳过")
+    if not jobs:
+        print(f"没有需要编码的图片: {src_dir}")
+        return {}
+
+    job_memory_mb = max(2 * decoded_image_mb(src_path) for _, src_path, _ in jobs)
+    workers = min(memory_bounded_workers(job_memory_mb, DELIVERY_WORKERS), len(jobs))
+    print(f"开始编码 {len(jobs)} 个交付文件，格式: {', '.join(formats)}，并行进程数: {workers}")
+
+    totals = {name: {'count': 0, 'src_bytes': 0, 'dst_bytes': 0, 'pixels': 0, 'seconds': 0.0} for name in formats}
+    start_time = time.time()
+    with process_pool(max_workers=workers) as pool:
+        futures = {pool.submit(encode_delivery, src_path, dst_path, preset_name): (preset_name, src_path, dst_path) for preset_name, src_path, dst_path in jobs}
+        for future in as_completed(futures):
+            preset_name, src_path, dst_path = futures[future]
+            try:
+                src_bytes, dst_bytes, pixels, seconds = future.result()
+            except Exception as e:
+                print(f"编码 {os.path.basename(src_path)} ({preset_name}) 时出错: {e}")
+                continue
+            total = totals[preset_name]
+            total['count'] += 1
+            total['src_bytes'] += src_bytes
+            total['dst_bytes'] += dst_bytes
+            total['pixels'] += pixels
+            total['seconds'] += seconds
+            print(f"[{preset_name}] {os.path.relpath(dst_path, output_dir)} ({src_bytes / 1024 / 1024:.1f}MB -> {dst_bytes / 1024 / 1024:.1f}MB)")
+    elapsed = time.time() - start_time
+
+    for preset_name, total in totals.items():
+        if not total['count']:
+            continue
+        # 与未压缩的 RGB 交付文件（Photoshop 默认存储的 TIFF）相比节省的字节数
+        saved = total['pixels'] * 3 - total['dst_bytes']
+        # 吞吐按单个进程的编码耗时计算，总墙钟时间另记
+        megapixels_per_second = total['pixels'] / 1e6 / total['seconds'] if total['seconds'] else 0
+        print(f"[{preset_name}] {total['count']} 张，{total['src_bytes'] / 1024 / 1024:.1f}MB -> {total['dst_bytes'] / 1024 / 1024:.1f}MB，"
+              f"比未压缩节省 {saved / 1024 / 1024:.1f}MB，吞吐 {megapixels_per_second:.1f} MP/s")
+        log_event('delivery_encode', preset=preset_name, count=total['count'], src_bytes=total['src_bytes'],
+                  dst_bytes=total['dst_bytes'], bytes_saved=saved, workers=workers,
+                  wall_seconds=round(elapsed, 2), encode_seconds=round(total['seconds'], 2),
+                  megapixels_per_second=round(megapixels_per_second, 2))
+    print(f"交付编码完成，用时 {elapsed:.1f} 秒。输出目录: {output_dir}")
+    return totals
+
+def main():
+    deliver_images()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+'''
+File: child_book_b_image.py
+Project: green
+Created: 2026-10-19 16:20:15
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 图像处理基础函数的微基准：耗时、Python内存分配峰值和进程峰值RSS，支持基线保存和对比
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+# 基线文件
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log', 'bench-image-baseline.json')
+
+# 测试图片尺寸：生图输出和放大输出（约8MP，竖版）
+GEN_SIZE = (1024, 1024)
+UPSCALE_SIZE = (2368, 3552)
+TILE_SIZE = (1024, 1024)
+
+# 超过该比例视为退化
+REGRESSION_THRESHOLD = 0.15
+
+def make_fixtures(fixture_dir):
+    """生成带渐变和噪声的合成测试图片，返回 {名称: 路径}"""
+    from PIL import Image
+
+    fixtures = {
+        'gen': os.path.join(fixture_dir, '1-w-1-gen.png'),
+        'upscale': os.path.join(fixture_dir, '1-w-1-upscale.png'),
+        'tile': os.path.join(fixture_dir, '1-w-1-upscale_2_3.png'),
+    }
+    for name, size, mode in [('gen', GEN_SIZE, 'RGB'), ('upscale', UPSCALE_SIZE, 'RGB'), ('tile', TILE_SIZE, 'RGBA')]:
+        if os.path.exists(fixtures[name]):
+            continue
+        gradient = Image.linear_gradient('L').resize(size)
+        noise = Image.effect_noise(size, 40)
+        image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        if mode == 'RGBA':
+            image.putalpha(Image.radial_gradient('L').resize(size))
+        image.save(fixtures[name])
+    return fixtures
+
+def build_operations(fixtures, out_dir):
+    """返回 {操作名: 无参函数}，覆盖缩放、PPI、裁剪、粘贴和瓦片坐标计算"""
+    from child_book_utils import scale_image, set_image_ppi, calculate_tile_coordinates, crop_image_by_size, paste_image
+    from child_book_3_ppi import process_image
+
+    def crop_tile():
+        x, y = calculate_tile_coordinates(fixtures['upscale'], 1024, 1024, 5, 5, 2, 3)
+        crop_image_by_size(fixtures['upscale'], os.path.join(out_dir, 'crop.png'), 1024, 1024, x, y)
+
+    def paste_tile():
+        x, y = calculate_tile_coordinates(fixtures['upscale'], 1024, 1024, 5, 5, 2, 3)
+        paste_image(fixtures['tile'], fixtures['upscale'], os.path.join(out_dir, 'paste.png'), x, y)
+
+    return {
+        'scale_image_gen': lambda: scale_image(fixtures['gen'], os.path.join(out_dir, 'scale_gen.png'), 512, 0, mode=1),
+        'scale_image_ppi': lambda: scale_image(fixtures['upscale'], os.path.join(out_dir, 'scale_ppi.png'), 1772, 1772, mode=2),
+        'scale_image_strips': lambda: scale_image(fixtures['upscale'], os.path.join(out_dir, 'scale_strips.png'), 1772, 1772, mode=2, strip_mb=16),
+        'set_image_ppi': lambda: set_image_ppi(fixtures['upscale'], os.path.join(out_dir, 'ppi.png'), target_ppi=450),
+        'ppi_process_image': lambda: process_image(fixtures['upscale'], os.path.join(out_dir, 'ppi_temp.png'), os.path.join(out_dir, 'ppi_out.png')),
+        'tile_coordinates': lambda: calculate_tile_coordinates(fixtures['upscale'], 1024, 1024, 5, 5, 3, 3),
+        'crop_tile': crop_tile,
+        'paste_tile': paste_tile,
+    }
+
+def _peak_rss_mb():
+    """当前进程的峰值RSS（MB）"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位为字节，Linux 为KB
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def measure_operation(name, fixture_dir, repeat):
+    """在独立进程中测量一个操作，返回耗时和内存指标
+
+    tracemalloc 只能看到 Python 层的分配，Pillow 的像素缓冲区在C层分配，
+    所以同时记录进程峰值RSS相对于导入完成后（预热之前）的增量。
+    """
+    fixtures = make_fixtures(fixture_dir)
+    with tempfile.TemporaryDirectory() as out_dir:
+        operation = build_operations(fixtures, out_dir)[name]
+        rss_before = _peak_rss_mb()
+        operation()  # 预热：加载插件和解码器
+
+        timings = []
+        tracemalloc.start()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            operation()
+            timings.append(time.perf_counter() - start)
+        _, py_peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    return {
+        'median_ms': statistics.median(timings) * 1000,
+        'min_ms': min(timings) * 1000,
+        'py_peak_kb': py_peak / 1024,
+        'py_alloc_blocks': sum(stat.count for stat in snapshot.statistics('filename')),
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_rss_delta_mb': _peak_rss_mb() - rss_before,
+    }
+
+def run_all(repeat, only=None):
+    """逐个操作在新进程中测量，避免峰值RSS互相影响"""
+    results = {}
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        make_fixtures(fixture_dir)
+        names = list(build_operations(make_fixtures(fixture_dir), fixture_dir).keys())
+        for name in names:
+            if only and name not in only:
+                continue
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                results[name] = pool.submit(measure_operation, name, fixture_dir, repeat).result()
+            metrics = results[name]
+            print(f"{name:<20} 中位数 {metrics['median_ms']:8.1f} ms  Python峰值 {metrics['py_peak_kb']:8.1f} KB  "
+                  f"峰值RSS {metrics['peak_rss_mb']:7.1f} MB (+{metrics['peak_rss_delta_mb']:.1f})")
+    return results
+
+def compare(results, baseline):
+    """和基线对比，返回退化的操作列表"""
+    regressions = []
+    print("\n===== 与基线对比 =====")
+    for name, metrics in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f"{name:<20} 基线中没有该操作")
+            continue
+        line = []
+        for key in ('median_ms', 'peak_rss_mb'):
+            change = (metrics[key] - base[key]) / base[key] if base[key] else 0
+            line.append(f"{key} {base[key]:.1f} -> {metrics[key]:.1f} ({change:+.0%})")
+            if change > REGRESSION_THRESHOLD:
+                regressions.append(f"{name}.{key}")
+        print(f"{name:<20} " + "  ".join(line))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='图像处理基础函数的微基准')
+    parser.add_argument('command', choices=['run', 'baseline', 'compare'], nargs='?', default='run',
+                        help='run 只测量；baseline 测量并保存为基线；compare 测量并与基线对比')
+    parser.add_argument('--repeat', type=int, default=5, help='每个操作的重复次数')
+    parser.add_argument('--only', nargs='*', help='只测量指定操作')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='基线文件路径')
+    args = parser.parse_args()
+
+    results = run_all(args.repeat, args.only)
+
+    if args.command == 'baseline':
+        from PIL import __version__ as pillow_version
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': sys.version.split()[0], 'pillow': pillow_version, 'repeat': args.repeat,
+                       'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已保存: {args.baseline}")
+    elif args.command == 'compare':
+        if not os.path.exists(args.baseline):
+            print(f"错误：基线文件不存在: {args.baseline}，请先运行 baseline")
+            exit(1)
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"\n发现退化 (>{REGRESSION_THRESHOLD:.0%}): {', '.join(regressions)}")
+            exit(1)
+        print("\n没有发现退化")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+'''
+File: child_book_b_import.py
+Project: green
+Created: 2026-10-19 17:20:12
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 导入耗时基准：每个子命令在新解释器里导入对应脚本的耗时，以及实际加载了哪些重模块
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+from child_book import COMMANDS
+
+# 需要关注的重模块，LazyLoader 占位但未真正执行的不算已加载
+HEAVY_MODULES = ['requests', 'PIL.Image', 'pandas', 'numpy']
+
+# 在子进程中执行的测量代码
+_PROBE = '''
+import sys, time, json, types, importlib
+sys.path.insert(0, {dir!r})
+start = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - start
+loaded = [m for m in {heavy!r} if type(sys.modules.get(m)) is types.ModuleType]
+print(json.dumps({{'ms': elapsed * 1000, 'loaded': loaded}}))
+'''
+
+def measure(module_name, repeat):
+    """在新解释器中导入模块 repeat 次，返回导入耗时中位数、进程总耗时中位数和已加载的重模块"""
+    import_times, process_times, loaded = [], [], []
+    code = _PROBE.format(dir=current_dir, module=module_name, heavy=HEAVY_MODULES)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=current_dir, check=True).stdout
+        process_times.append((time.perf_counter() - start) * 1000)
+        result = json.loads(output.strip().splitlines()[-1])
+        import_times.append(result['ms'])
+        loaded = result['loaded']
+    return statistics.median(import_times), statistics.median(process_times), loaded
+
+def main():
+    parser = argparse.ArgumentParser(description='测量各子命令的导入耗时')
+    parser.add_argument('--repeat', type=int, default=5, help='每个子命令的重复次数')
+    args = parser.parse_args()
+
+    # 空解释器的启动时间作为参照
+    empty = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        empty.append((time.perf_counter() - start) * 1000)
+    print(f"空解释器启动: {statistics.median(empty):.1f} ms\n")
+
+    print(f"{'命令':<10}{'导入(ms)':>10}{'进程(ms)':>10}  已加载的重模块")
+    for name, (module_name, _, _) in COMMANDS.items():
+        import_ms, process_ms, loaded = measure(module_name, args.repeat)
+        print(f"{name:<10}{import_ms:>10.1f}{process_ms:>10.1f}  {', '.join(loaded) or '-'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+'''
+File: child_book_b_throughput.py
+Project: green
+Created: 2026-10-19 15:40:22
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 端到端吞吐基准：在本地模拟服务器上运行真实的生图/放大脚本或流水线，记录每分钟场景数、传输量和模拟计费时长
+'''
+
+import os
+import sys
+import csv
+import json
+import time
+import inspect
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from runcomfy_fake_server import start_fake_server, fake_server_env
+
+# 基准结果日志
+BENCH_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log', 'bench-throughput.csv')
+BENCH_LOG_HEADER = [
+    '记录时间', 'commit', '场景数', '放大数', '场景/分钟', '放大/分钟',
+    '上传MB', '下载MB', '模拟计费分钟', '总耗时(秒)', '配置'
+]
+
+def git_commit():
+    """当前代码的 commit，用于对比不同提交之间的结果"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or 'unknown'
+    except Exception:
+        return 'unknown'
+
+def redirect_paths(module, old_root, new_root):
+    """把模块里以 old_root 开头的路径常量和函数默认参数改到 new_root 下，基准不读写真实的工作目录和日志
+
+    脚本通过 import * 各自持有一份路径常量，函数默认参数在定义时就已确定，所以每个模块、每个函数都要改。
+    """
+    def moved(value):
+        if isinstance(value, str) and value.startswith(old_root):
+            return new_root + value[len(old_root):]
+        return value
+
+    for name, value in list(vars(module).items()):
+        if name.isupper() or name == 'save_dir':
+            setattr(module, name, moved(value))
+        elif inspect.isfunction(value) and value.__module__ == module.__name__ and value.__defaults__:
+            value.__defaults__ = tuple(moved(default) for default in value.__defaults__)
+    # 实例由基准持有的租约保活，脚本释放时不进入保温窗口，也不启动保温守护进程
+    if hasattr(module, 'INSTANCE_KEEP_WARM'):
+        module.INSTANCE_KEEP_WARM = 0
+
+def run_main(module):
+    """运行脚本的 main()，返回耗时秒数；脚本用 exit(1) 报告的错误转成异常"""
+    start = time.time()
+    try:
+        module.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f"{module.__name__}.main() 退出码 {e.code}") from e
+    return time.time() - start
+
+def run_benchmark(scenes, upscales, config, mode='scripts', preprocess=False):
+    """启动模拟服务器，在临时工作目录里运行真实的脚本入口，返回结果字典
+
+    - scripts: 依次运行 child_book_1_gen.main() 和 child_book_2_upscale.main()（含双缓冲放大）
+    - pipeline: 运行 child_book_p_pipeline.main()，生成、挑选、放大和PPI并行
+    - preprocess: 放大脚本是否开启本地预处理（UPSCALE_PREPROCESS，GPU只做重绘）
+
+    实例由基准先行获取并预热，启动和预热耗时单独统计；脚本登记自己的租约，
+    释放时看到基准的租约不停机，和保温期内接连运行两个脚本一样复用同一台实例。
+    """
+    server, state, base_url = start_fake_server(**config)
+    os.environ.update(fake_server_env(base_url))
+
+    # 必须在设置环境变量之后导入，runcomfy_utils 在导入时读取API地址
+    import runcomfy_utils
+    import child_book_utils
+    import child_book_1_gen
+    import child_book_2_upscale
+    import child_book_3_ppi
+    import child_book_p_pipeline
+    modules = [runcomfy_utils, child_book_utils, child_book_1_gen, child_book_2_upscale, child_book_3_ppi, child_book_p_pipeline]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        old_root = child_book_utils.LOCAL_PATH
+        for module in modules:
+            redirect_paths(module, old_root, work_dir)
+        runcomfy_utils.runcomfy_service.instance_file = os.path.join(work_dir, '.runcomfy_instance')
+        child_book_p_pipeline.SELECT_MODE = 'picks'
+        child_book_2_upscale.UPSCALE_PREPROCESS = preprocess
+
+        # Gen 表：水彩和扁平交替；挑选文件：按场景顺序的前 upscales 张候选
+        gen_csv_path = child_book_1_gen.GEN_EXPORT_CSV_PATH
+        os.makedirs(os.path.dirname(gen_csv_path), exist_ok=True)
+        candidates = []
+        with open(gen_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(['file name', 'style', 'final prompt'])
+            for index in range(scenes):
+                style = 'watercolor' if index % 2 == 0 else 'flat'
+                name = f"1-{style[0]}-{index + 1}-bench"
+                csvwriter.writerow([name, style, 'benchmark scene'])
+                batch_size = child_book_1_gen.GEN_CONFIG[style]['batch_size']
+                candidates += [f"{name}_{i + 1}" for i in range(batch_size)] if batch_size > 1 else [name]
+        with open(child_book_utils.UPSCALE_PICKS_PATH, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(candidates[:upscales]) + '\n')
+
+        start_time = time.time()
+        lifecycle = child_book_utils.InstanceLifecycleManager(idle_timeout=0, keep_warm=0)
+        lifecycle.owner += ':bench'
+        instance_url = lifecycle.acquire(create_new_instance=True)
+        boot_seconds = time.time() - start_time
+
+        try:
+            # 预热本次要用的模板，预热耗时单独统计
+            warmup_start = time.time()
+            child_book_utils.warm_up_instance(instance_url, ['watercolor', 'flat'] + (['upscale'] if upscales else []),
+                                              created=lifecycle.created)
+            warmup_seconds = time.time() - warmup_start
+
+            if mode == 'pipeline':
+                gen_seconds = upscale_seconds = run_main(child_book_p_pipeline)
+            else:
+                gen_seconds = run_main(child_book_1_gen)
+                upscale_seconds = run_main(child_book_2_upscale) if upscales else 0
+        finally:
+            lifecycle.release()
+            total_seconds = time.time() - start_time
+        upscale_dir = child_book_utils.UPSCALE_OUTPUT_DIR
+        # 放大结果按风格放在子目录里
+        upscaled = sum(len(files) for _, _, files in os.walk(upscale_dir))
+
+    stats = state.stats
+    billed_minutes = state.billed_seconds() / 60
+    server.shutdown()
+    return {
+        'scenes': scenes,
+        'upscales': upscaled,
+        'scenes_per_minute': scenes / gen_seconds * 60 if gen_seconds else 0,
+        'upscales_per_minute': upscaled / upscale_seconds * 60 if upscale_seconds else 0,
+        'upload_mb': stats['bytes_in'] / 1024 / 1024,
+        'download_mb': stats['bytes_out'] / 1024 / 1024,
+        'billed_minutes': billed_minutes,
+        'boot_seconds': boot_seconds,
+        'warmup_seconds': warmup_seconds,
+        'total_seconds': total_seconds,
+    }
+
+def previous_result(config_json):
+    """读取同一配置下最近一次的结果"""
+    if not os.path.exists(BENCH_LOG_PATH):
+        return None
+    last = None
+    with open(BENCH_LOG_PATH, 'r', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if row.get('配置') == config_json:
+                last = row
+    return last
+
+def save_result(result, config_json):
+    """追加结果到基准日志"""
+    os.makedirs(os.path.dirname(BENCH_LOG_PATH), exist_ok=True)
+    file_exists = os.path.exists(BENCH_LOG_PATH)
+    with open(BENCH_LOG_PATH, 'a', newline='', encoding='utf-8') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        if not file_exists:
+            csvwriter.writerow(BENCH_LOG_HEADER)
+        csvwriter.writerow([
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            git_commit(),
+            result['scenes'],
+            result['upscales'],
+            f"{result['scenes_per_minute']:.2f}",
+            f"{result['upscales_per_minute']:.2f}",
+            f"{result['upload_mb']:.2f}",
+            f"{result['download_mb']:.2f}",
+            f"{result['billed_minutes']:.2f}",
+            f"{result['total_seconds']:.1f}",
+            config_json
+        ])
+
+def main():
+    parser = argparse.ArgumentParser(description='在本地模拟服务器上测量生图和放大的吞吐')
+    parser.add_argument('--scenes', type=int, default=4, help='生成的场景数')
+    parser.add_argument('--upscales', type=int, default=4, help='放大的图片数（按场景顺序挑选前几张候选）')
+    parser.add_argument('--mode', choices=['scripts', 'pipeline'], default='scripts',
+                        help='scripts 依次运行生图和放大脚本，pipeline 运行流水线')
+    parser.add_argument('--boot-seconds', type=float, default=5.0)
+    parser.add_argument('--gen-seconds', type=float, default=2.0, help='每张图20步的模拟GPU时间')
+    parser.add_argument('--upscale-seconds', type=float, default=4.0, help='每张放大的模拟GPU时间')
+    parser.add_argument('--load-seconds', type=float, default=3.0, help='切换模型的模拟加载时间')
+    parser.add_argument('--model-upscale-seconds', type=float, default=1.0, help='放大中模型放大的模拟GPU时间，只重绘时不计')
+    parser.add_argument('--preprocess', action='store_true', help='放大脚本开启本地预处理，GPU只做重绘')
+    parser.add_argument('--no-save', action='store_true', help='不写入基准日志')
+    args = parser.parse_args()
+
+    config = {
+        'boot_seconds': args.boot_seconds,
+        'gen_seconds': args.gen_seconds,
+        'upscale_seconds': args.upscale_seconds,
+        'load_seconds': args.load_seconds,
+        'model_upscale_seconds': args.model_upscale_seconds,
+    }
+    config_json = json.dumps(dict(config, scenes=args.scenes, upscales=args.upscales, mode=args.mode,
+                                  preprocess=args.preprocess), sort_keys=True)
+    previous = previous_result(config_json)
+
+    result = run_benchmark(args.scenes, args.upscales, config, args.mode, args.preprocess)
+
+    print("\n===== 吞吐基准结果 =====")
+    print(f"场景/分钟: {result['scenes_per_minute']:.2f}")
+    print(f"放大/分钟: {result['upscales_per_minute']:.2f}")
+    print(f"上传: {result['upload_mb']:.2f} MB，下载: {result['download_mb']:.2f} MB")
+    print(f"实例启动等待: {result['boot_seconds']:.1f} 秒")
+    print(f"模型预热: {result['warmup_seconds']:.1f} 秒")
+    print(f"模拟计费时长: {result['billed_minutes']:.2f} 分钟")
+    print(f"总耗时: {result['total_seconds']:.1f} 秒")
+
+    if previous:
+        print(f"\n与上次结果对比 (commit {previous['commit']}):")
+        for label, key, column in [('场景/分钟', 'scenes_per_minute', '场景/分钟'),
+                                   ('放大/分钟', 'upscales_per_minute', '放大/分钟'),
+                                   ('模拟计费分钟', 'billed_minutes', '模拟计费分钟')]:
+            old_value = float(previous[column])
+            change = (result[key] - old_value) / old_value * 100 if old_value else 0
+            print(f"- {label}: {old_value:.2f} -> {result[key]:.2f} ({change:+.1f}%)")
+
+    if not args.no_save:
+        save_result(result, config_json)
+        print(f"\n结果已追加到: {BENCH_LOG_PATH}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+'''
+File: child_book_d_daemon.py
+Project: green
+Created: 2026-10-19 17:45:03
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 常驻工作进程：在 Unix socket 上接收 child_book.py 的命令，串行执行并把输出实时回传，
+             HTTP 连接池、工作流模板、目录索引和已导入的模块在命令之间保持；
+             脚本文件修改后（改了 GEN_MODE、MACHINE_TYPE 等常量）下一个命令自动重新加载
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import threading
+import importlib
+import socketserver
+import subprocess
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+# socket 和日志位置
+SOCKET_PATH = os.path.join(current_dir, '.child_book_daemon.sock')
+DAEMON_LOG_PATH = os.path.join(current_dir, 'log', 'child-book-daemon.log')
+
+# 被脚本 import * 的共享模块，按依赖顺序重新加载
+SHARED_MODULES = ['runcomfy_utils', 'child_book_utils']
+# 重新加载共享模块时保留的状态：连接池和按修改时间自行失效的缓存，与配置常量无关
+KEEP_WARM_STATE = {
+    'runcomfy_utils': ['_http_session'],
+    'child_book_utils': ['_workflow_cache', '_file_index_cache'],
+}
+
+def _project_modules():
+    """已导入的本项目模块 {模块名: 文件路径}（不含守护进程自身和命令入口）"""
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if (path and name not in (__name__, '__main__', 'child_book')
+                and os.path.dirname(os.path.abspath(path)) == current_dir):
+            modules[name] = path
+    return modules
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+class _JobOutput:
+    """任务执行期间替换 sys.stdout/sys.stderr，把输出放进任务的输出队列（kind 为 out 或 err）"""
+
+    def __init__(self, output_queue, fallback, kind='out'):
+        self.output_queue = output_queue
+        self.fallback = fallback
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.output_queue.put((self.kind, text))
+            self.fallback.write(text)
+        return len(text)
+
+    def flush(self):
+        self.fallback.flush()
+
+class ChildBookDaemon:
+    """守护进程状态：任务队列和唯一的执行线程
+
+    任务在同一个进程里串行执行，脚本模块只在文件没有修改时复用，
+    runcomfy_utils 的 HTTP 会话、熔断器和 child_book_utils 的模板/目录缓存都在命令之间复用。
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.jobs = queue.Queue()
+        self.started_at = time.time()
+        self.completed = 0
+        self.current = None
+        self.server = None
+        self.reloads = 0
+        # 已导入模块的文件修改时间 {模块名: 修改时间}
+        self.mtimes = {}
+        self._record_mtimes()
+        self._worker = threading.Thread(target=self._run_jobs, name='daemon-worker', daemon=True)
+        self._worker.start()
+
+    def submit(self, command):
+        """排队一个命令，返回用于读取输出的队列"""
+        output_queue = queue.Queue()
+        self.jobs.put((command, output_queue))
+        position = self.jobs.qsize() + (1 if self.current else 0)
+        if position > 1:
+            output_queue.put(('out', f"[守护进程] 已排队，前面还有 {position - 1} 个任务\n"))
+        return output_queue
+
+    def _record_mtimes(self):
+        for name, path in _project_modules().items():
+            self.mtimes.setdefault(name, _mtime(path))
+
+    def refresh_modules(self):
+        """脚本或共享模块的文件修改过时重新加载，返回修改过的模块名
+
+        共享模块原地重新加载（保留 KEEP_WARM_STATE 里的状态），脚本模块从 sys.modules 中移除，
+        下次导入时重新执行，import * 得到的常量也是新的。
+        """
+        modules = _project_modules()
+        changed = [name for name, path in modules.items()
+                   if name in self.mtimes and _mtime(path) != self.mtimes[name]]
+        if not changed:
+            return []
+        if any(name in SHARED_MODULES for name in changed):
+            for name in SHARED_MODULES:
+                module = sys.modules.get(name)
+                if module is None:
+                    continue
+                kept = {attr: getattr(module, attr) for attr in KEEP_WARM_STATE.get(name, []) if hasattr(module, attr)}
+                importlib.reload(module)
+                for attr, value in kept.items():
+                    setattr(module, attr, value)
+        for name in modules:
+            if name not in SHARED_MODULES:
+                sys.modules.pop(name, None)
+        self.mtimes = {name: mtime for name, mtime in self.mtimes.items() if name in SHARED_MODULES}
+        for name in SHARED_MODULES:
+            if name in modules:
+                self.mtimes[name] = _mtime(modules[name])
+        self.reloads += 1
+        return changed
+
+    def _run_jobs(self):
+        real_stdout = sys.stdout
+        real_stderr = sys.stderr
+        while True:
+            command, output_queue = self.jobs.get()
+            self.current = command
+            module_name, func_name, _ = self.commands[command]
+            exit_code = 0
+            sys.stdout = _JobOutput(output_queue, real_stdout)
+            sys.stderr = _JobOutput(output_queue, real_stderr, 'err')
+            try:
+                changed = self.refresh_modules()
+                if changed:
+                    print(f"[守护进程] {', '.join(sorted(changed))} 已修改，重新加载")
+                module = importlib.import_module(module_name)
+                result = getattr(module, func_name)()
+                exit_code = result if isinstance(result, int) else 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception as e:
+                import traceback
+                print(f"命令 {command} 执行出错: {e}")
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout = real_stdout
+                sys.stderr = real_stderr
+                self._record_mtimes()
+                self.current = None
+                self.completed += 1
+                output_queue.put(('exit', exit_code))
+
+    def status(self):
+        import runcomfy_utils
+        import child_book_utils
+        return {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started_at),
+            'completed': self.completed,
+            'reloads': self.reloads,
+            'current': self.current,
+            'queued': self.jobs.qsize(),
+            'loaded_modules': sorted(name for name, _, _ in self.commands.values() if name in sys.modules),
+            'workflow_templates': len(child_book_utils._workflow_cache),
+            'indexed_dirs': len(child_book_utils._file_index_cache),
+            'http_session': runcomfy_utils._http_session is not None,
+        }
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """每个连接一条请求（JSON行），回复为多条JSON行，以 exit 结束"""
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        daemon = self.server.daemon_state
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return self._send({'exit': 2, 'error': '请求格式错误'})
+
+        action = request.get('action')
+        if action == 'status':
+            return self._send({'exit': 0, 'status': daemon.status()})
+        if action == 'stop':
+            self._send({'exit': 0})
+            return threading.Thread(target=self.server.shutdown, daemon=True).start()
+        if action != 'run' or request.get('command') not in daemon.commands:
+            return self._send({'exit': 2, 'error': f"未知命令: {request.get('command') or action}"})
+
+        output_queue = daemon.submit(request['command'])
+        while True:
+            kind, value = output_queue.get()
+            try:
+                if kind == 'exit':
+                    return self._send({'exit': value})
+                self._send({kind: value})
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端断开不影响任务继续执行，输出仍写入守护进程日志
+                while output_queue.get()[0] != 'exit':
+                    pass
+                return
+
+def serve(commands, socket_path=SOCKET_PATH):
+    """在前台运行守护进程，直到收到 stop 请求或 SIGTERM"""
+    if daemon_request({'action': 'status'}, socket_path) is not None:
+        print(f"守护进程已在运行: {socket_path}")
+        return 1
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # 预先导入共享模块，第一个命令就不用付导入成本
+    import child_book_utils  # noqa: F401
+
+    daemon = ChildBookDaemon(commands)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _DaemonHandler)
+    server.daemon_threads = True
+    server.daemon_state = daemon
+    daemon.server = server
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    print(f"守护进程已启动 (pid={os.getpid()}): {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("守护进程已退出")
+    return 0
+
+def start_background(socket_path=SOCKET_PATH, wait=10):
+    """在后台启动守护进程，输出写入 DAEMON_LOG_PATH"""
+    if daemon_request({'action': 'status'}, socket_path) is not None:
+        print(f"守护进程已在运行: {socket_path}")
+        return 0
+    os.makedirs(os.path.dirname(DAEMON_LOG_PATH), exist_ok=True)
+    with open(DAEMON_LOG_PATH, 'a', encoding='utf-8') as log_file:
+        subprocess.Popen(
+            [sys.executable, '-u', os.path.join(current_dir, 'child_book.py'), 'daemon', 'run'],
+            stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT,
+            start_new_session=True, cwd=current_dir
+        )
+    start_time = time.time()
+    while time.time() - start_time < wait:
+        if daemon_request({'action': 'status'}, socket_path) is not None:
+            print(f"守护进程已启动，日志: {DAEMON_LOG_PATH}")
+            return 0
+        time.sleep(0.2)
+    print(f"守护进程启动超时，请查看日志: {DAEMON_LOG_PATH}")
+    return 1
+
+def daemon_request(request, socket_path=SOCKET_PATH, on_output=None, on_error=None):
+    """向守护进程发送请求
+
+    参数:
+        request (dict): {'action': 'run'/'status'/'stop', 'command': ...}
+        socket_path (str): socket 路径
+        on_output (callable): 收到标准输出文本时的回调
+        on_error (callable): 收到标准错误文本时的回调
+
+    返回:
+        dict: 最后一条回复（含 exit），守护进程未运行时返回None
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+    except OSError:
+        return None
+    with client, client.makefile('rb') as reader:
+        client.sendall((json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8'))
+        for line in reader:
+            message = json.loads(line.decode('utf-8'))
+            if 'out' in message:
+                if on_output:
+                    on_output(message['out'])
+                continue
+            if 'err' in message:
+                if on_error:
+                    on_error(message['err'])
+                continue
+            return message
+    return {'exit': 1, 'error': '守护进程连接中断'}
@@ -10,7 +10,6 @@ Description: 从UPSCALE_OUTPUT_DIR目录中复制需要PS处理的图片到PS_OU
 
 import os
 import sys
-import csv
 import shutil
 
 current_dir = os.path.dirname(__file__)
@@ -28,13 +27,8 @@ def copy_files_by_prefix():
     os.makedirs(PS_OUTPUT_DIR, exist_ok=True)
     
     # 读取CSV文件获取文件名前缀列表
-    prefixes = []
     try:
-        with open(PS_CSV_PATH, 'r', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if 'file name' in row and row['file name']:
-                    prefixes.append(row['file name'].strip())
+        prefixes = [row['file name'] for row in read_sheet(PS_CSV_PATH, required_columns=['file name'])]
     except Exception as e:
         print(f"读取CSV文件失败: {e}")
         return
@@ -46,11 +40,7 @@ def copy_files_by_prefix():
     print(f"从CSV文件中找到 {len(prefixes)} 个前缀")
     
     # 获取UPSCALE_OUTPUT_DIR目录中的所有文件
-    all_files = []
-    for root, _, files in os.walk(UPSCALE_OUTPUT_DIR):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.tiff', '.tif')):
-                all_files.append(os.path.join(root, file))
+    all_files = list_files(UPSCALE_OUTPUT_DIR)
     
     if not all_files:
         print(f"在 {UPSCALE_OUTPUT_DIR} 目录下没有找到图片文件")
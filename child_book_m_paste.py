@@ -9,7 +9,6 @@ Description:
 
 import os
 import sys
-import pandas as pd
 
 current_dir = os.path.dirname(__file__)
 sys.path.insert(0, os.path.dirname(current_dir))
@@ -22,42 +21,25 @@ Y_TILE_COUNT = 5
 TILE_WIDTH = 1024
 TILE_HEIGHT = 1024
 
-def find_file_in_subdirs(base_dir, filename_prefix):
-    """在基础目录及其子目录中递归查找第一个匹配前缀的文件（尝试常见扩展名）"""
-    common_extensions = ['.png', '.jpg', '.jpeg', '.webp']
-    # print(f"DEBUG: Searching for files starting with '{filename_prefix}' in {base_dir}") # Debug print
-    for root, dirs, files in os.walk(base_dir):
-        for f in files:
-            if f.lower().startswith(filename_prefix.lower()):
-                file_ext = os.path.splitext(f)[1].lower()
-                if file_ext in common_extensions:
-                    full_path = os.path.join(root, f)
-                    if os.path.isfile(full_path):
-                        # print(f"DEBUG: Found matching file for prefix '{filename_prefix}': {full_path}") # Debug print
-                        return full_path
-    # print(f"DEBUG: No file found starting with prefix '{filename_prefix}' in {base_dir}") # Debug print
-    return None
-
 # 主函数
 def main():
-    # 读取 CSV 文件
+    # 读取 CSV 文件（同一张图的同一个瓦片只处理一次）
     try:
-        df = pd.read_csv(GEN_INPAINT_CSV_PATH, encoding='utf-8')
-
-        # 检查必需的列
-        required_columns = ['file name', 'inpaint x', 'inpaint y']
-        if not all(col in df.columns for col in required_columns):
-            print(f"错误：CSV 文件 {GEN_INPAINT_CSV_PATH} 缺少必需的列 ({required_columns})")
-            return
+        records = read_sheet(
+            GEN_INPAINT_CSV_PATH,
+            required_columns=['file name', 'inpaint x', 'inpaint y'],
+            int_columns=['inpaint x', 'inpaint y'],
+            key_columns=('file name', 'inpaint x', 'inpaint y')
+        )
 
         # 遍历每一行
-        for index, row in df.iterrows():
+        for row in records:
             base_filename_prefix = row['file name'] # Use as prefix
             inpaint_x = row['inpaint x']
             inpaint_y = row['inpaint y']
 
             # 1. 在 INPAINT_CROP_SRC_DIR 及其子目录中查找原始放大图 (使用前缀匹配)
-            src_path = find_file_in_subdirs(INPAINT_CROP_SRC_DIR, base_filename_prefix)
+            src_path = find_file_by_prefix(INPAINT_CROP_SRC_DIR, base_filename_prefix)
             if not src_path:
                 print(f"警告：在 {INPAINT_CROP_SRC_DIR} 及其子目录中未找到以 '{base_filename_prefix}' 开头的原始放大图（已尝试常见扩展名）")
                 continue
@@ -105,10 +87,8 @@ def main():
             except Exception as e:
                 print(f"处理 {base_filename_prefix} (找到文件: {src_filename_with_ext}) 的瓦片 ({inpaint_x}, {inpaint_y}) 时出错: {e}")
 
-    except FileNotFoundError:
-        print(f"错误：未找到 CSV 文件 {GEN_INPAINT_CSV_PATH}")
-    except pd.errors.EmptyDataError:
-        print(f"错误：CSV 文件 {GEN_INPAINT_CSV_PATH} 为空")
+    except SheetError as e:
+        print(f"错误：{e}")
     except Exception as e:
         print(f"处理 CSV 文件时出错: {e}")
 
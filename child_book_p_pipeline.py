@@ -0,0 +1,322 @@
+'''
+File: child_book_p_pipeline.py
+Project: green
+Created: 2026-10-19 10:12:04
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 流水线驱动：生成、挑选、放大、PPI、整理串联在一次运行里，各阶段之间用有界队列连接
+'''
+
+import os
+import sys
+import time
+import queue
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from child_book_utils import *
+from child_book_1_gen import GEN_CONFIG, resolve_gen_paths, load_prompts, generate_scene
+from child_book_3_ppi import process_image
+
+# 机器类型常量
+MACHINE_TYPE = "medium"
+
+# 放大使用的实例：'same' 与生成共用一台实例（只启动一次），'second' 另开一台实例并行放大
+UPSCALE_INSTANCE = 'same'
+
+# 各阶段之间队列的最大长度
+QUEUE_SIZE = 4
+
+# 同时在放大实例上的任务数（同 child_book_2_upscale.UPSCALE_IN_FLIGHT），1 表示逐张串行
+UPSCALE_IN_FLIGHT = 2
+
+# 自动挑选：'all' 放大全部候选，'first' 每个场景只放大第1张候选，
+# 'picks' 按挑选文件/Gen表挑选列（load_picks）放大，没有挑选输入时放大全部
+SELECT_MODE = 'all'
+
+# 流水线结束后是否把PPI结果编码成交付文件（格式见 child_book_5_deliver.DELIVERY_FORMATS）
+RUN_DELIVER = False
+
+# 流水线结束后是否按项目整理PPI结果
+RUN_ORGANIZE = True
+
+# 队列结束标记
+_DONE = object()
+
+def select_candidates(scene, files, picks=None):
+    """按 SELECT_MODE 从一个场景的候选图中挑出需要放大的图片"""
+    if SELECT_MODE == 'first':
+        return sorted(files)[:1]
+    if SELECT_MODE == 'picks' and picks is not None:
+        return [f for f in files if os.path.splitext(os.path.basename(f))[0] in picks]
+    return list(files)
+
+def gen_stage(prompts, instance_url, save_dir, out_queue, stats, front=False):
+    """生成阶段：逐个场景生成，把 (场景, 文件列表) 放入下游队列；front 为 True 时（Retry 表的返工）插到 ComfyUI 队列最前面"""
+    try:
+        for scene in prompts:
+            stats['scenes'] += 1
+            print(f"\n[生成] 开始生成场景: {scene['name']} (风格: {scene['style']})")
+            try:
+                generated_files = generate_scene(scene, instance_url, save_dir, front=front)
+                if generated_files:
+                    stats['generated'] += len(generated_files)
+                    out_queue.put((scene, generated_files))
+            except Exception as e:
+                print(f"[生成] 生成场景 {scene['name']} 失败: {e}")
+    finally:
+        out_queue.put(_DONE)
+
+def select_stage(in_queue, out_queue, stats, picks=None):
+    """挑选阶段：每个场景挑出需要放大的候选图"""
+    try:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            scene, files = item
+            selected = select_candidates(scene, files, picks)
+            stats['skipped'] += len(files) - len(selected)
+            for image_path in selected:
+                out_queue.put(image_path)
+    finally:
+        out_queue.put(_DONE)
+
+def upscale_stage(in_queue, out_queue, get_instance_url, save_dir, stats):
+    """放大阶段：在实例上放大图片，结果按风格放入 save_dir 子目录（与 organize_images_by_style 一致）并交给PPI队列
+
+    与 child_book_2_upscale 一样最多 UPSCALE_IN_FLIGHT 张同时在实例上：一张在GPU上执行时下一张已上传排队，
+    结果下载与下一张的GPU执行重叠。名额用完时不再从上游取图，有界队列的背压不变。
+    """
+    slots = threading.BoundedSemaphore(UPSCALE_IN_FLIGHT)
+    lock = threading.Lock()
+    busy = {'active': 0, 'since': 0.0}
+
+    def upscale_job(image_path, instance_url, style_dir):
+        base_name_with_ext = os.path.basename(image_path)
+        print(f"\n[放大] 开始处理图片: {base_name_with_ext}")
+        # 多张同时在实例上时单张耗时互相重叠，放大耗时按有任务在执行的墙钟时间计
+        with lock:
+            if not busy['active']:
+                busy['since'] = time.time()
+            busy['active'] += 1
+        try:
+            upscaled_file = runcomfy_upscale(
+                image_path=image_path,
+                instance_url=instance_url,
+                save_dir=style_dir
+            )
+            if upscaled_file:
+                with lock:
+                    stats['upscaled'] += 1
+                out_queue.put(upscaled_file)
+        except Exception as e:
+            print(f"[放大] 处理图片 {base_name_with_ext} 失败: {e}")
+        finally:
+            with lock:
+                busy['active'] -= 1
+                if not busy['active']:
+                    stats['upscale_seconds'] += time.time() - busy['since']
+            slots.release()
+
+    try:
+        instance_url = get_instance_url()
+        with ThreadPoolExecutor(max_workers=UPSCALE_IN_FLIGHT, thread_name_prefix='pipeline-upscale') as pool:
+            while True:
+                image_path = in_queue.get()
+                if image_path is _DONE:
+                    break
+                base_name_with_ext = os.path.basename(image_path)
+                base_name_no_ext = os.path.splitext(base_name_with_ext)[0]
+                style_dir = os.path.join(save_dir, image_style(base_name_no_ext))
+                os.makedirs(style_dir, exist_ok=True)
+
+                # 已经放大过的图片直接交给下游
+                existing = [f for f in os.listdir(style_dir) if f.startswith(base_name_no_ext)]
+                if existing:
+                    print(f"[放大] {base_name_with_ext} 的放大版本 ({existing[0]}) 已存在，跳过放大。")
+                    out_queue.put(os.path.join(style_dir, existing[0]))
+                    continue
+
+                slots.acquire()
+                pool.submit(upscale_job, image_path, instance_url, style_dir)
+    except Exception as e:
+        # 获取实例失败时清空上游队列，避免上游阻塞
+        print(f"[放大] 放大阶段失败: {e}")
+        while in_queue.get() is not _DONE:
+            pass
+    finally:
+        out_queue.put(_DONE)
+
+def ppi_stage(in_queue, stats):
+    """PPI阶段：本地调整尺寸和PPI，按风格放入 PPI_OUTPUT_DIR 子目录"""
+    try:
+        while True:
+            image_path = in_queue.get()
+            if image_path is _DONE:
+                break
+            filename = os.path.basename(image_path)
+            try:
+                style = image_style(filename)
+                output_dir = os.path.join(PPI_OUTPUT_DIR, style)
+                temp_dir = os.path.join(PPI_TEMP_DIR, style)
+                os.makedirs(output_dir, exist_ok=True)
+                os.makedirs(temp_dir, exist_ok=True)
+                process_image(image_path, os.path.join(temp_dir, filename), os.path.join(output_dir, filename))
+                stats['ppi'] += 1
+                print(f"[PPI] 成功处理: {filename}")
+            except Exception as e:
+                print(f"[PPI] 处理 {filename} 时出错: {e}")
+    except Exception as e:
+        # 出错时清空上游队列，避免放大阶段阻塞在有界队列上
+        print(f"[PPI] PPI阶段失败: {e}")
+        while in_queue.get() is not _DONE:
+            pass
+
+# 主函数
+def main():
+    # 记录开始时间
+    start_time = time.time()
+    start_datetime = datetime.now()
+    print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    input_csv_path, gen_save_dir = resolve_gen_paths()
+    prompts = load_prompts(input_csv_path)
+    # Retry 表的返工场景与 gen 脚本一样插到 ComfyUI 队列最前面
+    front = input_csv_path == GEN_RETRY_CSV_PATH
+    os.makedirs(UPSCALE_OUTPUT_DIR, exist_ok=True)
+
+    stats = {'scenes': 0, 'generated': 0, 'skipped': 0, 'upscaled': 0, 'upscale_seconds': 0.0, 'ppi': 0}
+    picks = load_picks() if SELECT_MODE == 'picks' else None
+    if SELECT_MODE == 'picks' and picks is None:
+        print(f"未找到挑选输入（{UPSCALE_PICKS_PATH} 或 {UPSCALE_PICK_COLUMN} 列），放大全部候选")
+    upscale_lifecycle = None
+    instance_count = 1
+
+    # 实例生命周期管理
+    lifecycle = InstanceLifecycleManager(
+        idle_timeout=INSTANCE_IDLE_TIMEOUT,
+        keep_warm=INSTANCE_KEEP_WARM,
+        price_per_hour=RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
+    )
+
+    try:
+        # 获取或创建RunComfy实例，并登记租约
+        instance_url = lifecycle.acquire(
+            create_new_instance=True,
+            server_type=MACHINE_TYPE,
+            estimated_duration=14400
+        )
+        print(f"获取到RunComfy实例: {instance_url}")
+        # 新实例先预热本次要用的模板（放大共用实例时也预热放大模板）
+        warmup_templates = list(GEN_CONFIG) + (['upscale'] if UPSCALE_INSTANCE == 'same' else [])
+        warm_up_instance(instance_url, warmup_templates, created=lifecycle.created, machine_type=MACHINE_TYPE)
+
+        if UPSCALE_INSTANCE == 'second':
+            # 第二台实例在放大线程里启动，启动期间生成照常进行；它有自己的实例文件和租约，
+            # 同样有心跳、空闲停机和保温，由主实例的计费表统一结算
+            upscale_lifecycle = InstanceLifecycleManager(
+                service=RunComfyService(instance_file=".runcomfy_instance_upscale"),
+                idle_timeout=INSTANCE_IDLE_TIMEOUT,
+                keep_warm=INSTANCE_KEEP_WARM,
+                price_per_hour=lifecycle.price_per_hour,
+                meter=lifecycle.meter
+            )
+            instance_count = 2
+
+            def get_upscale_url():
+                upscale_url = upscale_lifecycle.acquire(
+                    create_new_instance=True,
+                    server_type=MACHINE_TYPE,
+                    estimated_duration=14400,
+                    reuse_any=False
+                )
+                warm_up_instance(upscale_url, ['upscale'], created=upscale_lifecycle.created, machine_type=MACHINE_TYPE)
+                return upscale_url
+        else:
+            get_upscale_url = lambda: instance_url
+
+        # 各阶段之间的有界队列
+        selected_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        upscale_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        ppi_queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+        threads = [
+            threading.Thread(target=gen_stage, args=(prompts, instance_url, gen_save_dir, selected_queue, stats, front), name='gen'),
+            threading.Thread(target=select_stage, args=(selected_queue, upscale_queue, stats, picks), name='select'),
+            threading.Thread(target=upscale_stage, args=(upscale_queue, ppi_queue, get_upscale_url, UPSCALE_OUTPUT_DIR, stats), name='upscale'),
+            threading.Thread(target=ppi_stage, args=(ppi_queue, stats), name='ppi'),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except Exception as e:
+        print(f"处理失败: {e}")
+    finally:
+        # 释放第二台放大实例和主实例：没有其他脚本使用时进入保温窗口，到期自动停机
+        for manager in (upscale_lifecycle, lifecycle):
+            if manager is None:
+                continue
+            try:
+                manager.release()
+            except Exception as e:
+                print(f"\n释放实例失败: {e}")
+
+    # 编码交付文件（整理会移走PPI结果，所以在整理之前）
+    if RUN_DELIVER:
+        from child_book_5_deliver import deliver_images
+        deliver_images(src_dir=PPI_OUTPUT_DIR)
+
+    # 按项目整理PPI结果
+    if RUN_ORGANIZE:
+        organize_images_by_project(src_dir=PPI_OUTPUT_DIR, output_dir=ORGANIZE_PROJECT_OUTPUT)
+
+    # 记录结束时间并计算耗时
+    end_time = time.time()
+    end_datetime = datetime.now()
+    duration_minutes = (end_time - start_time) / 60
+
+    # 按实例实际的创建/就绪/停止时间结算计费，费用按任务耗时分摊到每张图
+    billing = lifecycle.meter.settle('pipeline')
+    billable_minutes = billing['billed_seconds'] / 60
+
+    # 计算机器使用成本
+    machine_price_per_hour = RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
+    estimated_cost = billing['cost']
+
+    print(f"\n生成 {stats['generated']} 张，跳过 {stats['skipped']} 张，放大 {stats['upscaled']} 张，PPI处理 {stats['ppi']} 张")
+    print(f"开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"结束运行时间: {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"总运行时间: {duration_minutes:.2f} 分钟")
+    print(f"实际计费时间: {billable_minutes:.2f} 分钟（启动 {billing['boot_seconds'] / 60:.2f}，空闲 {billing['idle_seconds'] / 60:.2f}）")
+    print(f"使用机器类型: {MACHINE_TYPE} x {instance_count}")
+    print(f"计费方式: {RUNCOMFY_BILLING_TYPE}")
+    print(f"预估使用成本: ${estimated_cost:.2f}")
+    if billing['cost_per_image']:
+        print(f"单张成本: ${billing['cost_per_image']:.4f}（{billing['images']} 张）")
+
+    # 记录挑选节省的放大成本
+    if stats['skipped']:
+        log_selection_savings('pipeline', stats['skipped'], stats['upscaled'], stats['upscale_seconds'], machine_price_per_hour)
+
+    # 记录脚本执行日志
+    log_script_execution(
+        script_type='pipeline',
+        image_count=stats['scenes'],
+        start_time=start_datetime,
+        end_time=end_datetime,
+        billable_minutes=billable_minutes,
+        billing_type=RUNCOMFY_BILLING_TYPE,
+        machine_type=MACHINE_TYPE,
+        machine_price_per_hour=machine_price_per_hour,
+        estimated_cost=estimated_cost,
+        billing=billing
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+'''
+File: child_book_q_queue.py
+Project: green
+Created: 2026-10-19 20:41:08
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 多本书共用的任务队列：扫描各项目工作区的返工、生成和放大任务，按优先级和项目公平分配GPU时间，
+             在同一台（或几台）实例上交替执行，一本书等人工审图时实例继续处理其他书
+'''
+
+import os
+import sys
+import time
+import threading
+from datetime import datetime
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from child_book_utils import *
+from child_book_1_gen import GEN_CONFIG, generate_scene
+
+# 机器类型常量
+MACHINE_TYPE = "medium"
+
+# 参与排队的项目（WORKSPACES_PATH 下的目录名），None 表示所有有 Gen 表的项目
+QUEUE_PROJECTS = None
+
+# 项目权重：权重越大分到的GPU时间越多，未列出的项目权重为 1
+PROJECT_WEIGHTS = {}
+
+# 并行使用的实例数，每台实例一个工作线程
+QUEUE_INSTANCES = 1
+
+# 放大任务只来自人工挑选（挑选文件或 Gen 表挑选列），没有挑选的书等审图后再放大
+QUEUE_UPSCALE_REQUIRES_PICKS = True
+
+# 优先级从高到低：urgent 客户退回的返工（Retry 表），interactive 等人审图的新场景，bulk 批量放大
+PRIORITY_CLASSES = ['urgent', 'interactive', 'bulk']
+JOB_PRIORITY = {'retry': 'urgent', 'gen': 'interactive', 'upscale': 'bulk'}
+
+# 这些优先级的任务提交时插到 ComfyUI 队列最前面（实例与其他脚本共用时也先执行）
+FRONT_CLASSES = ('urgent', 'interactive')
+
+# 每隔多少秒重新扫描工作区（执行中也扫描，返工任务不用等队列空），队列空了以后最多等待多少秒（应小于 INSTANCE_IDLE_TIMEOUT）
+QUEUE_RESCAN_SECONDS = 30
+QUEUE_WAIT_SECONDS = 300
+
+# 每个任务最多执行几次：失败后放回本项目待办队尾重试，用完次数才记为失败
+QUEUE_MAX_ATTEMPTS = 2
+
+class FairShareQueue:
+    """按优先级和项目公平分配的任务队列
+
+    取任务时先选优先级最高的一档（还没开始的低优先级任务一律往后推），同一档内选择
+    已用GPU秒数/权重 最小的项目（正在执行的任务按开始以来的时间计入），同一项目内按加入顺序。
+    失败的任务放回队尾，最多执行 QUEUE_MAX_ATTEMPTS 次。
+    每档统计排队等待时间（加入到第一次开始）和周转时间（加入到最终完成）。
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.pending = {}
+        self.usage = {}
+        self.running = {}
+        self.known = set()
+        self.progress = {}
+        self.class_stats = {}
+        self._condition = threading.Condition()
+
+    def add(self, project, kind, name, payload, priority='bulk'):
+        """加入一个任务，同一项目同名任务只加入一次，返回是否是新任务"""
+        key = (project, kind, name)
+        with self._condition:
+            if key in self.known:
+                return False
+            self.known.add(key)
+            self.pending.setdefault(project, []).append({
+                'project': project, 'kind': kind, 'name': name, 'payload': payload,
+                'priority': priority, 'enqueued_at': time.time(), 'attempts': 0
+            })
+            self.usage.setdefault(project, 0.0)
+            progress = self.progress.setdefault(project, {'total': 0, 'done': 0, 'failed': 0, 'images': 0, 'seconds': 0.0})
+            progress['total'] += 1
+            self._condition.notify()
+            return True
+
+    def _share(self, project, now):
+        started = [start for (p, _), start in self.running.items() if p == project]
+        used = self.usage[project] + sum(now - start for start in started)
+        return used / self.weights.get(project, 1)
+
+    def next(self, timeout=None):
+        """取下一个任务，超时没有任务时返回None"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: any(self.pending.values()), timeout):
+                return None
+            now = time.time()
+            rank = {priority: index for index, priority in enumerate(PRIORITY_CLASSES)}
+            best = min(rank[job['priority']] for jobs in self.pending.values() for job in jobs)
+            candidates = {p: [job for job in jobs if rank[job['priority']] == best] for p, jobs in self.pending.items()}
+            project = min((p for p, jobs in candidates.items() if jobs), key=lambda p: (self._share(p, now), p))
+            job = candidates[project][0]
+            self.pending[project].remove(job)
+            self.running[(project, id(job))] = now
+            job['started_at'] = now
+            job['attempts'] += 1
+            stats = self.class_stats.setdefault(job['priority'], {'jobs': 0, 'wait': 0.0, 'max_wait': 0.0, 'turnaround': 0.0})
+            if job['attempts'] == 1:
+                wait = now - job['enqueued_at']
+                stats['jobs'] += 1
+                stats['wait'] += wait
+                stats['max_wait'] = max(stats['max_wait'], wait)
+            return job
+
+    def done(self, job, seconds, images=0, ok=True):
+        """任务结束，计入项目的GPU用量和进度，返回项目进度
+
+        失败且还没用完 QUEUE_MAX_ATTEMPTS 次的任务放回本项目待办队尾（job['requeued'] 为 True），
+        不计入完成或失败。
+        """
+        with self._condition:
+            self.running.pop((job['project'], id(job)), None)
+            self.usage[job['project']] += seconds
+            progress = self.progress[job['project']]
+            progress['images'] += images
+            progress['seconds'] += seconds
+            job['requeued'] = not ok and job['attempts'] < QUEUE_MAX_ATTEMPTS
+            if job['requeued']:
+                self.pending[job['project']].append(job)
+                self._condition.notify_all()
+                return dict(progress)
+            progress['done' if ok else 'failed'] += 1
+            self.class_stats[job['priority']]['turnaround'] += time.time() - job['enqueued_at']
+            self._condition.notify_all()
+            return dict(progress)
+
+    def idle(self):
+        """没有待办也没有执行中的任务"""
+        with self._condition:
+            return not self.running and not any(self.pending.values())
+
+def scan_scenes(project, csv_path, save_dir, kind, job_queue):
+    """把表格中在 save_dir 还没有候选图的场景加入队列，返回新加入的任务数"""
+    os.makedirs(save_dir, exist_ok=True)
+    generated = {os.path.splitext(file)[0] for file in os.listdir(save_dir)}
+    added = 0
+    try:
+        for record in read_sheet(csv_path, required_columns=['file name', 'style', 'final prompt']):
+            name = record['file name']
+            if record['style'] not in GEN_CONFIG:
+                continue
+            if any(stem == name or stem.startswith(f"{name}_") for stem in generated):
+                continue
+            scene = {'name': name, 'style': record['style'], 'prompt': record['final prompt']}
+            added += job_queue.add(project, kind, name, scene, JOB_PRIORITY[kind])
+    except SheetError as e:
+        print(f"[{project}] {e}")
+    return added
+
+def scan_workspace(workspace, job_queue):
+    """扫描一个工作区，把还没完成的返工、生成和放大任务加入队列，返回新加入的任务数"""
+    project = workspace['project']
+    gen_dir = workspace['gen_dir']
+
+    # 返工任务：Retry 表中还没有重新生成的场景；生成任务：Gen 表中还没有候选图的场景
+    added = 0
+    if os.path.exists(workspace['retry_csv']):
+        added += scan_scenes(project, workspace['retry_csv'], workspace['retry_dir'], 'retry', job_queue)
+    added += scan_scenes(project, workspace['gen_csv'], gen_dir, 'gen', job_queue)
+
+    # 放大任务：挑中且还没放大的候选图
+    picks = load_picks(workspace['picks'], workspace['gen_csv'])
+    if picks is None and QUEUE_UPSCALE_REQUIRES_PICKS:
+        return added
+    plan = plan_upscale(gen_dir, workspace['upscale_dir'], picks)
+    for image_path in plan['todo']:
+        added += job_queue.add(project, 'upscale', os.path.splitext(os.path.basename(image_path))[0], image_path, JOB_PRIORITY['upscale'])
+    return added
+
+def run_job(job, instance_url, workspaces):
+    """在实例上执行一个任务，返回产出的图片数"""
+    workspace = workspaces[job['project']]
+    front = job['priority'] in FRONT_CLASSES
+    if job['kind'] in ('gen', 'retry'):
+        save_dir = workspace['retry_dir'] if job['kind'] == 'retry' else workspace['gen_dir']
+        generated_files = generate_scene(job['payload'], instance_url, save_dir, front=front)
+        return len(generated_files or [])
+    os.makedirs(workspace['upscale_dir'], exist_ok=True)
+    runcomfy_upscale(image_path=job['payload'], instance_url=instance_url, save_dir=workspace['upscale_dir'], front=front)
+    return 1
+
+def worker(instance_label, get_instance_url, job_queue, workspaces, stop_event):
+    """实例工作线程：不断从队列取任务执行，直到 stop_event 被设置"""
+    try:
+        instance_url = get_instance_url()
+    except Exception as e:
+        print(f"[{instance_label}] 获取实例失败: {e}")
+        return
+    while not stop_event.is_set():
+        job = job_queue.next(timeout=1)
+        if job is None:
+            continue
+        action = {'retry': '返工', 'gen': '生成', 'upscale': '放大'}[job['kind']]
+        print(f"\n[{instance_label}] [{job['project']}] [{job['priority']}] 开始{action}: {job['name']}"
+              f"（排队 {job['started_at'] - job['enqueued_at']:.0f} 秒）")
+        job_start = time.time()
+        images = 0
+        ok = True
+        try:
+            images = run_job(job, instance_url, workspaces)
+        except Exception as e:
+            ok = False
+            print(f"[{instance_label}] [{job['project']}] {job['name']} 失败: {e}")
+        progress = job_queue.done(job, time.time() - job_start, images, ok)
+        if job['requeued']:
+            print(f"[{instance_label}] [{job['project']}] {job['name']} 放回队列重试（第 {job['attempts']}/{QUEUE_MAX_ATTEMPTS} 次失败）")
+        print(f"[{job['project']}] 进度 {progress['done'] + progress['failed']}/{progress['total']}，"
+              f"GPU {progress['seconds'] / 60:.1f} 分钟")
+
+# 主函数
+def main():
+    # 记录开始时间
+    start_time = time.time()
+    start_datetime = datetime.now()
+    print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    projects = QUEUE_PROJECTS or list_workspaces()
+    if not projects:
+        print(f"在 {WORKSPACES_PATH} 下没有找到带 Gen 表的项目工作区")
+        return
+    workspaces = {project: get_workspace(project) for project in projects}
+    job_queue = FairShareQueue(PROJECT_WEIGHTS)
+    for workspace in workspaces.values():
+        scan_workspace(workspace, job_queue)
+    for project, progress in job_queue.progress.items():
+        print(f"[{project}] 待处理任务 {progress['total']} 个")
+    if job_queue.idle():
+        print("所有项目都没有待处理的任务")
+        return
+
+    machine_price_per_hour = RUNCOMFY_MACHINE_PRICES[RUNCOMFY_BILLING_TYPE][MACHINE_TYPE]
+
+    # 实例生命周期管理
+    lifecycle = InstanceLifecycleManager(
+        idle_timeout=INSTANCE_IDLE_TIMEOUT,
+        keep_warm=INSTANCE_KEEP_WARM,
+        price_per_hour=machine_price_per_hour
+    )
+    extra_lifecycles = []
+    threads = []
+    stop_event = threading.Event()
+    try:
+        # 获取或创建RunComfy实例，并登记租约
+        instance_url = lifecycle.acquire(
+            create_new_instance=True,
+            server_type=MACHINE_TYPE,
+            estimated_duration=14400
+        )
+        print(f"获取到RunComfy实例: {instance_url}")
+
+        # 每台实例在自己的工作线程里预热，预热期间主线程照常扫描工作区
+        warmup_templates = list(GEN_CONFIG) + ['upscale']
+        created = lifecycle.created
+
+        def get_first_url():
+            warm_up_instance(instance_url, warmup_templates, created=created, machine_type=MACHINE_TYPE)
+            return instance_url
+        getters = [get_first_url]
+        for index in range(1, QUEUE_INSTANCES):
+            # 其余实例在各自线程里启动，启动期间第一台实例照常执行任务；每台实例有自己的实例文件和租约，
+            # 由主实例的计费表统一结算
+            extra = InstanceLifecycleManager(
+                service=RunComfyService(instance_file=f".runcomfy_instance_queue{index}"),
+                idle_timeout=INSTANCE_IDLE_TIMEOUT,
+                keep_warm=INSTANCE_KEEP_WARM,
+                price_per_hour=machine_price_per_hour,
+                meter=lifecycle.meter
+            )
+            extra_lifecycles.append(extra)
+
+            def get_extra_url(extra=extra):
+                extra_url = extra.acquire(
+                    create_new_instance=True,
+                    server_type=MACHINE_TYPE,
+                    estimated_duration=14400,
+                    reuse_any=False
+                )
+                warm_up_instance(extra_url, warmup_templates, created=extra.created, machine_type=MACHINE_TYPE)
+                return extra_url
+            getters.append(get_extra_url)
+
+        threads = [
+            threading.Thread(target=worker, args=(f"实例{index + 1}", getter, job_queue, workspaces, stop_event), name=f'queue-{index + 1}')
+            for index, getter in enumerate(getters)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # 定期重新扫描工作区：Retry 表新增的返工马上插队，审图完成后新的挑选会变成放大任务，
+        # 表格新增的场景会变成生成任务
+        waited_since = None
+        while True:
+            time.sleep(QUEUE_RESCAN_SECONDS)
+            # 工作线程都已退出（例如实例都没有获取到）时没人取任务，不能一直占着租约等下去
+            if not any(thread.is_alive() for thread in threads) and not job_queue.idle():
+                pending = sum(len(jobs) for jobs in job_queue.pending.values())
+                print(f"\n所有实例的工作线程都已退出，还有 {pending} 个任务未执行，结束排队")
+                log_event('queue_stalled', pending=pending, instances=len(threads))
+                break
+            added = sum(scan_workspace(workspace, job_queue) for workspace in workspaces.values())
+            if added:
+                print(f"\n重新扫描工作区，新增 {added} 个任务")
+            if added or not job_queue.idle():
+                waited_since = None
+                continue
+            waited_since = waited_since or time.time()
+            if time.time() - waited_since >= QUEUE_WAIT_SECONDS:
+                print(f"\n{QUEUE_WAIT_SECONDS} 秒内没有新任务，结束排队")
+                break
+            print(f"队列已空，等待审图或新场景（已等待 {time.time() - waited_since:.0f} 秒）")
+    except KeyboardInterrupt:
+        print("\n收到中断，等待执行中的任务完成")
+    except Exception as e:
+        print(f"处理失败: {e}")
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        # 释放额外的实例和主实例：没有其他脚本使用时进入保温窗口，到期自动停机
+        for manager in extra_lifecycles + [lifecycle]:
+            try:
+                manager.release()
+            except Exception as e:
+                print(f"\n释放实例失败: {e}")
+
+    # 记录结束时间并计算耗时
+    end_time = time.time()
+    end_datetime = datetime.now()
+    duration_minutes = (end_time - start_time) / 60
+
+    # 按实例实际的创建/就绪/停止时间结算计费，再按各项目的GPU用量分摊
+    billing = lifecycle.meter.settle('queue')
+    billable_minutes = billing['billed_seconds'] / 60
+    estimated_cost = billing['cost']
+    total_seconds = sum(progress['seconds'] for progress in job_queue.progress.values())
+
+    print("\n各项目进度:")
+    for project, progress in sorted(job_queue.progress.items()):
+        share = progress['seconds'] / total_seconds if total_seconds else 0
+        print(f"- {project}: 完成 {progress['done']}/{progress['total']}，失败 {progress['failed']}，"
+              f"图片 {progress['images']} 张，GPU {progress['seconds'] / 60:.1f} 分钟（{share:.0%}），"
+              f"分摊成本 ${estimated_cost * share:.2f}")
+        log_event('queue_project', project=project, total=progress['total'], done=progress['done'],
+                  failed=progress['failed'], images=progress['images'], gpu_seconds=round(progress['seconds'], 1),
+                  weight=PROJECT_WEIGHTS.get(project, 1), cost=round(estimated_cost * share, 4))
+
+    print("\n各优先级排队时间:")
+    for priority in PRIORITY_CLASSES:
+        stats = job_queue.class_stats.get(priority)
+        if not stats:
+            continue
+        print(f"- {priority}: {stats['jobs']} 个任务，平均排队 {stats['wait'] / stats['jobs']:.0f} 秒，"
+              f"最长 {stats['max_wait']:.0f} 秒，平均周转 {stats['turnaround'] / stats['jobs']:.0f} 秒")
+        log_event('queue_priority', priority=priority, jobs=stats['jobs'],
+                  mean_wait=round(stats['wait'] / stats['jobs'], 1), max_wait=round(stats['max_wait'], 1),
+                  mean_turnaround=round(stats['turnaround'] / stats['jobs'], 1))
+
+    print(f"\n开始运行时间: {start_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"结束运行时间: {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"总运行时间: {duration_minutes:.2f} 分钟")
+    print(f"实际计费时间: {billable_minutes:.2f} 分钟（启动 {billing['boot_seconds'] / 60:.2f}，空闲 {billing['idle_seconds'] / 60:.2f}）")
+    print(f"使用机器类型: {MACHINE_TYPE} x {QUEUE_INSTANCES}")
+    print(f"计费方式: {RUNCOMFY_BILLING_TYPE}")
+    print(f"预估使用成本: ${estimated_cost:.2f}")
+
+    # 记录脚本执行日志
+    log_script_execution(
+        script_type='queue',
+        image_count=sum(progress['done'] for progress in job_queue.progress.values()),
+        start_time=start_datetime,
+        end_time=end_datetime,
+        billable_minutes=billable_minutes,
+        billing_type=RUNCOMFY_BILLING_TYPE,
+        machine_type=MACHINE_TYPE,
+        machine_price_per_hour=machine_price_per_hour,
+        estimated_cost=estimated_cost,
+        billing=billing
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+'''
+File: child_book_r_review.py
+Project: green
+Created: 2026-10-19 18:32:17
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 审图联系表：从缩略图缓存拼出每个场景的候选对比图和整本书的总览图，
+             挑选候选、PS/Fix 分拣前不用逐张打开原图
+'''
+
+import os
+import re
+import sys
+import json
+import time
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from child_book_utils import *
+
+ImageDraw = lazy_import('PIL.ImageDraw')
+
+# 需要生成联系表的目录：{名称: 目录}，放大目录按风格分了子目录，递归查找
+REVIEW_SOURCES = {
+    'draft': GEN_DRAFT_DIR,
+    'gen': UPSCALE_SRC_DIR,
+    'upscaled': UPSCALE_OUTPUT_DIR,
+}
+
+# 联系表输出目录，每个来源一个子目录
+REVIEW_OUTPUT_DIR = os.path.join(BASE_PATH, 'child-book-review')
+
+# 场景联系表每行几张候选；整本书总览中每张图的长边
+SCENE_COLUMNS = 4
+BOOK_CELL_SIZE = 192
+
+# 生成缩略图的进程数（None 表示 CPU 核数）
+THUMBNAIL_WORKERS = None
+
+# 是否删除缓存里已不对应任何源图的缩略图（只清理本次扫描过的来源）
+PRUNE_THUMBNAILS = True
+
+# 标签栏高度和颜色
+LABEL_HEIGHT = 18
+BACKGROUND = (40, 40, 40)
+LABEL_COLOR = (230, 230, 230)
+
+# 联系表清单文件：记录每张联系表用到的缩略图，没有变化的联系表不重新拼
+MANIFEST_NAME = 'manifest.json'
+
+def scene_name(image_path):
+    """候选图所属的场景名：去掉扩展名和末尾的 _序号"""
+    return re.sub(r'_\d+$', '', os.path.splitext(os.path.basename(image_path))[0])
+
+def short_label(text):
+    """标签只保留文件名前面的 ASCII 部分（默认字体没有中文字形），如 1-w-158 或 _3"""
+    return re.match(r'[\x20-\x7e]*', text).group(0).rstrip('-') or text[:8]
+
+def build_sheet(cells, columns, cell_size, dst_path):
+    """把 (缩略图路径, 标签) 按网格拼成一张 JPEG 联系表"""
+    rows = (len(cells) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * cell_size, rows * (cell_size + LABEL_HEIGHT)), BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    for index, (thumb_path, label) in enumerate(cells):
+        x = (index % columns) * cell_size
+        y = (index // columns) * (cell_size + LABEL_HEIGHT)
+        if thumb_path:
+            with Image.open(thumb_path) as thumb:
+                thumb.thumbnail((cell_size, cell_size))
+                sheet.paste(thumb, (x + (cell_size - thumb.width) // 2, y + (cell_size - thumb.height) // 2))
+        draw.text((x + 4, y + cell_size + 3), label, fill=LABEL_COLOR)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    sheet.save(dst_path, 'JPEG', quality=85)
+
+def review_source(name, src_dir):
+    """为一个来源目录生成场景联系表和每本书的总览图，返回 (新缩略图数, 重新拼的联系表数)"""
+    image_files = sorted(list_files(src_dir))
+    if not image_files:
+        print(f"[{name}] {src_dir} 中没有图片，跳过")
+        return 0, 0
+
+    thumbnails, built = ensure_thumbnails(image_files, workers=THUMBNAIL_WORKERS)
+    print(f"[{name}] {len(image_files)} 张图片，新生成缩略图 {built} 张")
+
+    # 按书（文件名第1个"-"前）和场景分组，保持文件名顺序
+    books = {}
+    for image_path in image_files:
+        if image_path not in thumbnails:
+            continue
+        scene = scene_name(image_path)
+        book = scene.split('-')[0]
+        books.setdefault(book, {}).setdefault(scene, []).append(image_path)
+
+    output_dir = os.path.join(REVIEW_OUTPUT_DIR, name)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            old_manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        old_manifest = {}
+
+    # 每张联系表：(文件名, 单元格列表, 列数, 单元格尺寸)
+    sheets = []
+    for book, scenes in books.items():
+        book_cells = []
+        book_columns = max(len(paths) for paths in scenes.values()) + 1
+        for scene, paths in scenes.items():
+            cells = [(thumbnails[path], short_label(os.path.splitext(os.path.basename(path))[0][len(scene):]) or '-') for path in paths]
+            sheets.append((os.path.join(book, f"{scene}.jpg"), cells, min(SCENE_COLUMNS, len(cells)), THUMBNAIL_SIZE))
+            # 总览图每个场景一行，第一格留给场景编号
+            book_cells.append((None, short_label(scene)))
+            book_cells.extend(cells)
+            book_cells.extend([(None, '')] * (book_columns - 1 - len(cells)))
+        sheets.append((f"book-{book}.jpg", book_cells, book_columns, BOOK_CELL_SIZE))
+
+    manifest = {}
+    rebuilt = 0
+    for sheet_name, cells, columns, cell_size in sheets:
+        dst_path = os.path.join(output_dir, sheet_name)
+        manifest[sheet_name] = [thumb_path for thumb_path, _ in cells]
+        if old_manifest.get(sheet_name) == manifest[sheet_name] and os.path.exists(dst_path):
+            continue
+        build_sheet(cells, columns, cell_size, dst_path)
+        rebuilt += 1
+
+    # 源图已不存在的场景，删掉旧联系表
+    for sheet_name in set(old_manifest) - set(manifest):
+        stale_path = os.path.join(output_dir, sheet_name)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    print(f"[{name}] {len(books)} 本书，{len(sheets)} 张联系表，重新拼 {rebuilt} 张: {output_dir}")
+    return built, rebuilt
+
+def manifest_thumbnails(name):
+    """上次为该来源拼联系表时用到的缩略图路径"""
+    try:
+        with open(os.path.join(REVIEW_OUTPUT_DIR, name, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return set()
+    return {thumb_path for thumb_paths in manifest.values() for thumb_path in thumb_paths if thumb_path}
+
+def prune_thumbnails(keep_paths, candidates):
+    """删除 candidates 中不在 keep_paths 里的缩略图（源图已删除或已被覆盖）
+
+    只处理本次扫描过的来源上次用到的缩略图，目录不存在（例如移动硬盘没有挂载）的来源不受影响；
+    其它进程正在写入的 .tmp 临时文件不会被删除。
+    """
+    removed = 0
+    for path in candidates - keep_paths:
+        if path.endswith('.tmp') or not os.path.exists(path):
+            continue
+        os.remove(path)
+        removed += 1
+    return removed
+
+# 主函数
+def main():
+    start_time = time.time()
+    keep_paths = set()
+    candidates = set()
+    for name, src_dir in REVIEW_SOURCES.items():
+        if not os.path.exists(src_dir):
+            print(f"[{name}] 目录不存在: {src_dir}")
+            continue
+        candidates.update(manifest_thumbnails(name))
+        review_source(name, src_dir)
+        keep_paths.update(thumbnail_cache_path(path) for path in list_files(src_dir))
+
+    if PRUNE_THUMBNAILS:
+        removed = prune_thumbnails(keep_paths, candidates)
+        if removed:
+            print(f"已清理 {removed} 张过期缩略图")
+    print(f"审图联系表完成，用时 {time.time() - start_time:.1f} 秒")
+
+if __name__ == "__main__":
+    main()
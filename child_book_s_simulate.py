@@ -0,0 +1,379 @@
+'''
+File: child_book_s_simulate.py
+Project: green
+Created: 2026-10-19 19:48:36
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 离散事件模拟器：用事件日志里实测的任务耗时和启动耗时（或参数化模型），
+             在不启动实例的情况下预测一本书在不同机器类型、实例数和批量下的耗时、计费时长和成本
+'''
+
+import os
+import sys
+import csv
+import json
+import heapq
+import random
+import argparse
+import statistics
+from collections import defaultdict
+
+current_dir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.dirname(current_dir))
+
+from child_book_utils import *
+from child_book_1_gen import GEN_CONFIG
+
+# 机器类型相对 medium 的GPU耗时倍数，实测轨迹缺少某种机器时用它换算
+MACHINE_SPEED = {
+    'medium': 1.0,
+    'large': 0.75,
+    'xlarge': 0.55,
+    '2xlarge': 0.4,
+    '2xlarge_plus': 0.4,
+}
+
+# 参数化模型（medium 上的秒数）：任务耗时 = 固定开销 + 每张图耗时 x 批量
+PARAMETRIC_MODEL = {
+    'watercolor': (20, 25),
+    'flat': (15, 20),
+    'upscale': (UPSCALE_SECONDS_PER_IMAGE, 0),
+}
+
+# 没有实测启动记录时的实例启动耗时（秒）
+DEFAULT_BOOT_SECONDS = 300
+
+# 扫描模式的候选配置
+SWEEP_INSTANCES = [1, 2, 3, 4]
+SWEEP_BATCH_SIZES = [1, 2, 4]
+
+class LatencyModel:
+    """任务耗时和启动耗时的来源：优先从事件日志的实测记录中抽样，没有记录时用参数化模型
+
+    - 同一机器类型、同一批量的实测记录直接抽样
+    - 批量不同时按参数化模型的批量比例换算，机器类型不同时按 MACHINE_SPEED 换算
+    """
+
+    def __init__(self, trace_path=None, seed=0):
+        self.rng = random.Random(seed)
+        # {(任务类型, 机器类型): [(批量, 秒数)]}，{机器类型: [启动秒数]}
+        self.jobs = defaultdict(list)
+        self.boots = defaultdict(list)
+        if trace_path:
+            self._load_trace(trace_path)
+
+    def _load_trace(self, trace_path):
+        if not os.path.exists(trace_path):
+            print(f"未找到事件日志 {trace_path}，使用参数化模型")
+            return
+        url_machine = {}
+        job_events = []
+        with open(trace_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 3 or row[1] not in ('instance_boot', 'job_complete'):
+                    continue
+                try:
+                    details = json.loads(row[2])
+                except ValueError:
+                    continue
+                if row[1] == 'instance_boot':
+                    url_machine[details.get('url')] = details.get('server_type', 'medium')
+                    self.boots[details.get('server_type', 'medium')].append(details['seconds'])
+                else:
+                    job_events.append(details)
+        # 任务所在实例的机器类型来自启动记录，复用的旧实例按 medium 计
+        for details in job_events:
+            machine = url_machine.get(details.get('url'), 'medium')
+            self.jobs[(details['kind'], machine)].append((details.get('batch_size', 1), details['seconds']))
+        print(f"从事件日志读取 {len(job_events)} 条任务耗时、{sum(len(v) for v in self.boots.values())} 条启动耗时")
+
+    def describe(self):
+        """各类任务的实测样本数"""
+        return {f"{kind}@{machine}": len(samples) for (kind, machine), samples in self.jobs.items()}
+
+    @staticmethod
+    def parametric(kind, batch_size):
+        base, per_image = PARAMETRIC_MODEL[kind]
+        return base + per_image * batch_size
+
+    def job_seconds(self, kind, batch_size, machine):
+        """抽样一个任务的耗时（秒）"""
+        candidates = self.jobs.get((kind, machine))
+        if not candidates:
+            candidates = [(b, s * MACHINE_SPEED[machine] / MACHINE_SPEED[m])
+                          for (k, m), samples in self.jobs.items() if k == kind for b, s in samples]
+        if not candidates:
+            return self.parametric(kind, batch_size) * MACHINE_SPEED[machine]
+        same_batch = [s for b, s in candidates if b == batch_size]
+        if same_batch:
+            return self.rng.choice(same_batch)
+        sample_batch, seconds = self.rng.choice(candidates)
+        return seconds * self.parametric(kind, batch_size) / self.parametric(kind, sample_batch)
+
+    def boot_seconds(self, machine):
+        """抽样一次实例启动耗时（秒）"""
+        samples = self.boots.get(machine) or [s for samples in self.boots.values() for s in samples]
+        return self.rng.choice(samples) if samples else DEFAULT_BOOT_SECONDS
+
+def load_workload(csv_path=None, upscale_dir=None, scenes=None):
+    """读取要模拟的工作量
+
+    返回:
+        dict: {'styles': [每个场景的风格], 'upscales': 只放大不生成的图片数}
+    """
+    if scenes:
+        return {'styles': ['watercolor' if i % 2 == 0 else 'flat' for i in range(scenes)], 'upscales': 0}
+    if upscale_dir:
+        plan = plan_upscale(upscale_dir, UPSCALE_OUTPUT_DIR, load_picks())
+        return {'styles': [], 'upscales': len(plan['todo'])}
+    records = read_sheet(csv_path, required_columns=['file name', 'style'])
+    styles = [record['style'] for record in records if record['style'] in GEN_CONFIG]
+    return {'styles': styles, 'upscales': 0}
+
+def simulate(workload, model, machine='medium', instances=1, batch_sizes=None, upscale_per_scene=1, billing_type=RUNCOMFY_BILLING_TYPE):
+    """模拟一次运行
+
+    所有实例同时启动，就绪后从共享队列取任务；生成任务完成后产生该场景的放大任务，
+    放大任务优先于尚未开始的生成任务（场景尽早完成，与流水线一致）。
+    全部任务完成后所有实例停机。与 BillingMeter 一致，每台实例从创建开始计费，
+    抽样的启动耗时也计入计费时长。
+
+    参数:
+        workload (dict): load_workload 的结果
+        model (LatencyModel): 耗时来源
+        machine (str): 机器类型
+        instances (int): 实例数
+        batch_sizes (dict): {风格: 每个场景的候选数}，默认 GEN_CONFIG
+        upscale_per_scene (int): 每个场景放大几张候选，None 表示全部放大
+
+    返回:
+        dict: wall_minutes, billed_minutes, boot_minutes, cost, busy_minutes, utilization, jobs
+    """
+    batch_sizes = batch_sizes or {style: config['batch_size'] for style, config in GEN_CONFIG.items()}
+    # 就绪队列：(优先级, 就绪时间, 序号, 任务类型, 批量)，放大优先级 0，生成 1
+    ready = []
+    sequence = 0
+    for style in workload['styles']:
+        ready.append((1, 0.0, sequence, style, batch_sizes[style]))
+        sequence += 1
+    for _ in range(workload['upscales']):
+        ready.append((0, 0.0, sequence, 'upscale', 1))
+        sequence += 1
+    heapq.heapify(ready)
+
+    # 事件队列：(时间, 序号, 事件, 实例编号, 任务)
+    events = []
+    boot_seconds = 0.0
+    for index in range(instances):
+        boot = model.boot_seconds(machine)
+        boot_seconds += boot
+        heapq.heappush(events, (boot, sequence, 'ready', index, None))
+        sequence += 1
+
+    idle = []
+    now = 0.0
+    busy_seconds = 0.0
+    job_count = 0
+    while events:
+        now, _, event, index, job = heapq.heappop(events)
+        if event == 'done':
+            job_count += 1
+            kind, batch_size = job
+            if kind != 'upscale':
+                upscales = batch_size if upscale_per_scene is None else min(upscale_per_scene, batch_size)
+                for _ in range(upscales):
+                    heapq.heappush(ready, (0, now, sequence, 'upscale', 1))
+                    sequence += 1
+        idle.append(index)
+        # 空闲实例依次领取任务
+        while idle and ready:
+            _, _, _, kind, batch_size = heapq.heappop(ready)
+            seconds = model.job_seconds(kind, batch_size, machine)
+            busy_seconds += seconds
+            heapq.heappush(events, (now + seconds, sequence, 'done', idle.pop(), (kind, batch_size)))
+            sequence += 1
+
+    wall_minutes = now / 60
+    # 所有实例在时间 0 创建、在最后一个任务完成时停机
+    billed_minutes = wall_minutes * instances
+    price = RUNCOMFY_MACHINE_PRICES[billing_type][machine]
+    return {
+        'wall_minutes': wall_minutes,
+        'billed_minutes': billed_minutes,
+        'boot_minutes': boot_seconds / 60,
+        'cost': billed_minutes * price / 60,
+        'busy_minutes': busy_seconds / 60,
+        'utilization': busy_seconds / (now * instances) if now else 0,
+        'jobs': job_count,
+    }
+
+def simulate_runs(workload, model, runs, **config):
+    """重复模拟 runs 次，返回耗时均值和 P90、计费时长和成本均值"""
+    results = [simulate(workload, model, **config) for _ in range(runs)]
+    walls = sorted(r['wall_minutes'] for r in results)
+    return {
+        'wall_minutes': statistics.mean(walls),
+        'wall_p90': walls[min(len(walls) - 1, int(len(walls) * 0.9))],
+        'billed_minutes': statistics.mean(r['billed_minutes'] for r in results),
+        'cost': statistics.mean(r['cost'] for r in results),
+        'utilization': statistics.mean(r['utilization'] for r in results),
+        'jobs': results[0]['jobs'],
+    }
+
+def pareto_front(rows):
+    """耗时和成本都不被其他配置同时超过的配置"""
+    front = []
+    for row in rows:
+        dominated = any(
+            other['wall_minutes'] <= row['wall_minutes'] and other['cost'] <= row['cost']
+            and (other['wall_minutes'] < row['wall_minutes'] or other['cost'] < row['cost'])
+            for other in rows
+        )
+        if not dominated:
+            front.append(row)
+    return front
+
+def warmup_payoff(trace_path):
+    """从事件日志比较新实例上每类任务的第一个任务：预热过和没预热的耗时，按机器类型汇总
+
+    节省 = 没预热的第一个任务 - (预热过的第一个任务 + 该模板的预热耗时)，为正说明预热划算。
+    白做的预热：预热后该实例上没有这类任务，或者第一个任务之前模型已被释放（job_complete 的 warmed 为 false）。
+
+    返回:
+        list: [{'machine', 'kind', 'cold_first', 'warmed_first', 'warmup', 'steady', 'saving', 'warmups', 'wasted'}]，
+              秒数为均值，没有样本时为None
+    """
+    if not os.path.exists(trace_path):
+        print(f"未找到事件日志 {trace_path}")
+        return []
+    url_machine = {}
+    job_events = []
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) < 3 or row[1] not in ('instance_boot', 'job_complete'):
+                continue
+            try:
+                details = json.loads(row[2])
+            except ValueError:
+                continue
+            if row[1] == 'instance_boot':
+                url_machine[details.get('url')] = details.get('server_type', 'medium')
+            else:
+                job_events.append(details)
+
+    # {(机器类型, 任务类型): {'cold_first'/'warmed_first'/'steady': [秒数]}}，{(机器类型, 模板): [预热秒数]}
+    samples = defaultdict(lambda: defaultdict(list))
+    warmups = defaultdict(list)
+    # 每个实例上每类任务的第一个任务是否预热过 {(实例URL, 模板): warmed}
+    first_warmed = {(details.get('url'), details['kind'].split('-')[0]): bool(details.get('warmed'))
+                    for details in job_events if details.get('first_on_instance')}
+    wasted = defaultdict(int)
+    for details in job_events:
+        machine = details.get('server_type') or url_machine.get(details.get('url'), 'medium')
+        kind = details['kind']
+        if kind.startswith('warmup-'):
+            template = kind[len('warmup-'):]
+            warmups[(machine, template)].append(details['seconds'])
+            if not first_warmed.get((details.get('url'), template)):
+                wasted[(machine, template)] += 1
+        elif not details.get('first_on_instance'):
+            samples[(machine, kind)]['steady'].append(details['seconds'])
+        elif details.get('cold'):
+            samples[(machine, kind)]['warmed_first' if details.get('warmed') else 'cold_first'].append(details['seconds'])
+
+    mean = lambda values: statistics.mean(values) if values else None
+    rows = []
+    for (machine, kind), groups in sorted(samples.items()):
+        if not groups['cold_first'] and not groups['warmed_first']:
+            continue
+        template = kind.split('-')[0]
+        row = {'machine': machine, 'kind': kind, 'warmup': mean(warmups[(machine, template)]),
+               'warmups': len(warmups[(machine, template)]), 'wasted': wasted[(machine, template)],
+               **{key: mean(groups[key]) for key in ('cold_first', 'warmed_first', 'steady')}}
+        row['saving'] = (row['cold_first'] - row['warmed_first'] - row['warmup']
+                         if None not in (row['cold_first'], row['warmed_first'], row['warmup']) else None)
+        rows.append(row)
+    # 预热过但实例上从没执行过这类任务，预热全部白做
+    covered = {(row['machine'], row['kind'].split('-')[0]) for row in rows}
+    for (machine, template), seconds in sorted(warmups.items()):
+        if (machine, template) not in covered:
+            rows.append({'machine': machine, 'kind': template, 'warmup': mean(seconds), 'warmups': len(seconds),
+                         'wasted': wasted[(machine, template)], 'cold_first': None, 'warmed_first': None,
+                         'steady': None, 'saving': None})
+    return rows
+
+def print_rows(rows, front=()):
+    print(f"\n{'机器':<14}{'实例':>4}{'批量':>5}{'任务':>6}{'耗时(分)':>10}{'P90(分)':>10}{'计费(分)':>10}{'成本($)':>9}{'利用率':>8}")
+    for row in rows:
+        mark = ' *' if row in front else ''
+        print(f"{row['machine']:<14}{row['instances']:>4}{row['batch']:>5}{row['jobs']:>6}{row['wall_minutes']:>10.1f}{row['wall_p90']:>10.1f}"
+              f"{row['billed_minutes']:>10.1f}{row['cost']:>9.2f}{row['utilization']:>8.0%}{mark}")
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟一本书的生成/放大耗时和成本')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--csv', default=GEN_EXPORT_CSV_PATH, help='要回放的 Gen 表（默认 AI插画_图片表_Gen.csv）')
+    source.add_argument('--upscale-dir', help='只模拟放大：回放该目录中待放大的图片（遵循挑选文件）')
+    source.add_argument('--scenes', type=int, help='虚拟的场景数（水彩和扁平交替）')
+    parser.add_argument('--machine', default='medium', choices=list(MACHINE_SPEED), help='机器类型')
+    parser.add_argument('--instances', type=int, default=1, help='实例数')
+    parser.add_argument('--batch', type=int, help='每个场景的候选数（默认按 GEN_CONFIG）')
+    parser.add_argument('--upscale-per-scene', default='1', help="每个场景放大几张候选，'all' 表示全部")
+    parser.add_argument('--billing', default=RUNCOMFY_BILLING_TYPE, choices=list(RUNCOMFY_MACHINE_PRICES), help='计费方式')
+    parser.add_argument('--trace', default=EVENT_LOG_PATH, help='提供实测耗时的事件日志')
+    parser.add_argument('--parametric', action='store_true', help='忽略事件日志，只用参数化模型')
+    parser.add_argument('--runs', type=int, default=20, help='每个配置重复模拟的次数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--sweep', action='store_true', help='扫描机器类型、实例数和批量，输出 Pareto 前沿')
+    parser.add_argument('--warmup', action='store_true', help='只比较新实例上预热与不预热时第一个任务的耗时')
+    args = parser.parse_args()
+
+    if args.warmup:
+        fmt = lambda value: f"{value:.1f}" if value is not None else '-'
+        print(f"\n{'机器':<14}{'任务':<18}{'未预热首个':>10}{'预热后首个':>10}{'预热':>8}{'稳定':>8}{'节省(秒)':>10}{'白做/预热':>10}")
+        for row in warmup_payoff(args.trace):
+            print(f"{row['machine']:<14}{row['kind']:<18}{fmt(row['cold_first']):>10}{fmt(row['warmed_first']):>10}"
+                  f"{fmt(row['warmup']):>8}{fmt(row['steady']):>8}{fmt(row['saving']):>10}{row['wasted']:>6}/{row['warmups']}")
+        return 0
+
+    model = LatencyModel(None if args.parametric else args.trace, seed=args.seed)
+    if model.jobs:
+        print(f"实测样本: {model.describe()}")
+    try:
+        workload = load_workload(args.csv, args.upscale_dir, args.scenes)
+    except SheetError as e:
+        print(f"错误：{e}")
+        return 1
+    print(f"工作量: {len(workload['styles'])} 个场景，{workload['upscales']} 张只放大的图片")
+    upscale_per_scene = None if args.upscale_per_scene == 'all' else int(args.upscale_per_scene)
+
+    if args.sweep:
+        configs = [(machine, instances, batch)
+                   for machine in MACHINE_SPEED
+                   for instances in SWEEP_INSTANCES
+                   for batch in ([args.batch] if args.batch else SWEEP_BATCH_SIZES)]
+    else:
+        configs = [(args.machine, args.instances, args.batch)]
+
+    rows = []
+    for machine, instances, batch in configs:
+        batch_sizes = {style: batch for style in GEN_CONFIG} if batch else None
+        result = simulate_runs(workload, model, args.runs, machine=machine, instances=instances,
+                               batch_sizes=batch_sizes, upscale_per_scene=upscale_per_scene, billing_type=args.billing)
+        result.update(machine=machine, instances=instances, batch=batch or '-')
+        rows.append(result)
+
+    rows.sort(key=lambda row: (row['cost'], row['wall_minutes']))
+    front = pareto_front(rows) if args.sweep else ()
+    print_rows(rows, front)
+    if args.sweep:
+        print(f"\n* 为 Pareto 前沿（共 {len(front)} 个配置）：没有其他配置同时更快且更便宜")
+        print_rows(sorted(front, key=lambda row: row['wall_minutes']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,20 +9,27 @@ Description:
 
 import os
 import sys
-import requests
-import urllib3
+import math
 import time
 import json
 import shutil
 import csv
+import hashlib
+import tempfile
 from datetime import datetime
-from PIL import Image
 from runcomfy_utils import *
 
+# PIL 延迟导入，只复制文件的命令不需要加载它
+Image = lazy_import('PIL.Image')
+
 # 全局常量定义
 # 选择计费方式：'hobby' 或 'pro'
 RUNCOMFY_BILLING_TYPE = 'hobby'
 
+# 实例生命周期：空闲多少秒自动停机，脚本结束后保温多少秒（0 表示结束即停机）
+INSTANCE_IDLE_TIMEOUT = 600
+INSTANCE_KEEP_WARM = 900
+
 # 目录常量定义
 HOME = os.path.expanduser('~')
 PATH_DOWNLOADS = os.path.join(HOME, 'Downloads')
@@ -35,9 +42,45 @@ GEN_EXPORT_CSV_PATH = os.path.join(BASE_PATH, "AI插画_图片表_Gen.csv")
 GEN_OUTPUT_RETRY_DIR = os.path.join(BASE_PATH, 'child-book-retry')
 GEN_OUTPUT_DEFAULT_DIR = os.path.join(BASE_PATH, 'child-book-gen')
 
+# 两遍生成：草稿用少步数（可选低分辨率）逐个种子出图，挑中的草稿再用同一种子按完整质量定稿
+# 草稿清单记录每张草稿的种子、提示词和耗时，在 pick 列填 1 表示挑中
+GEN_DRAFT_DIR = os.path.join(BASE_PATH, 'child-book-draft')
+GEN_DRAFT_CSV_PATH = os.path.join(BASE_PATH, "AI插画_草稿.csv")
+DRAFT_STEPS = 8
+# 草稿分辨率 (宽, 高)，None 表示与定稿相同。初始噪声与分辨率有关，降低分辨率后定稿构图会和草稿不同
+DRAFT_RESOLUTION = None
+DRAFT_HEADER = ['file name', 'scene', 'style', 'seed', 'steps', 'width', 'height', 'seconds', 'prompt', 'pick']
+
 # 图像放大相关目录
 UPSCALE_SRC_DIR = os.path.join(BASE_PATH, "child-book-gen")
 UPSCALE_OUTPUT_DIR = os.path.join(BASE_PATH, 'child-book-upscaled')
+UPSCALE_PREPROCESS_DIR = os.path.join(BASE_PATH, 'temp-upscale')
+
+# 放大挑选：挑选文件每行一个候选图名（如 1-w-158-妈妈阻止男孩摘花_3），
+# 或在 Gen 表的挑选列里填候选序号（如 3、1,3）；两者都没有时放大全部候选
+UPSCALE_PICKS_PATH = os.path.join(BASE_PATH, "AI插画_挑选.txt")
+UPSCALE_PICK_COLUMN = 'pick'
+# 没有实测数据时，估算节省成本所用的单张放大GPU耗时（秒）
+UPSCALE_SECONDS_PER_IMAGE = 120
+
+# 输出策略：各工作流真正的输出节点（SaveImage），其他节点的预览图和 temp 输出不下载
+GEN_OUTPUT_NODES = ['31']
+UPSCALE_OUTPUT_NODES = ['265']
+# 传输格式：'png' 按原样下载；'webp' 在实例上保存无损 WebP，下载后本地解码回 PNG（像素一致，下载量约减半）
+GEN_TRANSFER_FORMAT = 'png'
+UPSCALE_TRANSFER_FORMAT = 'webp'
+
+# 预热：实例就绪后先为本次要用的每个模板提交一个1步、极小潜空间的任务，把 Flux UNET、T5/CLIP 和 LoRA
+# 提前加载进显存，第一个正式任务不再承担模型加载时间。'new' 只预热本次新建的实例，'always' 复用的实例也预热，'never' 不预热
+WARMUP_MODE = 'new'
+WARMUP_TEMPLATES = {
+    'watercolor': 'runcomfy_watercolor_api.json',
+    'flat': 'runcomfy_flat_api.json',
+    'upscale': 'runcomfy_upscale_api.json',
+}
+WARMUP_STEPS = 1
+WARMUP_SIZE = 64  # 生成预热任务的宽高，也是放大预热输入图的边长
+WARMUP_UPSCALE_MEGAPIXELS = 0.25  # 放大预热任务的目标像素数（百万），模板默认 8
 
 # 局部修复相关目录
 GEN_INPAINT_CSV_PATH = os.path.join(BASE_PATH, "AI插画_图片表_Inpaint.csv")
@@ -66,7 +109,271 @@ PPI_TEMP_DIR = os.path.join(BASE_PATH, 'temp')
 ORGANIZE_PROJECT_SRC = os.path.join(BASE_PATH, 'src')
 ORGANIZE_PROJECT_OUTPUT = os.path.join(BASE_PATH, 'final')
 
-def scale_image(src_path, dst_path, max_size, min_width, mode=1):
+# 多本书工作区：每本书一个子目录，内部结构与 BASE_PATH 相同（表格、child-book-gen、child-book-upscaled ...）
+WORKSPACES_PATH = os.path.join(BASE_PATH, 'projects')
+
+# 缩略图缓存目录（按 路径+修改时间+文件大小 命名，源图变化后自动失效）
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_PATH, '.thumbnails')
+THUMBNAIL_SIZE = 384
+
+# 常见图片扩展名
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.tiff', '.tif')
+
+# 工作流模板缓存 {路径: (修改时间, JSON文本)}
+_workflow_cache = {}
+
+def load_workflow_template(file_name):
+    """读取项目目录下的工作流模板，返回可以随意修改的新字典
+
+    文本按修改时间缓存，同一进程（例如守护进程）里重复调用不再读盘，模板被修改后自动重新读取。
+    """
+    workflow_path = os.path.join(os.path.dirname(__file__), file_name)
+    mtime = os.path.getmtime(workflow_path)
+    cached = _workflow_cache.get(workflow_path)
+    if not cached or cached[0] != mtime:
+        with open(workflow_path, 'r', encoding='utf-8') as f:
+            cached = (mtime, f.read())
+        _workflow_cache[workflow_path] = cached
+    return json.loads(cached[1])
+
+# 目录文件索引缓存 {目录: ({子目录: 修改时间}, [文件路径])}
+_file_index_cache = {}
+
+def list_files(base_dir, extensions=IMAGE_EXTENSIONS):
+    """递归列出目录下指定扩展名的文件（按 os.walk 顺序）
+
+    结果按目录缓存，并记录每个子目录的修改时间；下次调用只 stat 这些目录，
+    有文件增删（目录修改时间变化）时才重新遍历。
+    """
+    cached = _file_index_cache.get(base_dir)
+    if cached:
+        try:
+            if all(os.stat(path).st_mtime_ns == mtime for path, mtime in cached[0].items()):
+                return [path for path in cached[1] if path.lower().endswith(extensions)]
+        except FileNotFoundError:
+            pass
+
+    dir_mtimes = {}
+    files = []
+    for root, dirs, names in os.walk(base_dir):
+        dir_mtimes[root] = os.stat(root).st_mtime_ns
+        files.extend(os.path.join(root, name) for name in names)
+    if dir_mtimes:
+        _file_index_cache[base_dir] = (dir_mtimes, files)
+    return [path for path in files if path.lower().endswith(extensions)]
+
+def find_file_by_prefix(base_dir, filename_prefix, extensions=('.png', '.jpg', '.jpeg', '.webp')):
+    """在目录及其子目录中查找第一个文件名以指定前缀开头的图片（不区分大小写），没有则返回None"""
+    prefix = filename_prefix.lower()
+    for path in list_files(base_dir, extensions):
+        if os.path.basename(path).lower().startswith(prefix):
+            return path
+    return None
+
+def get_workspace(project=None):
+    """项目工作区的路径集合
+
+    project 为 None 时返回默认工作区（BASE_PATH 下原有的表格和目录），
+    否则返回 WORKSPACES_PATH/<project> 下结构相同的路径，多本书可以同时在处理中。
+
+    返回:
+        dict: project, base, gen_csv, retry_csv, gen_dir, retry_dir, draft_csv, draft_dir,
+              picks, upscale_dir, ppi_dir, final_dir
+    """
+    base = BASE_PATH if project is None else os.path.join(WORKSPACES_PATH, project)
+    return {
+        'project': project or 'default',
+        'base': base,
+        'gen_csv': os.path.join(base, "AI插画_图片表_Gen.csv"),
+        'retry_csv': os.path.join(base, "AI插画_图片表_Retry.csv"),
+        'gen_dir': os.path.join(base, 'child-book-gen'),
+        'retry_dir': os.path.join(base, 'child-book-retry'),
+        'draft_csv': os.path.join(base, "AI插画_草稿.csv"),
+        'draft_dir': os.path.join(base, 'child-book-draft'),
+        'picks': os.path.join(base, "AI插画_挑选.txt"),
+        'upscale_dir': os.path.join(base, 'child-book-upscaled'),
+        'ppi_dir': os.path.join(base, 'child-book-ppi'),
+        'final_dir': os.path.join(base, 'final'),
+    }
+
+def list_workspaces():
+    """WORKSPACES_PATH 下的项目名（有 Gen 表的子目录），按名称排序"""
+    if not os.path.exists(WORKSPACES_PATH):
+        return []
+    return sorted(
+        name for name in os.listdir(WORKSPACES_PATH)
+        if os.path.exists(get_workspace(name)['gen_csv'])
+    )
+
+class SheetError(ValueError):
+    """表格无法读取、为空或缺少必需的列"""
+
+def read_sheet(csv_path, required_columns, int_columns=(), key_columns=('file name',)):
+    """流式读取飞书导出的表格（Gen/Retry/Inpaint/Fix/Ps），逐行产出记录
+
+    打开文件时立即检查表头，缺列直接抛出 SheetError，之后每解析一行就产出一条，
+    调用方可以在整张表读完之前开始处理第一行。
+
+    - 统一按 utf-8-sig 读取，去掉飞书导出的 BOM；表头和单元格去掉首尾空白
+    - 全空的行直接跳过；必需列为空的行跳过并提示
+    - int_columns 中的列转为 int，无法转换的行跳过并提示
+    - key_columns 组合重复的行跳过并提示（第一次出现的那行已经产出）
+
+    参数:
+        csv_path (str): 表格路径
+        required_columns (list): 必需的列
+        int_columns (list): 需要转为整数的列
+        key_columns (tuple): 用于判断重复的列，为空则不检查
+
+    返回:
+        generator: 产出 {列名: 值, '_row': 行号} 字典
+
+    异常:
+        SheetError: 文件不存在、为空或缺少必需的列
+    """
+    try:
+        csvfile = open(csv_path, 'r', encoding='utf-8-sig', newline='')
+    except FileNotFoundError:
+        raise SheetError(f"未找到表格 {csv_path}")
+
+    reader = csv.reader(csvfile)
+    header = next(reader, None)
+    if not header:
+        csvfile.close()
+        raise SheetError(f"表格 {csv_path} 为空")
+    header = [column.strip() for column in header]
+    missing = [column for column in required_columns if column not in header]
+    if missing:
+        csvfile.close()
+        raise SheetError(f"表格 {os.path.basename(csv_path)} 缺少必需的列 {missing}")
+
+    def records():
+        seen = {}
+        with csvfile:
+            for values in reader:
+                # line_num 是文件中的行号，单元格内有换行时也准确
+                row_number = reader.line_num
+                if not any(value.strip() for value in values):
+                    continue
+                record = {column: (values[i].strip() if i < len(values) else '') for i, column in enumerate(header)}
+
+                empty = [column for column in required_columns if not record[column]]
+                if empty:
+                    print(f"跳过第 {row_number} 行: {empty} 为空")
+                    continue
+                try:
+                    for column in int_columns:
+                        record[column] = int(float(record[column]))
+                except ValueError:
+                    print(f"跳过第 {row_number} 行: {column} 不是整数 ({record[column]})")
+                    continue
+
+                if key_columns:
+                    key = tuple(record[column] for column in key_columns)
+                    if key in seen:
+                        print(f"跳过第 {row_number} 行: {key_columns} 与第 {seen[key]} 行重复 {key}")
+                        continue
+                    seen[key] = row_number
+
+                record['_row'] = row_number
+                yield record
+
+    return records()
+
+def available_memory():
+    """估算当前可用物理内存（字节），无法获取时返回None"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        pass
+    # macOS 没有 SC_AVPHYS_PAGES，按物理内存的一半估算
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# 图片处理进程除图片本身以外的常驻内存（解释器、Pillow），估算进程池大小时加上
+PROCESS_BASE_MB = 64
+
+def decoded_image_mb(path, scale=1.0):
+    """只读文件头，估算 Pillow 解码后整张图占用的内存（MB），多通道图每像素4字节
+
+    :param str path: 图片路径
+    :param float scale: 像素数倍数（估算缩放结果时传入面积比例）
+    """
+    with Image.open(path) as image:
+        pixel_bytes = 4 if len(image.getbands()) > 1 else 1
+        return image.width * image.height * scale * pixel_bytes / (1024 * 1024)
+
+def memory_bounded_workers(job_memory_mb, max_workers=None):
+    """按单个任务的内存峰值估计和可用内存决定进程池大小，不超过 CPU 核数
+
+    :param float job_memory_mb: 单个任务处理图片的内存峰值估计（MB），不含 PROCESS_BASE_MB
+    :param int max_workers: 进程数上限
+    """
+    workers = max_workers or os.cpu_count() or 1
+    memory = available_memory()
+    if memory:
+        workers = min(workers, int(memory // ((job_memory_mb + PROCESS_BASE_MB) * 1024 * 1024)))
+    return max(1, workers)
+
+# 进程池的启动方式：守护进程里命令在线程中运行，放大等脚本也有心跳线程，fork 多线程进程可能把
+# 其它线程持有的锁复制到子进程里导致死锁；forkserver 从一个单线程的服务进程派生工作进程。
+# 平台不支持时（Windows）使用默认方式
+PROCESS_START_METHOD = 'forkserver'
+
+def process_pool(max_workers=None):
+    """创建图片处理用的进程池（PROCESS_START_METHOD 启动），用法同 ProcessPoolExecutor"""
+    # 进程池只在需要时导入，复制文件类的命令不加载 multiprocessing
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = PROCESS_START_METHOD if PROCESS_START_METHOD in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+def resize_in_strips(image, size, strip_mb=None):
+    """缩放图片，最后的 Bicubic 按水平条带进行
+
+    strip_mb 为 None 时等同于 image.resize(size)。指定时：
+    - JPEG 源图用 draft 按缩小比例解码
+    - 缩小2倍以上先用 reduce 做整数倍块平均，随即释放原图（8MP 缩到 1772 不到2倍，不会触发）
+    - Bicubic 按水平条带进行（resize 的 box 参数），每条带的中间缓冲不超过 strip_mb，
+      结果与整张缩放一致，只是不再需要"整张源图高度 x 目标宽度"的中间图
+
+    这只省掉中间缓冲，不是整个缩放的内存上限：源图和目标图仍完整放在内存里，
+    峰值约为 decoded_image_mb(源图) + decoded_image_mb(目标图) + strip_mb。
+
+    :param Image image: 未加载或已加载的图片，按条带缩放时会被关闭
+    :param tuple size: 目标尺寸 (宽, 高)
+    :param int strip_mb: 每个条带中间缓冲的大小（MB），None 表示整张缩放
+    :return: 缩放后的图片
+    """
+    if not strip_mb:
+        return image.resize(size)
+
+    resample = Image.NEAREST if image.mode in ('1', 'P') else Image.BICUBIC
+    image.draft(None, size)
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor >= 2:
+        reduced = image.reduce(factor)
+        image.close()
+        image = reduced
+
+    # Pillow 内部多通道图每像素4字节
+    pixel_bytes = 4 if len(image.getbands()) > 1 else 1
+    scale_y = image.height / size[1]
+    # 每行输出需要 scale_y 行水平缩放后的缓冲，再加一行输出
+    row_bytes = size[0] * pixel_bytes * (scale_y + 1)
+    strip_rows = max(16, int(strip_mb * 1024 * 1024 / row_bytes))
+
+    result = Image.new(image.mode, size)
+    for top in range(0, size[1], strip_rows):
+        bottom = min(top + strip_rows, size[1])
+        strip = image.resize((size[0], bottom - top), resample, box=(0, top * scale_y, image.width, bottom * scale_y))
+        result.paste(strip, (0, top))
+    image.close()
+    return result
+
+def scale_image(src_path, dst_path, max_size, min_width, mode=1, strip_mb=None):
     """等比缩放图片，根据模式选择缩放长边或短边
 
     :param str src_path: 源图片路径
@@ -74,6 +381,7 @@ def scale_image(src_path, dst_path, max_size, min_width, mode=1):
     :param int max_size: 最大尺寸值
     :param int min_width: 长图的最小宽度（仅对纵向图片生效）
     :param int mode: 模式（1-长边缩放到最大值 2-短边缩放到最大值）
+    :param int strip_mb: 按条带缩放时每个条带的缓冲大小（MB），None 表示整张缩放（见 resize_in_strips）
     """
     image = Image.open(src_path)
     width, height = image.size
@@ -97,7 +405,7 @@ def scale_image(src_path, dst_path, max_size, min_width, mode=1):
                 new_height = int(min_width / width * height)
                 
             # 缩放图片
-            image = image.resize((new_width, new_height))
+            image = resize_in_strips(image, (new_width, new_height), strip_mb)
     
     elif mode == 2:
         # 模式2：短边缩放到最大值
@@ -118,11 +426,24 @@ def scale_image(src_path, dst_path, max_size, min_width, mode=1):
             new_height = int(min_width / width * height)
             
         # 缩放图片
-        image = image.resize((new_width, new_height))
+        image = resize_in_strips(image, (new_width, new_height), strip_mb)
 
     # 输出文件
     image.save(dst_path)
 
+def set_image_ppi(src_path, dst_path, target_ppi=450):
+    """设置图片的PPI（像素尺寸不变），透明背景转为不透明
+
+    :param str src_path: 源图片路径
+    :param str dst_path: 目标图片路径
+    :param int target_ppi: 目标PPI
+    """
+    with Image.open(src_path) as image:
+        # 印刷交付不需要Alpha通道
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGB')
+        image.save(dst_path, dpi=(target_ppi, target_ppi))
+
 def calculate_tile_coordinates(src_path: str, tile_width: int, tile_height: int, x_tile_count: int, y_tile_count: int, x_tile_num: int, y_tile_num: int) -> tuple[int, int]:
     """
     计算在给定网格布局下，特定瓦片的左上角坐标。
@@ -202,6 +523,28 @@ def calculate_tile_coordinates(src_path: str, tile_width: int, tile_height: int,
 
     return x_coordinate, y_coordinate
 
+def crop_image_by_size(src_path: str, dst_path: str, crop_width: int, crop_height: int, x_coordinate: int, y_coordinate: int):
+    """
+    从源图片的指定坐标裁剪出固定尺寸的区域并保存。
+
+    :param str src_path: 源图片路径。
+    :param str dst_path: 保存裁剪结果的路径。
+    :param int crop_width: 裁剪宽度。
+    :param int crop_height: 裁剪高度。
+    :param int x_coordinate: 裁剪区域左上角的 x 坐标。
+    :param int y_coordinate: 裁剪区域左上角的 y 坐标。
+    :raises FileNotFoundError: 如果源图片未找到。
+    :raises IOError: 如果打开或处理图片时出错。
+    """
+    try:
+        with Image.open(src_path) as image:
+            region = image.crop((x_coordinate, y_coordinate, x_coordinate + crop_width, y_coordinate + crop_height))
+            region.save(dst_path)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(f"源图片未找到: {src_path}") from e
+    except Exception as e:
+        raise IOError(f"裁剪图片 '{src_path}' 时出错: {e}") from e
+
 def paste_image(src_path1: str, src_path2: str, dst_path: str, x_coordinate: int, y_coordinate: int):
     """
     将一张图片 (src1) 粘贴到另一张图片 (src2) 的指定坐标上。
@@ -285,7 +628,136 @@ def paste_image(src_path1: str, src_path2: str, dst_path: str, x_coordinate: int
     except Exception as e:
         raise IOError(f"处理图片 '{src_path1}' 或 '{src_path2}' 时出错: {e}") from e
 
-def runcomfy_watercolor(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, output_name=None, max_retries=3):
+# 放大工作流中在本地完成的节点：263 裁剪缩小、133/134 模型放大、34 缩放到目标像素
+UPSCALE_LOCAL_NODES = ('263', '133', '134', '34')
+
+def upscale_target_megapixels():
+    """放大工作流节点 34 ImageScaleToTotalPixels 的目标百万像素数"""
+    return load_workflow_template("runcomfy_upscale_api.json")["34"]["inputs"]["megapixels"]
+
+def denoise_only_workflow(workflow):
+    """把放大工作流改成只做分块重绘：删除 UPSCALE_LOCAL_NODES，原来接节点 34 的输入直接接 LoadImage(264)"""
+    for node_id in UPSCALE_LOCAL_NODES:
+        workflow.pop(node_id, None)
+    for node in workflow.values():
+        for key, value in node['inputs'].items():
+            if isinstance(value, list) and value and value[0] == '34':
+                node['inputs'][key] = ['264', 0]
+    return workflow
+
+def preprocess_upscale_input(src_path, dst_dir=UPSCALE_PREPROCESS_DIR, max_side=1024, megapixels=8, file_format='webp'):
+    """在本地完成放大工作流中重绘之前的步骤，生成可以直接分块重绘的上传图片
+
+    对应 runcomfy_upscale_api.json 的节点 263 ImageResize+（长宽限制在 max_side 以内，只缩小，
+    保持比例，尺寸取偶数，nearest-exact）和节点 34 ImageScaleToTotalPixels（lanczos 缩放到
+    megapixels 百万像素）。节点 133/134 的 nmkdSiaxCX 模型放大需要 GPU，本地用 lanczos 直接放大代替，
+    之后 0.15 的重绘负责补回细节。runcomfy_upscale 上传预处理图片时使用 denoise_only_workflow，
+    GPU 只执行分块重绘。上传的图片约为原图的 8 倍像素，用无损 WebP 压缩。
+    该函数运行在独立进程中，只使用可序列化的参数。
+
+    :param str src_path: 原始小图路径
+    :param str dst_dir: 预处理结果保存目录
+    :param int max_side: 长宽上限（节点263）
+    :param float megapixels: 目标百万像素数（节点34，见 upscale_target_megapixels）
+    :param str file_format: 输出格式，'webp' 或 'png'
+    :return: 预处理后的图片路径
+    :rtype: str
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(src_path))[0]
+    dst_path = os.path.join(dst_dir, f"{base_name}.{file_format}")
+
+    with Image.open(src_path) as image:
+        # LoadImage 节点只使用RGB通道
+        image = image.convert('RGB')
+        width, height = image.size
+
+        # 节点263：downscale if bigger + keep proportion + multiple_of 2
+        if width > max_side or height > max_side:
+            ratio = min(max_side / width, max_side / height)
+            width = max(2, round(width * ratio) // 2 * 2)
+            height = max(2, round(height * ratio) // 2 * 2)
+            image = image.resize((width, height), Image.NEAREST)
+
+        # 节点34：与 ComfyUI 相同，按 megapixels·1024² 计算缩放比例，宽高四舍五入
+        scale = math.sqrt(int(megapixels * 1024 * 1024) / (width * height))
+        image = image.resize((round(width * scale), round(height * scale)), Image.LANCZOS)
+
+        if file_format == 'webp':
+            image.save(dst_path, 'WEBP', lossless=True, quality=50, method=4)
+        else:
+            image.save(dst_path, 'PNG', compress_level=4)
+
+    return dst_path
+
+def thumbnail_cache_path(src_path, size=THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR):
+    """返回源图对应的缓存缩略图路径
+
+    缓存键由绝对路径、修改时间（纳秒）、文件大小和缩略图尺寸组成，
+    源图被覆盖或重新生成后键随之变化，旧缩略图不会再被使用。
+    """
+    stat = os.stat(src_path)
+    key = hashlib.sha1(f"{os.path.abspath(src_path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}".encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.jpg")
+
+def make_thumbnail(src_path, dst_path, size=THUMBNAIL_SIZE):
+    """生成长边不超过 size 的 JPEG 缩略图
+
+    JPEG 源图用 draft 让解码器直接按 1/2、1/4、1/8 缩小解码；
+    PNG 等格式用 reduce 做整数倍块平均，最后只对小图做一次 Lanczos。
+    先写临时文件再改名，进程池里多个进程同时写缓存也不会读到半张图。
+    该函数运行在独立进程中，只使用可序列化的参数。
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with Image.open(src_path) as image:
+        image.draft('RGB', (size, size))
+        factor = min(image.width // size, image.height // size)
+        if factor > 1:
+            image = image.reduce(factor)
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+        temp_path = f"{dst_path}.{os.getpid()}.tmp"
+        image.save(temp_path, 'JPEG', quality=85)
+    os.replace(temp_path, dst_path)
+    return dst_path
+
+def ensure_thumbnails(src_paths, size=THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR, workers=None):
+    """为一批图片准备缩略图，只生成缓存中缺少的部分
+
+    参数:
+        src_paths (list): 源图路径
+        size (int): 缩略图长边
+        cache_dir (str): 缓存目录
+        workers (int): 进程数，默认 CPU 核数
+
+    返回:
+        tuple: ({源图路径: 缩略图路径}, 新生成的数量)，生成失败的图片不在结果中
+    """
+    thumbnails = {}
+    missing = {}
+    for src_path in src_paths:
+        dst_path = thumbnail_cache_path(src_path, size, cache_dir)
+        if os.path.exists(dst_path):
+            thumbnails[src_path] = dst_path
+        else:
+            missing[src_path] = dst_path
+    if not missing:
+        return thumbnails, 0
+
+    from concurrent.futures import as_completed
+    built = 0
+    with process_pool(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(make_thumbnail, src_path, dst_path, size): src_path for src_path, dst_path in missing.items()}
+        for future in as_completed(futures):
+            src_path = futures[future]
+            try:
+                thumbnails[src_path] = future.result()
+                built += 1
+            except Exception as e:
+                print(f"生成缩略图失败 {os.path.basename(src_path)}: {e}")
+    return thumbnails, built
+
+def runcomfy_watercolor(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, output_name=None, max_retries=3, seed=None, steps=None, size=None, front=False):
     """使用RunComfy工作流生成水彩风格图片
     
     参数:
@@ -294,25 +766,38 @@ def runcomfy_watercolor(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLO
     - batch_size: 一次生成的图片数量
     - save_dir: 生成图片保存的目录
     - output_name: 输出文件名前缀，如果不指定则使用时间戳
-    - max_retries: 最大重试次数
+    - max_retries: 最大尝试次数（传给 runcomfy_workflow 的重试策略）
+    - seed: 指定种子（草稿定稿时复用草稿的种子），不指定则随机生成
+    - steps: KSampler 步数，不指定则使用模板的步数；少于模板步数时按草稿任务记录
+    - size: (宽, 高) 覆盖模板分辨率，不指定则使用模板分辨率
+    - front: 插到 ComfyUI 队列最前面（加急的返工任务）
     
     返回:
     - 生成的图片文件路径列表
     """
     # 加载工作流JSON
-    workflow_path = os.path.join(os.path.dirname(__file__), "runcomfy_watercolor_api.json")
-    with open(workflow_path, 'r', encoding='utf-8') as f:
-        workflow = json.load(f)
+    workflow = load_workflow_template("runcomfy_watercolor_api.json")
     
-    # 生成随机种子
-    new_seed = generate_seed()
-    print(f"使用随机种子: {new_seed}")
+    # 生成随机种子（定稿时使用草稿记录的种子）
+    new_seed = seed if seed is not None else generate_seed()
+    print(f"使用种子: {new_seed}")
     
     # 更新工作流中的种子和batch_size
     workflow["202"]["inputs"]["seed"] = new_seed
     workflow["101"]["inputs"]["batch_size"] = batch_size  # 同时更新EmptyLatentSizePicker的batch_size
     workflow["140"]["inputs"]["batch_size"] = batch_size  # 同时更新EmptySD3LatentImage的batch_size
     
+    # 草稿设置：减少步数、降低分辨率（宽高覆盖 SDXLEmptyLatentSizePicker 的预设分辨率）
+    kind = 'watercolor'
+    if steps is not None:
+        if steps < workflow["202"]["inputs"]["steps"]:
+            kind = 'watercolor-draft'
+        workflow["202"]["inputs"]["steps"] = steps
+    if size is not None:
+        workflow["101"]["inputs"]["width_override"], workflow["101"]["inputs"]["height_override"] = size
+    if GEN_TRANSFER_FORMAT == 'webp':
+        webp_outputs(workflow, GEN_OUTPUT_NODES)
+    
     # 配置输入
     inputs = {
         "177": {  # 177是工作流JSON中CLIPTextEncode节点的ID
@@ -325,67 +810,51 @@ def runcomfy_watercolor(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLO
     print(f"批量大小: {batch_size}")
     print(f"使用实例: {instance_url}")
     
-    # 外层重试逻辑
-    for attempt in range(max_retries):
-        try:
-            # 确保输出目录存在
-            os.makedirs(save_dir, exist_ok=True)
-            # 如果没有指定output_name，则使用时间戳
-            if output_name is None:
-                output_name = f"watercolor_{int(time.time())}"
-            
-            print(f"将结果保存到: {save_dir}")
-            print(f"输出文件名前缀: {output_name}")
-            
-            # 执行工作流
-            result = runcomfy_workflow(
-                workflow_json=workflow,
-                inputs=inputs,
-                instance_url=instance_url,
-                verify_ssl=True,
-                max_retries=2  # 指定内部重试次数
-            )
-            
-            if not result or 'outputs' not in result:
-                print("警告: 工作流执行成功但没有返回输出数据")
-                if attempt < max_retries - 1:
-                    print(f"将在 5 秒后重试 (尝试 {attempt+2}/{max_retries})...")
-                    time.sleep(5)
-                    continue
-                return None
-                
-            # 下载输出文件
-            saved_files = runcomfy_download_outputs(
-                outputs=result['outputs'],
-                instance_url=instance_url,
-                save_dir=save_dir,
-                output_name=output_name,
-                verify_ssl=True
-            )
-            
-            print(f"生成成功，生成了 {len(saved_files)} 个文件")
-            return saved_files  # 返回所有生成的文件路径
-            
-        except Exception as e:
-            print(f"尝试 {attempt+1}/{max_retries} 失败: {str(e)}")
-            
-            # 记录详细错误信息
-            if attempt == max_retries - 1:  # 最后一次尝试
-                print("详细错误信息:")
-                import traceback
-                traceback.print_exc()
-            
-            # 如果不是最后一次尝试，则等待后重试
-            if attempt < max_retries - 1:
-                # 使用指数退避
-                wait_time = 5 * (2 ** attempt)  # 5, 10, 20...
-                print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
+    # 确保输出目录存在
+    os.makedirs(save_dir, exist_ok=True)
+    # 如果没有指定output_name，则使用时间戳
+    if output_name is None:
+        output_name = f"watercolor_{int(time.time())}"
+    
+    print(f"将结果保存到: {save_dir}")
+    print(f"输出文件名前缀: {output_name}")
+    
+    # 从另一种工作流切换过来时先释放实例显存和模型缓存
+    housekeeper = get_housekeeper(instance_url)
+    housekeeper.before_job('watercolor')
     
-    # 如果所有尝试都失败
-    raise Exception(f"在 {max_retries} 次尝试后生成图片失败")
+    # 重试由 runcomfy_workflow 的重试策略统一负责，按失败类别决定是否重试
+    job_start = time.time()
+    result = runcomfy_workflow(
+        workflow_json=workflow,
+        inputs=inputs,
+        instance_url=instance_url,
+        verify_ssl=True,
+        max_retries=max_retries,
+        front=front
+    )
+    
+    # 下载输出文件（只下载声明的输出节点），记录传输字节数和耗时
+    transfer = {}
+    saved_files = runcomfy_download_outputs(
+        outputs=result['outputs'],
+        instance_url=instance_url,
+        save_dir=save_dir,
+        output_name=output_name,
+        verify_ssl=True,
+        output_nodes=GEN_OUTPUT_NODES,
+        stats=transfer
+    )
+    
+    # 任务耗时（提交到下载完成）写入事件日志，并按实例计费表分摊费用
+    record_job(kind, instance_url, job_start, images=len(saved_files), name=output_name, batch_size=batch_size,
+               queue_seconds=result.get('queue_seconds'), transfer=transfer)
+    # 结果已取回，删除实例上的 history
+    housekeeper.after_job(result.get('prompt_id'), transfer)
+    print(f"生成成功，生成了 {len(saved_files)} 个文件")
+    return saved_files  # 返回所有生成的文件路径
 
-def runcomfy_flat(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, output_name=None, max_retries=3):
+def runcomfy_flat(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, output_name=None, max_retries=3, seed=None, steps=None, size=None, front=False):
     """使用RunComfy工作流生成扁平风格图片
     
     参数:
@@ -394,25 +863,38 @@ def runcomfy_flat(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, o
     - batch_size: 一次生成的图片数量
     - save_dir: 生成图片保存的目录
     - output_name: 输出文件名前缀，如果不指定则使用时间戳
-    - max_retries: 最大重试次数
+    - max_retries: 最大尝试次数（传给 runcomfy_workflow 的重试策略）
+    - seed: 指定种子（草稿定稿时复用草稿的种子），不指定则随机生成
+    - steps: KSampler 步数，不指定则使用模板的步数；少于模板步数时按草稿任务记录
+    - size: (宽, 高) 覆盖模板分辨率，不指定则使用模板分辨率
+    - front: 插到 ComfyUI 队列最前面（加急的返工任务）
     
     返回:
     - 生成的图片文件路径列表
     """
     # 加载工作流JSON
-    workflow_path = os.path.join(os.path.dirname(__file__), "runcomfy_flat_api.json")
-    with open(workflow_path, 'r', encoding='utf-8') as f:
-        workflow = json.load(f)
+    workflow = load_workflow_template("runcomfy_flat_api.json")
     
-    # 生成随机种子
-    new_seed = generate_seed()
-    print(f"使用随机种子: {new_seed}")
+    # 生成随机种子（定稿时使用草稿记录的种子）
+    new_seed = seed if seed is not None else generate_seed()
+    print(f"使用种子: {new_seed}")
     
     # 更新工作流中的种子和batch_size
     workflow["202"]["inputs"]["seed"] = new_seed
     workflow["101"]["inputs"]["batch_size"] = batch_size  # 同时更新EmptyLatentSizePicker的batch_size
     workflow["140"]["inputs"]["batch_size"] = batch_size  # 同时更新EmptySD3LatentImage的batch_size
     
+    # 草稿设置：减少步数、降低分辨率（宽高覆盖 SDXLEmptyLatentSizePicker 的预设分辨率）
+    kind = 'flat'
+    if steps is not None:
+        if steps < workflow["202"]["inputs"]["steps"]:
+            kind = 'flat-draft'
+        workflow["202"]["inputs"]["steps"] = steps
+    if size is not None:
+        workflow["101"]["inputs"]["width_override"], workflow["101"]["inputs"]["height_override"] = size
+    if GEN_TRANSFER_FORMAT == 'webp':
+        webp_outputs(workflow, GEN_OUTPUT_NODES)
+    
     # 配置输入
     inputs = {
         "177": {  # 177是工作流JSON中CLIPTextEncode节点的ID
@@ -425,82 +907,69 @@ def runcomfy_flat(prompt, instance_url, batch_size=1, save_dir=PATH_DOWNLOADS, o
     print(f"批量大小: {batch_size}")
     print(f"使用实例: {instance_url}")
     
-    # 外层重试逻辑
-    for attempt in range(max_retries):
-        try:
-            # 确保输出目录存在
-            os.makedirs(save_dir, exist_ok=True)
-            # 如果没有指定output_name，则使用时间戳
-            if output_name is None:
-                output_name = f"flat_{int(time.time())}"
-            
-            print(f"将结果保存到: {save_dir}")
-            print(f"输出文件名前缀: {output_name}")
-            
-            # 执行工作流
-            result = runcomfy_workflow(
-                workflow_json=workflow,
-                inputs=inputs,
-                instance_url=instance_url,
-                verify_ssl=True,
-                max_retries=2  # 指定内部重试次数
-            )
-            
-            if not result or 'outputs' not in result:
-                print("警告: 工作流执行成功但没有返回输出数据")
-                if attempt < max_retries - 1:
-                    print(f"将在 5 秒后重试 (尝试 {attempt+2}/{max_retries})...")
-                    time.sleep(5)
-                    continue
-                return None
-                
-            # 下载输出文件
-            saved_files = runcomfy_download_outputs(
-                outputs=result['outputs'],
-                instance_url=instance_url,
-                save_dir=save_dir,
-                output_name=output_name,
-                verify_ssl=True
-            )
-            
-            print(f"生成成功，生成了 {len(saved_files)} 个文件")
-            return saved_files  # 返回所有生成的文件路径
-            
-        except Exception as e:
-            print(f"尝试 {attempt+1}/{max_retries} 失败: {str(e)}")
-            
-            # 记录详细错误信息
-            if attempt == max_retries - 1:  # 最后一次尝试
-                print("详细错误信息:")
-                import traceback
-                traceback.print_exc()
-            
-            # 如果不是最后一次尝试，则等待后重试
-            if attempt < max_retries - 1:
-                # 使用指数退避
-                wait_time = 5 * (2 ** attempt)  # 5, 10, 20...
-                print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
+    # 确保输出目录存在
+    os.makedirs(save_dir, exist_ok=True)
+    # 如果没有指定output_name，则使用时间戳
+    if output_name is None:
+        output_name = f"flat_{int(time.time())}"
+    
+    print(f"将结果保存到: {save_dir}")
+    print(f"输出文件名前缀: {output_name}")
+    
+    # 从另一种工作流切换过来时先释放实例显存和模型缓存
+    housekeeper = get_housekeeper(instance_url)
+    housekeeper.before_job('flat')
+    
+    # 重试由 runcomfy_workflow 的重试策略统一负责，按失败类别决定是否重试
+    job_start = time.time()
+    result = runcomfy_workflow(
+        workflow_json=workflow,
+        inputs=inputs,
+        instance_url=instance_url,
+        verify_ssl=True,
+        max_retries=max_retries,
+        front=front
+    )
     
-    # 如果所有尝试都失败
-    raise Exception(f"在 {max_retries} 次尝试后生成图片失败")
+    # 下载输出文件（只下载声明的输出节点），记录传输字节数和耗时
+    transfer = {}
+    saved_files = runcomfy_download_outputs(
+        outputs=result['outputs'],
+        instance_url=instance_url,
+        save_dir=save_dir,
+        output_name=output_name,
+        verify_ssl=True,
+        output_nodes=GEN_OUTPUT_NODES,
+        stats=transfer
+    )
+    
+    # 任务耗时（提交到下载完成）写入事件日志，并按实例计费表分摊费用
+    record_job(kind, instance_url, job_start, images=len(saved_files), name=output_name, batch_size=batch_size,
+               queue_seconds=result.get('queue_seconds'), transfer=transfer)
+    # 结果已取回，删除实例上的 history
+    housekeeper.after_job(result.get('prompt_id'), transfer)
+    print(f"生成成功，生成了 {len(saved_files)} 个文件")
+    return saved_files  # 返回所有生成的文件路径
 
-def runcomfy_upscale(image_path, instance_url, save_dir=PATH_DOWNLOADS, max_retries=3):
+def runcomfy_upscale(image_path, instance_url, save_dir=PATH_DOWNLOADS, max_retries=3, preprocessed_path=None, front=False):
     """使用RunComfy工作流放大图像
     
     参数:
     - image_path: 需要放大的图像文件路径
     - instance_url: ComfyUI实例URL
     - save_dir: 放大后图像保存的目录
-    - max_retries: 最大重试次数
+    - max_retries: 最大尝试次数（传给 runcomfy_workflow 的重试策略）
+    - preprocessed_path: preprocess_upscale_input 生成的预处理图片，指定时上传该文件，GPU 只做分块重绘（denoise_only_workflow）
+    - front: 插到 ComfyUI 队列最前面（加急的返工任务）
     
     返回:
     - 放大后的图像文件路径
     """
     # 加载工作流JSON
-    workflow_path = os.path.join(os.path.dirname(__file__), "runcomfy_upscale_api.json")
-    with open(workflow_path, 'r') as f:
-        workflow = json.load(f)
+    workflow = load_workflow_template("runcomfy_upscale_api.json")
+    if preprocessed_path:
+        # 缩小、放大和缩放到目标像素已在本地完成
+        denoise_only_workflow(workflow)
     
     # 生成随机种子
     new_seed = generate_seed()
@@ -508,76 +977,337 @@ def runcomfy_upscale(image_path, instance_url, save_dir=PATH_DOWNLOADS, max_retr
     
     # 更新工作流中的种子
     workflow["259"]["inputs"]["seed"] = new_seed
+    if UPSCALE_TRANSFER_FORMAT == 'webp':
+        webp_outputs(workflow, UPSCALE_OUTPUT_NODES)
     
     # 配置输入
     inputs = {
         "264": {  # 264是工作流JSON中LoadImage节点的ID
             "type": "image",
-            "path": image_path
+            "path": preprocessed_path or image_path
         }
     }
     
     print("开始放大图像处理...")
     print(f"原图路径: {image_path}")
+    if preprocessed_path:
+        print(f"上传预处理图片: {preprocessed_path}")
     print(f"使用实例: {instance_url}")
     
-    # 外层重试逻辑
-    for attempt in range(max_retries):
+    # 确保输出目录存在
+    os.makedirs(save_dir, exist_ok=True)
+    output_name = os.path.basename(image_path).split('.')[0]
+    
+    print(f"将结果保存到: {save_dir}")
+    print(f"输出文件名前缀: {output_name}")
+    
+    # 从另一种工作流切换过来时先释放实例显存和模型缓存
+    housekeeper = get_housekeeper(instance_url)
+    housekeeper.before_job('upscale')
+    
+    # 重试由 runcomfy_workflow 的重试策略统一负责，按失败类别决定是否重试
+    job_start = time.time()
+    result = runcomfy_workflow(
+        workflow_json=workflow,
+        inputs=inputs,
+        instance_url=instance_url,
+        verify_ssl=True,
+        max_retries=max_retries,
+        front=front
+    )
+    
+    # 下载输出文件（只下载声明的输出节点），记录传输字节数和耗时
+    transfer = {}
+    saved_files = runcomfy_download_outputs(
+        outputs=result['outputs'],
+        instance_url=instance_url,
+        save_dir=save_dir,
+        output_name=output_name,
+        verify_ssl=True,
+        output_nodes=UPSCALE_OUTPUT_NODES,
+        stats=transfer
+    )
+    
+    # 任务耗时（提交到下载完成）和输入像素数写入事件日志，并按实例计费表分摊费用
+    record_job('upscale', instance_url, job_start, images=len(saved_files), name=output_name,
+               queue_seconds=result.get('queue_seconds'), megapixels=image_megapixels(preprocessed_path or image_path),
+               transfer=transfer)
+    # 结果已取回，删除实例上的 history
+    housekeeper.after_job(result.get('prompt_id'), transfer)
+    print(f"放大成功，生成了 {len(saved_files)} 个文件")
+    return saved_files[0]  # 只返回第一个文件路径，因为这个工作流只生成一张图片
+
+def warmup_workflow(template):
+    """生成模板的预热版本：1步、极小尺寸，SaveImage 换成 PreviewImage（存到 temp 目录，不下载）"""
+    workflow = load_workflow_template(WARMUP_TEMPLATES[template])
+    if template == 'upscale':
+        workflow["259"]["inputs"]["steps"] = WARMUP_STEPS
+        workflow["34"]["inputs"]["megapixels"] = WARMUP_UPSCALE_MEGAPIXELS
+        output_nodes = UPSCALE_OUTPUT_NODES
+    else:
+        workflow["202"]["inputs"]["steps"] = WARMUP_STEPS
+        workflow["101"]["inputs"]["width_override"] = workflow["101"]["inputs"]["height_override"] = WARMUP_SIZE
+        workflow["101"]["inputs"]["batch_size"] = workflow["140"]["inputs"]["batch_size"] = 1
+        output_nodes = GEN_OUTPUT_NODES
+    for node_id in output_nodes:
+        workflow[node_id] = {
+            "inputs": {"images": workflow[node_id]["inputs"]["images"]},
+            "class_type": "PreviewImage",
+            "_meta": {"title": "Preview Image"}
+        }
+    return workflow
+
+def warm_up_instance(instance_url, templates, created=True, machine_type=None):
+    """实例就绪后按模板提交预热任务，每个模板的耗时单独记入事件日志（job_complete 类型为 warmup-模板名）
+
+    参数:
+    - instance_url: ComfyUI实例URL
+    - templates: 本次运行要用的模板（watercolor/flat/upscale），按使用顺序
+    - created: 实例是否本次新建（lifecycle.created），WARMUP_MODE 为 'new' 时复用的实例不预热
+    - machine_type: 机器类型，写入事件日志，用于按机器类型比较预热是否划算
+
+    返回:
+    - {模板: 预热秒数}，没有预热时返回None
+    """
+    templates = [template for template in dict.fromkeys(templates) if template in WARMUP_TEMPLATES]
+    if not templates or WARMUP_MODE == 'never' or (WARMUP_MODE == 'new' and not created):
+        return None
+
+    print(f"\n预热实例模型: {', '.join(templates)}")
+    warmup_start = time.time()
+    report = {}
+    # 倒序预热，第一个要用的模板最后加载
+    for template in reversed(templates):
+        inputs = {}
+        if template == 'upscale':
+            # 放大预热的输入是一张纯白小图
+            image_path = os.path.join(tempfile.gettempdir(), 'child-book-warmup.png')
+            if not os.path.exists(image_path):
+                Image.new('RGB', (WARMUP_SIZE, WARMUP_SIZE), 'white').save(image_path)
+            inputs = {"264": {"type": "image", "path": image_path}}
+        job_start = time.time()
         try:
-            # 确保输出目录存在
-            os.makedirs(save_dir, exist_ok=True)
-            output_name = os.path.basename(image_path).split('.')[0]
-            
-            print(f"将结果保存到: {save_dir}")
-            print(f"输出文件名前缀: {output_name}")
-            
-            # 执行工作流
             result = runcomfy_workflow(
-                workflow_json=workflow,
+                workflow_json=warmup_workflow(template),
                 inputs=inputs,
                 instance_url=instance_url,
                 verify_ssl=True,
-                max_retries=2  # 指定内部重试次数
-            )
-            
-            if not result or 'outputs' not in result:
-                print("警告: 工作流执行成功但没有返回输出数据")
-                if attempt < max_retries - 1:
-                    print(f"将在 5 秒后重试 (尝试 {attempt+2}/{max_retries})...")
-                    time.sleep(5)
-                    continue
-                return None
-                
-            # 下载输出文件
-            saved_files = runcomfy_download_outputs(
-                outputs=result['outputs'],
-                instance_url=instance_url,
-                save_dir=save_dir,
-                output_name=output_name,
-                verify_ssl=True
+                max_retries=1
             )
-            
-            print(f"放大成功，生成了 {len(saved_files)} 个文件")
-            return saved_files[0]  # 只返回第一个文件路径，因为这个工作流只生成一张图片
-            
         except Exception as e:
-            print(f"尝试 {attempt+1}/{max_retries} 失败: {str(e)}")
-            
-            # 记录详细错误信息
-            if attempt == max_retries - 1:  # 最后一次尝试
-                print("详细错误信息:")
-                import traceback
-                traceback.print_exc()
-            
-            # 如果不是最后一次尝试，则等待后重试
-            if attempt < max_retries - 1:
-                # 使用指数退避
-                wait_time = 5 * (2 ** attempt)  # 5, 10, 20...
-                print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
-    
-    # 如果所有尝试都失败
-    raise Exception(f"在 {max_retries} 次尝试后放大图像失败")
+            print(f"预热 {template} 失败: {e}")
+            continue
+        report[template] = time.time() - job_start
+        record_job(f'warmup-{template}', instance_url, job_start, images=0, name=f'warmup-{template}',
+                   queue_seconds=result.get('queue_seconds'))
+        get_housekeeper(instance_url).after_job(result.get('prompt_id'))
+        print(f"预热 {template} 完成，用时 {report[template]:.1f} 秒")
+
+    # 清理器不会因为切换到预热过的工作流而释放刚加载的模型
+    get_housekeeper(instance_url).warmed_up(list(report), templates[0])
+    log_event('warmup', url=instance_url, server_type=machine_type, templates=templates,
+              seconds=round(time.time() - warmup_start, 1), failed=[t for t in templates if t not in report],
+              **{f'{template}_seconds': round(seconds, 1) for template, seconds in report.items()})
+    return report
+
+def image_megapixels(image_path):
+    """图片的百万像素数（只读文件头），无法读取时返回None"""
+    try:
+        with Image.open(image_path) as image:
+            return image.width * image.height / 1e6
+    except Exception:
+        return None
+
+def image_style(name):
+    """从图片名（如 1-w-158-妈妈阻止男孩摘花_3）取第1个和第2个"-"之间的风格代码，格式不对时返回空字符串"""
+    parts = os.path.basename(name).split('-')
+    return parts[1] if len(parts) >= 3 else ''
+
+# 放大历史里输入超过这个百万像素数的记录是本地预处理上传的 8MP 图，跑的是只重绘的工作流，与完整放大分开估算
+UPSCALE_MODEL_MAX_MEGAPIXELS = 2
+
+def upscale_time_model(event_log_path=None, denoise_only=False):
+    """从事件日志的放大记录统计每种风格的平均放大耗时
+
+    生成输出都是同样的 1024 像素见方，按像素数估算没有区别；不同风格的画面细节不同，
+    分块重绘的耗时才有差别。耗时取任务总耗时减去在 ComfyUI 队列中等待的时间。
+    没有记录时所有风格都按 UPSCALE_SECONDS_PER_IMAGE 估算。denoise_only 为 True 时只统计
+    本地预处理后只重绘的记录，否则只统计完整放大的记录。
+
+    返回:
+        tuple: ({风格代码: 平均秒数}, 全部记录的平均秒数, 样本数)
+    """
+    samples = {}
+    event_log_path = event_log_path or EVENT_LOG_PATH
+    if os.path.exists(event_log_path):
+        with open(event_log_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[1] != 'job_complete' or '"upscale"' not in row[2]:
+                    continue
+                try:
+                    details = json.loads(row[2])
+                except ValueError:
+                    continue
+                if details.get('kind') != 'upscale':
+                    continue
+                if ((details.get('megapixels') or 0) > UPSCALE_MODEL_MAX_MEGAPIXELS) != denoise_only:
+                    continue
+                style = image_style(details.get('name') or '')
+                samples.setdefault(style, []).append(details['seconds'] - details.get('queue_seconds', 0))
+    count = sum(len(seconds) for seconds in samples.values())
+    if not count:
+        return {}, float(UPSCALE_SECONDS_PER_IMAGE), 0
+    styles = {style: sum(seconds) / len(seconds) for style, seconds in samples.items() if style}
+    return styles, sum(sum(seconds) for seconds in samples.values()) / count, count
+
+def batch_job_seconds(kind, batch_size, event_log_path=None):
+    """事件日志里某类任务在指定批量下的平均耗时（秒，不含在 ComfyUI 队列中等待的时间）
+
+    返回:
+        tuple: (平均秒数, 样本数)；没有记录时返回 (None, 0)
+    """
+    samples = []
+    event_log_path = event_log_path or EVENT_LOG_PATH
+    if os.path.exists(event_log_path):
+        with open(event_log_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[1] != 'job_complete':
+                    continue
+                try:
+                    details = json.loads(row[2])
+                except ValueError:
+                    continue
+                if details.get('kind') == kind and details.get('batch_size') == batch_size:
+                    samples.append(details['seconds'] - details.get('queue_seconds', 0))
+    if not samples:
+        return None, 0
+    return sum(samples) / len(samples), len(samples)
+
+def order_upscale_jobs(image_paths, model=None):
+    """按风格的历史平均放大耗时从长到短排序，最慢的图片先开始，结尾不会只剩一张慢图在跑
+
+    同一风格内、以及没有历史记录时保持 image_paths 的顺序。
+
+    返回:
+        list: [(图片路径, 预计秒数)]
+    """
+    styles, default, _ = model or upscale_time_model()
+    jobs = [(image_path, styles.get(image_style(image_path), default)) for image_path in image_paths]
+    # sorted 是稳定排序，预计耗时相同的图片保持原来的顺序
+    return sorted(jobs, key=lambda job: -job[1])
+
+def load_picks(picks_path=UPSCALE_PICKS_PATH, csv_path=GEN_EXPORT_CSV_PATH, column=UPSCALE_PICK_COLUMN):
+    """读取放大挑选结果，返回挑中的候选图名集合（不含扩展名）
+
+    挑选文件和 Gen 表的挑选列可以同时使用，结果合并；文件中空行和 # 开头的行忽略。
+    挑选列的值是候选序号时与 file name 拼成候选图名，也可以直接写完整的候选图名。
+
+    返回:
+        set: 挑中的候选图名；两种挑选输入都不存在时返回None，表示全部放大
+    """
+    picks = None
+    if os.path.exists(picks_path):
+        picks = set()
+        with open(picks_path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                name = line.strip()
+                if not name or name.startswith('#'):
+                    continue
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    name = os.path.splitext(name)[0]
+                picks.add(name)
+        print(f"从 {os.path.basename(picks_path)} 读取到 {len(picks)} 个挑选")
+
+    if os.path.exists(csv_path):
+        try:
+            sheet_picks = None
+            for record in read_sheet(csv_path, required_columns=['file name']):
+                if column not in record:
+                    break
+                sheet_picks = sheet_picks if sheet_picks is not None else set()
+                for value in record[column].replace('，', ',').replace(',', ' ').split():
+                    sheet_picks.add(f"{record['file name']}_{value}" if value.isdigit() else value)
+            if sheet_picks is not None:
+                print(f"从 {os.path.basename(csv_path)} 的 {column} 列读取到 {len(sheet_picks)} 个挑选")
+                picks = (picks or set()) | sheet_picks
+        except SheetError as e:
+            print(f"读取挑选列失败: {e}")
+    return picks
+
+def plan_upscale(src_dir, save_dir, picks=None):
+    """按挑选结果规划放大任务
+
+    参数:
+        src_dir (str): 候选小图目录（child-book-gen）
+        save_dir (str): 放大结果目录，已有同名前缀文件的图片不再放大
+        picks (set): load_picks 的结果，None 表示全部放大
+
+    返回:
+        dict: todo 待放大的路径, existing 已放大的路径, rejected 未挑中的路径,
+              missing 挑中但在 src_dir 找不到的候选图名
+    """
+    candidates = sorted(
+        os.path.join(src_dir, file) for file in os.listdir(src_dir)
+        if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
+    )
+    upscaled = os.listdir(save_dir) if os.path.exists(save_dir) else []
+    plan = {'todo': [], 'existing': [], 'rejected': [], 'missing': []}
+    stems = set()
+    for image_path in candidates:
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        stems.add(stem)
+        if picks is not None and stem not in picks:
+            plan['rejected'].append(image_path)
+        elif any(existing.startswith(stem) for existing in upscaled):
+            plan['existing'].append(image_path)
+        else:
+            plan['todo'].append(image_path)
+    if picks is not None:
+        plan['missing'] = sorted(picks - stems)
+    return plan
+
+def log_selection_savings(script_type, rejected_count, upscaled_count, upscale_seconds, price_per_hour):
+    """把挑选跳过的放大数量和节省的成本写入事件日志
+
+    单张放大耗时按本次实测平均值估算，本次没有放大时使用 UPSCALE_SECONDS_PER_IMAGE。
+    """
+    seconds_per_image = upscale_seconds / upscaled_count if upscaled_count else UPSCALE_SECONDS_PER_IMAGE
+    gpu_seconds_saved = rejected_count * seconds_per_image
+    cost_saved = gpu_seconds_saved / 3600 * price_per_hour
+    print(f"挑选跳过 {rejected_count} 张候选图，约节省GPU {gpu_seconds_saved / 60:.1f} 分钟，${cost_saved:.2f}")
+    log_event('upscale_selection', script=script_type, skipped=rejected_count, upscaled=upscaled_count,
+              seconds_per_image=round(seconds_per_image, 1),
+              gpu_seconds_saved=round(gpu_seconds_saved), cost_saved=round(cost_saved, 4))
+
+def append_draft_records(records, csv_path=GEN_DRAFT_CSV_PATH):
+    """把草稿记录追加到草稿清单，清单不存在时先写表头
+
+    参数:
+        records (list): 字典列表，键为 DRAFT_HEADER 中的列名（pick 列留空给人工填写）
+    """
+    file_exists = os.path.exists(csv_path)
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    with open(csv_path, 'a', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=DRAFT_HEADER, extrasaction='ignore')
+        if not file_exists:
+            writer.writeheader()
+        writer.writerows(records)
+
+def load_drafts(csv_path=GEN_DRAFT_CSV_PATH):
+    """读取草稿清单，按场景分组
+
+    返回:
+        dict: {场景名: [草稿记录, ...]}，记录中 seed、steps 为整数，seconds 为浮点数，
+              picked 表示 pick 列是否挑中（非空且不是 0/n/no）
+    """
+    drafts = {}
+    for record in read_sheet(csv_path, required_columns=['file name', 'scene', 'style', 'seed', 'prompt'],
+                             int_columns=['seed']):
+        record['steps'] = int(record.get('steps') or 0)
+        record['seconds'] = float(record.get('seconds') or 0)
+        record['picked'] = record.get('pick', '').strip().lower() not in ('', '0', 'n', 'no')
+        drafts.setdefault(record['scene'], []).append(record)
+    return drafts
 
 def organize_images_by_style():
     """将放大后的图片按风格分类到不同文件夹
@@ -634,24 +1364,24 @@ def organize_images_by_style():
     
     print(f"整理完成，成功移动 {moved_count} 个文件到对应的风格目录")
 
-def organize_images_by_project():
+def organize_images_by_project(src_dir=None, output_dir=None):
     """将 src 目录下的图片按项目分类到 TIFF 目录下的子目录中
     
-    源目录: ORGANIZE_PROJECT_SRC
-    目标目录: ORGANIZE_PROJECT_OUTPUT
+    源目录: src_dir，默认为 ORGANIZE_PROJECT_SRC
+    目标目录: output_dir，默认为 ORGANIZE_PROJECT_OUTPUT
     
     文件名格式示例：1-w-1-女孩桌上画幻想.xxx
     第1个"-"前的数字作为项目目录名
     处理所有子目录中的图片，并在处理完成后删除风格子目录
     """
     # 源目录
-    src_dir = ORGANIZE_PROJECT_SRC
+    src_dir = src_dir or ORGANIZE_PROJECT_SRC
     if not os.path.exists(src_dir):
         print(f"错误：源目录不存在: {src_dir}")
         return
     
     # 目标根目录
-    tiff_root_dir = ORGANIZE_PROJECT_OUTPUT
+    tiff_root_dir = output_dir or ORGANIZE_PROJECT_OUTPUT
     os.makedirs(tiff_root_dir, exist_ok=True)
     
     # 获取所有图片文件（包括子目录）
@@ -715,7 +1445,14 @@ def organize_images_by_project():
     
     print(f"整理完成，成功移动 {moved_count} 个文件到对应的类别目录，并删除风格子目录")
 
-def log_script_execution(script_type, image_count, start_time, end_time, billable_minutes, billing_type, machine_type, machine_price_per_hour, estimated_cost):
+# 运行日志的表头（图片数量、单张成本、空闲计费由计费表结算得出，GPU节省来自两遍生成，旧日志文件会自动补齐表头）
+RUN_LOG_HEADER = [
+    '日志记录时间', '脚本类型', '场景数量', '开始运行时间', '结束运行时间',
+    '计费时长(分钟)', '计费方式', '机器类型', '单价($/小时)', '使用成本($)',
+    '图片数量', '单张成本($)', '空闲计费(分钟)', 'GPU节省(秒)'
+]
+
+def log_script_execution(script_type, image_count, start_time, end_time, billable_minutes, billing_type, machine_type, machine_price_per_hour, estimated_cost, billing=None, gpu_seconds_saved=None):
     """记录脚本执行日志
     
     参数:
@@ -728,6 +1465,8 @@ def log_script_execution(script_type, image_count, start_time, end_time, billabl
     - machine_type: 机器类型
     - machine_price_per_hour: 每小时机器价格
     - estimated_cost: 预估使用成本
+    - billing: BillingMeter.settle() 的结算结果，提供图片数量、单张成本和空闲计费时长
+    - gpu_seconds_saved: 两遍生成相比全部按完整质量出图节省的GPU秒数
     """
     # 日志文件路径
     log_dir = os.path.join(LOCAL_PATH, 'log')
@@ -750,6 +1489,24 @@ def log_script_execution(script_type, image_count, start_time, end_time, billabl
         f"{machine_price_per_hour:.2f}",         # 单价
         f"{estimated_cost:.2f}"                  # 使用成本
     ]
+    if billing:
+        log_data += [
+            billing['images'],                                                              # 图片数量
+            f"{billing['cost_per_image']:.4f}" if billing['cost_per_image'] else '',       # 单张成本
+            f"{billing['idle_seconds'] / 60:.2f}"                                          # 空闲计费时长
+        ]
+    if gpu_seconds_saved is not None:
+        log_data += [''] * (len(RUN_LOG_HEADER) - 1 - len(log_data))
+        log_data.append(f"{gpu_seconds_saved:.0f}")                                        # GPU节省
+    
+    # 旧日志文件的表头缺少新增的列时补齐（只改第一行）
+    if os.path.exists(log_file_path):
+        with open(log_file_path, 'r', newline='', encoding='utf-8') as csvfile:
+            lines = csvfile.readlines()
+        if lines and next(csv.reader(lines[:1])) != RUN_LOG_HEADER:
+            lines[0] = ','.join(RUN_LOG_HEADER) + lines[0][len(lines[0].rstrip('\r\n')):]
+            with open(log_file_path, 'w', newline='', encoding='utf-8') as csvfile:
+                csvfile.writelines(lines)
     
     # 检查文件是否存在，不存在则创建并写入表头
     file_exists = os.path.exists(log_file_path)
@@ -759,11 +1516,7 @@ def log_script_execution(script_type, image_count, start_time, end_time, billabl
         
         # 如果文件不存在，写入表头
         if not file_exists:
-            header = [
-                '日志记录时间', '脚本类型', '场景数量', '开始运行时间', '结束运行时间', 
-                '计费时长(分钟)', '计费方式', '机器类型', '单价($/小时)', '使用成本($)'
-            ]
-            csvwriter.writerow(header)
+            csvwriter.writerow(RUN_LOG_HEADER)
         
         # 写入日志数据
         csvwriter.writerow(log_data)
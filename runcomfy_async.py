@@ -0,0 +1,340 @@
+'''
+File: runcomfy_async.py
+Project: utils
+Created: 2026-10-19 14:32:10
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: RunComfy 的 asyncio 客户端，一个事件循环里同时管理大量提交、轮询和下载
+'''
+
+import os
+import json
+import time
+import asyncio
+import urllib.parse
+
+from runcomfy_utils import (
+    RunComfyService,
+    RunComfyError,
+    RetryPolicy,
+    DEFAULT_RETRY_POLICY,
+    ERROR_EXECUTION,
+    ERROR_TIMEOUT,
+    ERROR_VALIDATION,
+    http_session,
+    auth_headers,
+    mark_activity,
+    make_client_id,
+    apply_workflow_inputs,
+    runcomfy_cancel_prompt,
+    get_circuit_breaker,
+    classify_error,
+    output_file_path,
+    decode_webp_frames,
+    _execution_error_message,
+    _execution_start_time,
+)
+
+async def retry_async(policy, func, instance_url, description='', probe=True):
+    """RetryPolicy.call 的异步版本：await func(attempt)，退避用 asyncio.sleep，不占用线程
+
+    熔断和失败分类与同步版本共用 RetryPolicy.check_breaker / after_failure；
+    实例探测是阻塞请求，放到线程里执行。
+    """
+    breaker = get_circuit_breaker(instance_url)
+    retries_by_kind = {}
+    attempt = 0
+    while True:
+        attempt += 1
+        policy.check_breaker(breaker, instance_url, description, attempt)
+        try:
+            result = await func(attempt)
+            breaker.record_success()
+            return result
+        except Exception as e:
+            kind = await asyncio.to_thread(classify_error, e, instance_url, probe)
+            delay = policy.after_failure(e, kind, breaker, attempt, retries_by_kind, instance_url, description)
+            if delay:
+                await asyncio.sleep(delay)
+
+class AsyncRunComfyClient:
+    """RunComfy 异步客户端
+
+    HTTP 请求仍由共享的 requests 会话（http_session）发出，通过 asyncio.to_thread 在线程里执行；
+    轮询间隔和重试退避都是 asyncio.sleep，等待中的任务不占用线程，一个事件循环可以同时跟踪大量任务。
+    runcomfy_utils 中的 runcomfy_workflow、runcomfy_upload_image、runcomfy_download_outputs
+    都是本类的同步包装，两边只有这一份实现。
+
+    用法:
+        client = AsyncRunComfyClient(instance_url)
+        result = await client.run_workflow(workflow, inputs)
+        files = await client.download_outputs(result['outputs'], save_dir, output_name)
+    """
+
+    def __init__(self, instance_url=None, verify_ssl=False, service=None):
+        """
+        参数:
+            instance_url (str): ComfyUI实例URL，可在 create_instance/get_or_create_instance 后自动设置
+            verify_ssl (bool): SSL验证
+            service (RunComfyService): 实例管理使用的服务对象，默认使用 .runcomfy_instance
+        """
+        self.instance_url = instance_url
+        self.verify_ssl = verify_ssl
+        self.service = service or RunComfyService()
+
+    async def _request(self, method, url, **kwargs):
+        """在线程里发出一个 HTTP 请求，返回 requests 的响应对象"""
+        kwargs.setdefault('headers', auth_headers())
+        kwargs.setdefault('verify', self.verify_ssl)
+        return await asyncio.to_thread(getattr(http_session(), method), url, **kwargs)
+
+    # ---------- 实例管理：复用 RunComfyService 的实现 ----------
+
+    def _use_instance(self, info):
+        if info and info.get('url'):
+            self.instance_url = info['url']
+        return info
+
+    async def get_instance_info(self):
+        """获取第一个 Ready 状态的实例，没有则返回None"""
+        return self._use_instance(await asyncio.to_thread(self.service.get_instance_info))
+
+    async def create_instance(self, server_type="medium", estimated_duration=3600):
+        """创建实例并等待就绪，返回实例信息字典"""
+        return self._use_instance(await asyncio.to_thread(self.service.create_instance, server_type, estimated_duration))
+
+    async def get_or_create_instance(self, **kwargs):
+        """获取现有实例或创建新实例，参数同 RunComfyService.get_or_create_instance"""
+        return self._use_instance(await asyncio.to_thread(self.service.get_or_create_instance, **kwargs))
+
+    async def stop_instance(self, server_id=None):
+        """停止实例，返回是否成功"""
+        ok = await asyncio.to_thread(self.service.stop_instance, server_id)
+        if ok and not server_id:
+            self.instance_url = None
+        return ok
+
+    # ---------- 工作流 ----------
+
+    async def upload_image(self, image_path, upload_name=None):
+        """上传图片到实例（覆盖同名文件），返回实例上的文件名"""
+        upload_name = upload_name or os.path.basename(image_path)
+        url = f"{self.instance_url}/upload/image"
+
+        def post():
+            with open(image_path, 'rb') as image_file:
+                files = [('image', (upload_name, image_file, 'application/octet-stream'))]
+                return http_session().post(url, headers=auth_headers(), data={'overwrite': 'true'},
+                                           files=files, verify=self.verify_ssl, timeout=60)
+
+        print(f"上传图片: {os.path.basename(image_path)} -> {upload_name}")
+        response = await asyncio.to_thread(post)
+        response.raise_for_status()
+        mark_activity(self.instance_url)
+        return upload_name
+
+    async def submit(self, workflow, client_id=None, front=False):
+        """提交工作流，返回 prompt_id
+
+        参数:
+            front (bool): 插到 ComfyUI 队列最前面（加急任务），不影响正在执行的任务
+        """
+        payload = {"prompt": workflow, "client_id": client_id or make_client_id()}
+        if front:
+            payload["front"] = True
+        response = await self._request('post', f"{self.instance_url}/prompt", json=payload, timeout=30)
+        if response.status_code == 400:
+            # 节点ID错误、缺少模型等，ComfyUI 在 node_errors 里说明原因
+            raise RunComfyError(f"工作流校验失败: {response.text[:500]}", kind=ERROR_VALIDATION)
+        response.raise_for_status()
+        mark_activity(self.instance_url)
+        return response.json()['prompt_id']
+
+    async def cancel(self, prompt_id, reason=''):
+        """取消任务：等待中的从队列删除，运行中的中断，返回结果同 runcomfy_cancel_prompt"""
+        return await asyncio.to_thread(runcomfy_cancel_prompt, self.instance_url, prompt_id, self.verify_ssl, reason)
+
+    async def wait(self, prompt_id, timeout=600, poll_interval=3):
+        """轮询 /history 直到工作流产生输出，返回该任务的 history 记录；执行出错或超时抛出 RunComfyError"""
+        history_url = f"{self.instance_url}/history/{prompt_id}"
+        start_time = time.time()
+        poll_failures = 0
+
+        while time.time() - start_time < timeout:
+            try:
+                response = await self._request('get', history_url, timeout=15)
+                response.raise_for_status()
+                history_data = response.json()
+                poll_failures = 0
+            except Exception as e:
+                # 连续轮询失败交给重试策略判断是网络抖动还是实例已停止
+                poll_failures += 1
+                print(f"检查工作流状态失败 ({poll_failures}/3): {e}")
+                if poll_failures >= 3:
+                    raise
+                await asyncio.sleep(5)
+                continue
+
+            mark_activity(self.instance_url)
+            entry = history_data.get(prompt_id)
+            if entry:
+                if entry.get('outputs'):
+                    print(f"工作流执行完成，用时 {time.time() - start_time:.1f} 秒")
+                    return entry
+                status = entry.get('status') or {}
+                if status.get('status_str') == 'error' or status.get('completed'):
+                    raise RunComfyError(_execution_error_message(entry), kind=ERROR_EXECUTION, prompt_id=prompt_id)
+
+            print("工作流正在执行中...")
+            await asyncio.sleep(poll_interval)
+
+        raise RunComfyError(f"工作流执行超时 ({timeout}秒)", kind=ERROR_TIMEOUT, prompt_id=prompt_id)
+
+    async def run_workflow(self, workflow_json, inputs, max_retries=None, retry_policy=None, timeout=600, front=False):
+        """上传输入、提交并等待完成，失败时按重试策略决定是否重试
+
+        参数:
+            workflow_json (dict/str): 工作流JSON对象或文件路径
+            inputs (dict): 输入配置，格式同 apply_workflow_inputs
+            max_retries (int): 最大尝试次数，未指定 retry_policy 时使用
+            retry_policy (RetryPolicy): 重试策略，默认 DEFAULT_RETRY_POLICY
+            timeout (int): 单次执行的超时时间(秒)
+            front (bool): 插到 ComfyUI 队列最前面
+
+        返回:
+            dict: outputs 生成文件信息；prompt_id 任务ID；queue_seconds 在 ComfyUI 队列中等待的秒数（history 有 execution_start 时）
+        """
+        policy = retry_policy or (RetryPolicy(max_attempts=max_retries) if max_retries else DEFAULT_RETRY_POLICY)
+
+        if isinstance(workflow_json, str):
+            with open(workflow_json, 'r', encoding='utf-8') as f:
+                workflow = json.load(f)
+        else:
+            workflow = workflow_json
+
+        uploads = apply_workflow_inputs(workflow, inputs) if inputs else []
+        client_id = make_client_id()
+
+        async def attempt_once(attempt):
+            print(f"执行工作流 (第 {attempt}/{policy.max_attempts} 次尝试)...")
+            # 本次尝试提交的任务，失败或重试前必须取消，否则旧任务会继续占用GPU
+            prompt_id = None
+            try:
+                await asyncio.gather(*(self.upload_image(image_path, upload_name)
+                                       for _, image_path, upload_name in uploads))
+
+                print("正在提交工作流...")
+                submitted_at = time.time()
+                prompt_id = await self.submit(workflow, client_id, front=front)
+                print(f"工作流提交成功，prompt_id={prompt_id}")
+
+                print("等待工作流执行完成...")
+                try:
+                    entry = await self.wait(prompt_id, timeout=timeout)
+                except RunComfyError as e:
+                    if e.kind == ERROR_EXECUTION:
+                        # 已结束的任务不需要取消
+                        prompt_id = None
+                    raise
+                result = {'outputs': entry['outputs'], 'prompt_id': prompt_id}
+                # 服务器时钟与本机可能有偏差，排队时间不小于0
+                execution_start = _execution_start_time(entry)
+                if execution_start:
+                    result['queue_seconds'] = max(0.0, execution_start - submitted_at)
+                return result
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                # asyncio.run 收到 Ctrl+C 时以 CancelledError 取消任务
+                if prompt_id:
+                    await asyncio.shield(self.cancel(prompt_id, reason='用户中断'))
+                raise
+            except Exception as e:
+                print(f"执行失败: {e}")
+                if prompt_id:
+                    await self.cancel(prompt_id, reason=str(e))
+                raise
+
+        return await retry_async(policy, attempt_once, self.instance_url, description='执行工作流')
+
+    async def download_outputs(self, outputs, save_dir, output_name, retry_policy=None, output_nodes=None, stats=None):
+        """并发下载工作流的输出文件，参数和返回值同 runcomfy_utils.runcomfy_download_outputs"""
+        policy = retry_policy or DEFAULT_RETRY_POLICY
+        os.makedirs(save_dir, exist_ok=True)
+        stats = stats if stats is not None else {}
+
+        # 按输出策略筛选：非声明节点和临时预览图不下载
+        entries = []
+        skipped = 0
+        for node_id, node_output in outputs.items():
+            images = node_output.get('images', [])
+            if output_nodes is not None and str(node_id) not in output_nodes:
+                skipped += len(images)
+                continue
+            for image in images:
+                if image.get('type', 'output') == 'temp':
+                    skipped += 1
+                    continue
+                entries.append(image)
+        if skipped:
+            print(f"跳过 {skipped} 个非输出节点或临时预览图")
+
+        async def download(idx, image):
+            params = {
+                "filename": image['filename'],
+                "subfolder": image.get('subfolder', ''),
+                "type": image.get('type', 'output')
+            }
+            url = f"{self.instance_url}/view?{urllib.parse.urlencode(params)}"
+
+            async def attempt_once(attempt):
+                response = await self._request('get', url, timeout=30)
+                response.raise_for_status()
+                return response
+
+            print(f"下载文件 {idx+1}/{len(entries)}: {image['filename']}")
+            try:
+                # 只重试下载本身，不会因为下载失败重新生成
+                response = await retry_async(policy, attempt_once, self.instance_url, description='下载输出')
+            except Exception as e:
+                print(f"下载文件失败: {e}")
+                raise
+            mark_activity(self.instance_url)
+            return image['filename'], response.content
+
+        transfer_start = time.time()
+        downloaded = await asyncio.gather(*(download(idx, image) for idx, image in enumerate(entries)))
+        stats['bytes'] = sum(len(content) for _, content in downloaded)
+        stats['seconds'] = time.time() - transfer_start
+        stats['skipped'] = skipped
+
+        # WebP 解码和写文件是CPU/磁盘操作，放到线程里，不阻塞其它任务的轮询
+        decode_start = time.time()
+        saved_files = await asyncio.to_thread(_save_outputs, downloaded, save_dir, output_name)
+        stats['decode_seconds'] = time.time() - decode_start
+
+        if not saved_files:
+            raise Exception("没有生成任何文件")
+
+        print(f"成功下载了 {len(saved_files)} 个文件，{stats['bytes'] / 1024 / 1024:.2f}MB，用时 {stats['seconds']:.1f} 秒")
+        return saved_files
+
+def _save_outputs(downloaded, save_dir, output_name):
+    """保存下载的文件：WebP 解码成 PNG（多帧 WebP 的每一帧是批量中的一张），其它原样写入，按顺序统一编号"""
+    files = []
+    for filename, content in downloaded:
+        if filename.lower().endswith('.webp'):
+            files.extend(('png', frame) for frame in decode_webp_frames(content))
+        else:
+            files.append((filename.split('.')[-1], content))
+
+    saved_files = []
+    for idx, (ext, data) in enumerate(files):
+        file_path = output_file_path(save_dir, output_name, idx, len(files), f"output.{ext}")
+        if isinstance(data, bytes):
+            with open(file_path, "wb") as f:
+                f.write(data)
+        else:
+            # 与 ComfyUI 的 SaveImage 相同的压缩级别
+            data.save(file_path, 'PNG', compress_level=4)
+        saved_files.append(file_path)
+        print(f"文件已保存: {file_path}")
+    return saved_files
@@ -0,0 +1,506 @@
+'''
+File: runcomfy_fake_server.py
+Project: utils
+Created: 2026-10-19 15:05:47
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 本地模拟的 ComfyUI 实例 + RunComfy 管理API，用于在没有账号的情况下测试和压测
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import queue
+import random
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 模拟参数默认值
+DEFAULT_CONFIG = {
+    'boot_seconds': 5.0,        # 实例从创建到 Ready 的时间
+    'gen_seconds': 2.0,         # 生图：每张图、20步的GPU时间
+    'upscale_seconds': 4.0,     # 放大：每张图的GPU时间（完整放大工作流）
+    'model_upscale_seconds': 1.0,  # 其中模型放大(ImageUpscaleWithModel)的时间，只重绘的工作流不计
+    'load_seconds': 3.0,        # 切换模型组合时的加载时间
+    'gen_size': (1024, 1024),   # 生图输出尺寸
+    'upscale_size': (2896, 2896),  # 放大输出尺寸（约8MP）
+    'noise': 0.5,               # 输出PNG中随机噪声行的比例，决定文件大小
+    'vram_total': 16 * 1024 ** 3,
+    'error_rate': 0.0,          # 执行时随机出错（模拟显存不足）的比例
+}
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def make_png(width, height, noise=0.5):
+    """用标准库生成指定尺寸的RGB PNG，noise 比例的行填充随机数据以模拟真实文件大小"""
+    noise_every = max(1, round(1 / noise)) if noise > 0 else 0
+    flat_row = bytes(width * 3)
+    raw = bytearray()
+    for y in range(height):
+        raw += b'\x00'
+        raw += os.urandom(width * 3) if noise_every and y % noise_every == 0 else flat_row
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(bytes(raw), 1)) + chunk(b'IEND', b'')
+
+class FakeRunComfy:
+    """模拟服务器的状态：实例、GPU队列、历史、上传文件和计量数据"""
+
+    def __init__(self, **config):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.lock = threading.Condition()
+        self.servers = {}
+        self.pending = []
+        self.running = None
+        self.interrupted = set()
+        self.history = {}
+        self.uploads = {}
+        self.outputs = {}
+        self.loaded_models = None
+        self.counter = 0
+        self.subscribers = {}
+        self.stats = {'bytes_in': 0, 'bytes_out': 0, 'prompts': 0, 'completed': 0,
+                      'interrupted': 0, 'failed': 0, 'gpu_seconds': 0.0, 'load_seconds': 0.0}
+        self._png_cache = {}
+        self._webp_cache = {}
+        self.frames = {}
+        threading.Thread(target=self._gpu_worker, name='fake-gpu', daemon=True).start()
+
+    # ---------- 管理API ----------
+
+    def server_view(self, server):
+        ready = time.time() - server['created_at'] >= self.config['boot_seconds']
+        if server.get('stopped_at'):
+            status = 'Stopped'
+        else:
+            status = 'Ready' if ready else 'Initializing'
+            if ready and not server.get('ready_at'):
+                server['ready_at'] = server['created_at'] + self.config['boot_seconds']
+        return {
+            'server_id': server['server_id'],
+            'current_status': status,
+            'server_type': server['server_type'],
+            'main_service_url': f"/{server['server_id']}" if status == 'Ready' else None,
+            'created_at': server['created_at'],
+            'ready_at': server.get('ready_at'),
+            'stopped_at': server.get('stopped_at'),
+        }
+
+    def billed_seconds(self):
+        """所有实例从创建到停止（或当前）的总时长"""
+        now = time.time()
+        return sum((s.get('stopped_at') or now) - s['created_at'] for s in self.servers.values())
+
+    # ---------- GPU 队列 ----------
+
+    def submit(self, prompt, client_id, front=False):
+        with self.lock:
+            self.counter += 1
+            prompt_id = str(uuid.uuid4())
+            number = -self.counter if front else self.counter
+            item = [number, prompt_id, prompt, {'client_id': client_id}, []]
+            if front:
+                self.pending.insert(0, item)
+            else:
+                self.pending.append(item)
+            self.stats['prompts'] += 1
+            self.lock.notify_all()
+            return prompt_id, number
+
+    def _job_cost(self, prompt):
+        """根据工作流内容估算GPU时间、模型组合和输出"""
+        class_types = {node.get('class_type') for node in prompt.values()}
+        models = tuple(sorted(
+            str(node['inputs'].get(key)) for node in prompt.values()
+            for key in ('unet_name', 'lora_name', 'model_name') if key in node.get('inputs', {})
+        ))
+        steps = max([node['inputs'].get('steps', 20) for node in prompt.values()
+                     if node.get('class_type') == 'KSampler' and isinstance(node['inputs'].get('steps'), int)] or [20])
+        if 'LoadImage' in class_types:
+            seconds = self.config['upscale_seconds'] * steps / 4
+            if 'ImageUpscaleWithModel' not in class_types:
+                seconds = max(0.0, seconds - self.config['model_upscale_seconds'])
+            size, count = self.config['upscale_size'], 1
+        else:
+            count = max([node['inputs'].get('batch_size', 1) for node in prompt.values()
+                         if isinstance(node.get('inputs', {}).get('batch_size'), int)] or [1])
+            seconds = self.config['gen_seconds'] * count * steps / 20
+            size = self.config['gen_size']
+        return seconds, models, size, count
+
+    def _gpu_worker(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                item = self.pending.pop(0)
+                self.running = item
+            number, prompt_id, prompt, extra, _ = item
+            client_id = extra.get('client_id')
+            self._notify(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id}})
+
+            seconds, models, size, count = self._job_cost(prompt)
+            if models and models != self.loaded_models:
+                seconds += self.config['load_seconds']
+                self.stats['load_seconds'] += self.config['load_seconds']
+                self.loaded_models = models
+
+            started = time.time()
+            execution_start = ['execution_start', {'prompt_id': prompt_id, 'timestamp': int(started * 1000)}]
+            interrupted = False
+            while time.time() - started < seconds:
+                time.sleep(min(0.05, seconds))
+                if prompt_id in self.interrupted:
+                    interrupted = True
+                    break
+            self.stats['gpu_seconds'] += time.time() - started
+
+            failed = not interrupted and random.random() < self.config['error_rate']
+            with self.lock:
+                self.running = None
+                if failed:
+                    self.stats['failed'] += 1
+                    self.history[prompt_id] = {'prompt': item, 'outputs': {}, 'status': {
+                        'status_str': 'error', 'completed': False,
+                        'messages': [['execution_error', {'prompt_id': prompt_id, 'node_id': '202', 'node_type': 'KSampler',
+                                                          'exception_type': 'torch.OutOfMemoryError',
+                                                          'exception_message': 'CUDA out of memory (模拟)'}]]}}
+                elif interrupted:
+                    self.stats['interrupted'] += 1
+                    self.history[prompt_id] = {'prompt': item, 'outputs': {}, 'status': {
+                        'status_str': 'error', 'completed': False,
+                        'messages': [['execution_interrupted', {'prompt_id': prompt_id}]]}}
+                else:
+                    self.stats['completed'] += 1
+                    self.history[prompt_id] = {'prompt': item, 'outputs': self._make_outputs(prompt, size, count),
+                                               'status': {'status_str': 'success', 'completed': True, 'messages': [execution_start]}}
+            self._notify(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+
+    def _make_outputs(self, prompt, size, count):
+        outputs = {}
+        for node_id, node in prompt.items():
+            class_type = node.get('class_type')
+            if class_type not in ('SaveImage', 'PreviewImage', 'SaveAnimatedWEBP'):
+                continue
+            image_type = 'temp' if class_type == 'PreviewImage' else 'output'
+            ext = 'webp' if class_type == 'SaveAnimatedWEBP' else 'png'
+            images = []
+            frames = 1 if class_type == 'SaveAnimatedWEBP' else count
+            for _ in range(frames):
+                filename = f"ComfyUI_{uuid.uuid4().hex[:8]}_.{ext}"
+                self.outputs[filename] = size
+                self.frames[filename] = count if class_type == 'SaveAnimatedWEBP' else 1
+                images.append({'filename': filename, 'subfolder': '', 'type': image_type})
+            outputs[node_id] = {'images': images}
+            if class_type == 'SaveAnimatedWEBP':
+                outputs[node_id]['animated'] = [count > 1]
+        return outputs
+
+    def png_bytes(self, size):
+        if size not in self._png_cache:
+            self._png_cache[size] = make_png(size[0], size[1], self.config['noise'])
+        return self._png_cache[size]
+
+    def webp_bytes(self, size, frames):
+        """SaveAnimatedWEBP 的输出：无损 WebP，批量时每张图一帧；没有 PIL 时退回 PNG 内容"""
+        key = (size, frames)
+        if key not in self._webp_cache:
+            try:
+                import io
+                from PIL import Image
+                image = Image.open(io.BytesIO(self.png_bytes(size))).convert('RGB')
+                # 真实批量里每张图都不同；相同帧会被编码器合并，所以后续帧改动一个像素
+                others = []
+                for index in range(1, frames):
+                    other = image.copy()
+                    other.putpixel((0, 0), (index, index, index))
+                    others.append(other)
+                buffer = io.BytesIO()
+                image.save(buffer, 'WEBP', lossless=True, save_all=frames > 1, append_images=others, duration=1000)
+                self._webp_cache[key] = buffer.getvalue()
+            except ImportError:
+                self._webp_cache[key] = self.png_bytes(size)
+        return self._webp_cache[key]
+
+    # ---------- WebSocket 订阅 ----------
+
+    def _notify(self, client_id, message):
+        for subscriber in list(self.subscribers.get(client_id, [])):
+            subscriber.put(message)
+
+def validate_prompt(prompt):
+    """检查节点连线，返回 ComfyUI 风格的 node_errors（空字典表示通过）"""
+    node_errors = {}
+    for node_id, node in prompt.items():
+        if not isinstance(node, dict) or 'class_type' not in node:
+            node_errors[node_id] = {'errors': [{'type': 'invalid_node', 'message': '缺少 class_type'}]}
+            continue
+        for name, value in node.get('inputs', {}).items():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and value[0] not in prompt:
+                node_errors[node_id] = {'errors': [{'type': 'missing_link',
+                                                    'message': f"输入 {name} 引用了不存在的节点 {value[0]}"}]}
+    return node_errors
+
+class FakeRunComfyHandler(BaseHTTPRequestHandler):
+    """把HTTP请求分发给 FakeRunComfy"""
+
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_json(self):
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def do_GET(self):
+        state = self.state
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+
+        match = re.fullmatch(r'/prod/api/users/[^/]+/(servers|workflows)(?:/([^/]+))?', path)
+        if match:
+            kind, server_id = match.groups()
+            if kind == 'workflows':
+                return self._send_json([{'workflow_id': 'fake', 'version_id': 'fake-version'}])
+            with state.lock:
+                if server_id:
+                    server = state.servers.get(server_id)
+                    if not server or server.get('stopped_at'):
+                        return self._send_json({'error': 'not found'}, 404)
+                    return self._send_json(state.server_view(server))
+                return self._send_json([state.server_view(s) for s in state.servers.values() if not s.get('stopped_at')])
+
+        if path == '/system_stats':
+            return self._send_json({
+                'system': {'os': 'fake', 'python_version': sys.version},
+                'devices': [{'name': 'fake-gpu', 'type': 'cuda', 'index': 0,
+                             'vram_total': state.config['vram_total'],
+                             'vram_free': state.config['vram_total'] // (2 if state.loaded_models else 1)}]
+            })
+        if path == '/queue':
+            with state.lock:
+                return self._send_json({'queue_running': [state.running] if state.running else [],
+                                        'queue_pending': list(state.pending)})
+        if path.startswith('/history'):
+            prompt_id = path[len('/history/'):] if path.startswith('/history/') else None
+            with state.lock:
+                if prompt_id:
+                    entry = state.history.get(prompt_id)
+                    return self._send_json({prompt_id: entry} if entry else {})
+                return self._send_json(dict(state.history))
+        if path == '/view':
+            params = urllib.parse.parse_qs(parsed.query)
+            filename = params.get('filename', [''])[0]
+            size = state.outputs.get(filename)
+            if not size:
+                return self._send_json({'error': 'not found'}, 404)
+            body = state.webp_bytes(size, state.frames.get(filename, 1)) if filename.endswith('.webp') else state.png_bytes(size)
+            state.stats['bytes_out'] += len(body)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/webp' if filename.endswith('.webp') else 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path == '/ws':
+            return self._serve_websocket(urllib.parse.parse_qs(parsed.query).get('clientId', [''])[0])
+        if path == '/_fake/stats':
+            with state.lock:
+                return self._send_json(dict(state.stats, billed_seconds=state.billed_seconds(),
+                                            servers=[state.server_view(s) for s in state.servers.values()]))
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        state = self.state
+        path = urllib.parse.urlparse(self.path).path
+
+        if re.fullmatch(r'/prod/api/users/[^/]+/servers', path):
+            data = self._read_json()
+            server_id = uuid.uuid4().hex[:12]
+            with state.lock:
+                state.servers[server_id] = {'server_id': server_id, 'server_type': data.get('server_type', 'medium'),
+                                            'created_at': time.time()}
+            return self._send_json({'server_id': server_id})
+        if path == '/upload/image':
+            body = self._read_body()
+            state.stats['bytes_in'] += len(body)
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + body)
+            name = None
+            for part in message.iter_parts():
+                if part.get_param('name', header='content-disposition') == 'image':
+                    name = part.get_filename()
+                    state.uploads[name] = len(part.get_payload(decode=True) or b'')
+            if not name:
+                return self._send_json({'error': 'no image'}, 400)
+            return self._send_json({'name': name, 'subfolder': '', 'type': 'input'})
+        if path == '/prompt':
+            data = self._read_json()
+            prompt = data.get('prompt')
+            if not isinstance(prompt, dict) or not prompt:
+                return self._send_json({'error': {'type': 'invalid_prompt', 'message': 'prompt 为空'}, 'node_errors': {}}, 400)
+            node_errors = validate_prompt(prompt)
+            if node_errors:
+                return self._send_json({'error': {'type': 'prompt_outputs_failed_validation',
+                                                  'message': 'Prompt outputs failed validation'},
+                                        'node_errors': node_errors}, 400)
+            prompt_id, number = state.submit(prompt, data.get('client_id'), front=bool(data.get('front')))
+            return self._send_json({'prompt_id': prompt_id, 'number': number, 'node_errors': {}})
+        if path == '/queue':
+            data = self._read_json()
+            with state.lock:
+                if data.get('clear'):
+                    state.pending.clear()
+                delete_ids = set(data.get('delete', []))
+                state.pending[:] = [item for item in state.pending if item[1] not in delete_ids]
+            return self._send_json({})
+        if path == '/interrupt':
+            data = self._read_json()
+            with state.lock:
+                # 带 prompt_id 时只中断该任务（新版 ComfyUI 的行为）
+                if state.running and data.get('prompt_id') in (None, state.running[1]):
+                    state.interrupted.add(state.running[1])
+            return self._send_json({})
+        if path == '/history':
+            data = self._read_json()
+            with state.lock:
+                if data.get('clear'):
+                    state.history.clear()
+                for prompt_id in data.get('delete', []):
+                    state.history.pop(prompt_id, None)
+            return self._send_json({})
+        if path == '/free':
+            data = self._read_json()
+            with state.lock:
+                if data.get('unload_models'):
+                    state.loaded_models = None
+            return self._send_json({})
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_DELETE(self):
+        state = self.state
+        match = re.fullmatch(r'/prod/api/users/[^/]+/servers/([^/]+)', urllib.parse.urlparse(self.path).path)
+        if not match:
+            return self._send_json({'error': 'not found'}, 404)
+        with state.lock:
+            server = state.servers.get(match.group(1))
+            if not server or server.get('stopped_at'):
+                return self._send_json({'error': 'not found'}, 404)
+            server['stopped_at'] = time.time()
+        self._send_json({'status': 'stopping'}, 202)
+
+    def _serve_websocket(self, client_id):
+        """最小化的 WebSocket 服务端，只向客户端推送文本消息"""
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+
+        subscriber = queue.Queue()
+        self.state.subscribers.setdefault(client_id, []).append(subscriber)
+        try:
+            self._send_ws_text({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': len(self.state.pending)}}, 'sid': client_id}})
+            while True:
+                try:
+                    message = subscriber.get(timeout=15)
+                except queue.Empty:
+                    message = {'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': len(self.state.pending)}}}}
+                self._send_ws_text(message)
+        except OSError:
+            pass
+        finally:
+            self.state.subscribers[client_id].remove(subscriber)
+            self.close_connection = True
+
+    def _send_ws_text(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        if len(payload) < 126:
+            header = struct.pack('>BB', 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('>BBH', 0x81, 126, len(payload))
+        else:
+            header = struct.pack('>BBQ', 0x81, 127, len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+def start_fake_server(host='127.0.0.1', port=0, **config):
+    """在后台线程启动模拟服务器
+
+    返回:
+        tuple: (server, state, base_url)，用 server.shutdown() 停止
+    """
+    state = FakeRunComfy(**config)
+    handler = type('BoundFakeRunComfyHandler', (FakeRunComfyHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-runcomfy', daemon=True).start()
+    base_url = f"http://{host}:{server.server_address[1]}"
+    return server, state, base_url
+
+def fake_server_env(base_url):
+    """让 runcomfy_utils 指向模拟服务器所需的环境变量（需在导入 runcomfy_utils 之前设置）"""
+    return {
+        'RUNCOMFY_API_BASE': f"{base_url}/prod/api",
+        'RUNCOMFY_COMFYUI_URL_TEMPLATE': base_url,
+        'RUNCOMFY_USER_ID': 'fake-user',
+        'RUNCOMFY_API_TOKEN': 'fake-token',
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟 ComfyUI 实例和 RunComfy 管理API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--boot-seconds', type=float, default=DEFAULT_CONFIG['boot_seconds'])
+    parser.add_argument('--gen-seconds', type=float, default=DEFAULT_CONFIG['gen_seconds'])
+    parser.add_argument('--upscale-seconds', type=float, default=DEFAULT_CONFIG['upscale_seconds'])
+    parser.add_argument('--load-seconds', type=float, default=DEFAULT_CONFIG['load_seconds'])
+    parser.add_argument('--noise', type=float, default=DEFAULT_CONFIG['noise'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_CONFIG['error_rate'])
+    args = parser.parse_args()
+
+    server, state, base_url = start_fake_server(
+        args.host, args.port, boot_seconds=args.boot_seconds, gen_seconds=args.gen_seconds,
+        upscale_seconds=args.upscale_seconds, load_seconds=args.load_seconds, noise=args.noise,
+        error_rate=args.error_rate
+    )
+    print(f"模拟服务器已启动: {base_url}")
+    for name, value in fake_server_env(base_url).items():
+        print(f"export {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -7,25 +7,89 @@ Email: greenzorromail@gmail.com
 Description: 
 '''
 
+import io
 import os
 import uuid
 import json
-import requests
 import time
 import random
 import urllib.parse
+import csv
+import sys
+import re
+import socket
+import atexit
+import threading
+import subprocess
+import importlib.util
+from datetime import datetime
 
-# RunComfy API Token
+def lazy_import(name):
+    """延迟导入模块：返回的模块在第一次访问属性时才真正执行导入
+
+    requests、PIL 等模块导入要上百毫秒，只做本地文件操作的命令用不到它们。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+requests = lazy_import('requests')
+Image = lazy_import('PIL.Image')
+
+# RunComfy API Token，第一次调用 RunComfy 时才读取
 keys_file_path = os.path.join(os.path.dirname(__file__), "runcomfy_keys.json")
-try:
-    with open(keys_file_path, 'r') as f:
-        keys = json.load(f)
-        RUNCOMFY_USER_ID = keys.get('RUNCOMFY_USER_ID')
-        RUNCOMFY_API_TOKEN = keys.get('RUNCOMFY_API_TOKEN')
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    print(f"从 {keys_file_path} 加载密钥时出错: {e}")
-    RUNCOMFY_USER_ID = None
-    RUNCOMFY_API_TOKEN = None
+_credentials = None
+
+def get_credentials():
+    """读取 RunComfy 凭证，环境变量优先（用于本地模拟服务器等场景）
+
+    返回:
+        tuple: (RUNCOMFY_USER_ID, RUNCOMFY_API_TOKEN)
+    """
+    global _credentials
+    if _credentials is None:
+        user_id = api_token = None
+        try:
+            with open(keys_file_path, 'r') as f:
+                keys = json.load(f)
+                user_id = keys.get('RUNCOMFY_USER_ID')
+                api_token = keys.get('RUNCOMFY_API_TOKEN')
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"从 {keys_file_path} 加载密钥时出错: {e}")
+        _credentials = (os.environ.get('RUNCOMFY_USER_ID', user_id), os.environ.get('RUNCOMFY_API_TOKEN', api_token))
+    return _credentials
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """进程内共享的 HTTP 会话，复用到实例和管理API的连接
+
+    守护进程里跨命令保持，连续的命令不用重新建立 TLS 连接。
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+def auth_headers():
+    """请求 RunComfy/ComfyUI 时使用的认证头"""
+    return {'Authorization': f'Bearer {get_credentials()[1]}'}
+
+# RunComfy 管理API地址和实例的 ComfyUI 地址模板（可用环境变量指向本地模拟服务器）
+RUNCOMFY_API_BASE = os.environ.get('RUNCOMFY_API_BASE', "https://api.runcomfy.net/prod/api")
+COMFYUI_URL_TEMPLATE = os.environ.get('RUNCOMFY_COMFYUI_URL_TEMPLATE', "https://{server_id}-comfyui.runcomfy.com")
 
 # RunComfy 机器价格字典（Hobby 和 Pro 价格）
 RUNCOMFY_MACHINE_PRICES = {
@@ -53,13 +117,55 @@ def generate_seed():
     """
     return random.randint(10**14, (10**15)-1)
 
+# 运行事件日志
+EVENT_LOG_PATH = os.path.join(os.path.dirname(__file__), 'log', 'runcomfy-events.csv')
+_event_log_lock = threading.Lock()
+
+def log_event(event, **details):
+    """记录一条运行事件（实例生命周期决策等）到事件日志
+    
+    参数:
+        event (str): 事件类型
+        details: 事件详情，以JSON形式写入
+    """
+    print(f"[事件] {event}: {json.dumps(details, ensure_ascii=False)}")
+    try:
+        with _event_log_lock:
+            os.makedirs(os.path.dirname(EVENT_LOG_PATH), exist_ok=True)
+            file_exists = os.path.exists(EVENT_LOG_PATH)
+            with open(EVENT_LOG_PATH, 'a', newline='', encoding='utf-8') as csvfile:
+                csvwriter = csv.writer(csvfile)
+                if not file_exists:
+                    csvwriter.writerow(['记录时间', '事件', '详情'])
+                csvwriter.writerow([
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    event,
+                    json.dumps(details, ensure_ascii=False)
+                ])
+    except Exception as e:
+        print(f"写入事件日志失败: {e}")
+
+# 每个实例最近一次交互的时间 {实例URL: 时间戳}，供各自租约的空闲检测使用
+_last_activity = {}
+
+def mark_activity(instance_url):
+    """记录一次实例活动（提交、轮询、下载）"""
+    _last_activity[instance_url] = time.time()
+
+def get_last_activity(instance_url):
+    """返回该实例最近一次活动的时间戳，没有记录时返回 None"""
+    return _last_activity.get(instance_url)
+
+# 实例健康检查结果的缓存时间(秒)，缓存期内不再探测
+HEALTH_CHECK_TTL = 60
+
 class RunComfyService:
     """RunComfy实例管理服务"""
     
-    def __init__(self):
+    def __init__(self, instance_file=".runcomfy_instance"):
         self.instance_info = None
         self.instance_url = None
-        self.instance_file = os.path.join(os.path.dirname(__file__), ".runcomfy_instance")
+        self.instance_file = os.path.join(os.path.dirname(__file__), instance_file)
     
     def get_url_from_file(self):
         """从文件读取实例URL"""
@@ -73,15 +179,38 @@ class RunComfyService:
             print(f"读取实例文件失败: {e}")
         return None
         
-    def save_url_to_file(self, url):
+    def save_url_to_file(self, url, server_id=None):
         """保存实例URL到文件"""
         try:
             with open(self.instance_file, 'w') as f:
-                json.dump({'url': url}, f)
+                json.dump({'url': url, 'server_id': server_id}, f)
             print(f"实例URL已保存到文件: {url}")
         except Exception as e:
             print(f"保存实例文件失败: {e}")
     
+    def read_instance_file(self):
+        """读取实例文件的全部内容，文件不存在或损坏时返回空字典"""
+        try:
+            if os.path.exists(self.instance_file):
+                with open(self.instance_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"读取实例文件失败: {e}")
+        return {}
+    
+    def update_instance_file(self, **fields):
+        """合并更新实例文件中的字段（写临时文件后替换，避免读到半个文件）"""
+        data = self.read_instance_file()
+        data.update(fields)
+        temp_file = f"{self.instance_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_file, self.instance_file)
+        except Exception as e:
+            print(f"更新实例文件失败: {e}")
+        return data
+    
     def remove_instance_file(self):
         """删除实例信息文件"""
         try:
@@ -91,37 +220,104 @@ class RunComfyService:
         except Exception as e:
             print(f"删除实例文件失败: {e}")
 
+    def check_health(self, url, timeout=5):
+        """直接探测 ComfyUI 的 /system_stats，确认实例可用
+        
+        参数:
+            url (str): ComfyUI实例URL
+            timeout (int): 超时时间(秒)
+            
+        返回:
+            dict: system_stats 响应，实例不可用时返回None
+        """
+        headers = auth_headers()
+        try:
+            response = http_session().get(f"{url}/system_stats", headers=headers, timeout=timeout)
+            if response.status_code == 200:
+                return response.json()
+            print(f"实例健康检查失败，状态码: {response.status_code}")
+        except Exception as e:
+            print(f"实例健康检查失败: {e}")
+        return None
+    
+    def get_instance_stats(self, url=None, timeout=5):
+        """获取实例的队列深度和显存情况，供调度使用
+        
+        参数:
+            url (str): ComfyUI实例URL，默认使用当前实例
+            timeout (int): 超时时间(秒)
+            
+        返回:
+            dict: queue_running、queue_pending、vram_total、vram_free 等（见 runcomfy_system_stats），获取失败返回None
+        """
+        url = url or self.instance_url or self.get_url_from_file()
+        if not url:
+            return None
+        return runcomfy_system_stats(url, timeout=timeout)
+    
+    def get_cached_instance(self, ttl=HEALTH_CHECK_TTL):
+        """从实例文件获取实例，健康检查结果在 ttl 秒内有效，过期后重新探测 ComfyUI
+        
+        返回:
+            str: 可用的实例URL，文件中没有实例或探测失败时返回None
+        """
+        data = self.read_instance_file()
+        url = data.get('url')
+        if not url:
+            return None
+        
+        checked_at = data.get('health_checked_at') or 0
+        if time.time() - checked_at < ttl:
+            print(f"实例健康检查缓存有效 ({time.time() - checked_at:.0f}秒前)")
+        elif self.check_health(url) is not None:
+            self.update_instance_file(health_checked_at=time.time())
+        else:
+            self.update_instance_file(health_checked_at=None)
+            return None
+        
+        self.instance_url = url
+        self.instance_info = {
+            'url': url,
+            'status': 'Ready',
+            'server_id': data.get('server_id')
+        }
+        return url
+
     def get_instance_info(self):
         """获取实例信息
         
         返回:
             dict: 包含实例信息的字典，如果没有可用实例则返回None
         """
+        RUNCOMFY_USER_ID, RUNCOMFY_API_TOKEN = get_credentials()
         if not RUNCOMFY_API_TOKEN:
             raise ValueError("请设置RUNCOMFY_API_TOKEN")
             
         if not RUNCOMFY_USER_ID:
             raise ValueError("请设置RUNCOMFY_USER_ID")
             
-        headers = {'Authorization': f'Bearer {RUNCOMFY_API_TOKEN}'}
+        headers = auth_headers()
         
         # 先检查是否有可用的现有实例
         try:
-            servers_url = f"https://api.runcomfy.net/prod/api/users/{RUNCOMFY_USER_ID}/servers"
-            response = requests.get(servers_url, headers=headers, timeout=15)
+            servers_url = f"{RUNCOMFY_API_BASE}/users/{RUNCOMFY_USER_ID}/servers"
+            response = http_session().get(servers_url, headers=headers, timeout=15)
             if response.status_code == 200:
                 servers = response.json()
                 for server in servers:
                     if server.get('current_status') == 'Ready':
                         server_id = server['server_id']
-                        url = f"https://{server_id}-comfyui.runcomfy.com"
+                        url = COMFYUI_URL_TEMPLATE.format(server_id=server_id)
                         
                         # 更新实例信息
                         self.instance_url = url
                         self.instance_info = {
                             'url': url,
                             'status': server.get('current_status'),
-                            'server_id': server_id
+                            'server_id': server_id,
+                            'server_type': server.get('server_type'),
+                            'created_at': server.get('created_at'),
+                            'ready_at': server.get('ready_at')
                         }
                         
                         return self.instance_info
@@ -140,18 +336,19 @@ class RunComfyService:
         返回:
             dict: 包含实例信息的字典
         """
+        RUNCOMFY_USER_ID, RUNCOMFY_API_TOKEN = get_credentials()
         if not RUNCOMFY_API_TOKEN:
             raise ValueError("请设置RUNCOMFY_API_TOKEN")
             
         if not RUNCOMFY_USER_ID:
             raise ValueError("请设置RUNCOMFY_USER_ID")
             
-        headers = {'Authorization': f'Bearer {RUNCOMFY_API_TOKEN}'}
+        headers = auth_headers()
         
         # 1. 获取工作流
         print("正在获取工作流列表...")
-        workflows_url = f"https://api.runcomfy.net/prod/api/users/{RUNCOMFY_USER_ID}/workflows"
-        response = requests.get(workflows_url, headers=headers, timeout=15)
+        workflows_url = f"{RUNCOMFY_API_BASE}/users/{RUNCOMFY_USER_ID}/workflows"
+        response = http_session().get(workflows_url, headers=headers, timeout=15)
         response.raise_for_status()
         workflows = response.json()
         
@@ -162,14 +359,15 @@ class RunComfyService:
         
         # 2. 启动实例
         print(f"正在请求启动{server_type}类型实例...")
-        launch_url = f"https://api.runcomfy.net/prod/api/users/{RUNCOMFY_USER_ID}/servers"
+        launch_time = time.time()
+        launch_url = f"{RUNCOMFY_API_BASE}/users/{RUNCOMFY_USER_ID}/servers"
         request_data = {
             "server_type": server_type,
             "estimated_duration": estimated_duration,
             "workflow_version_id": version_id
         }
         
-        response = requests.post(
+        response = http_session().post(
             launch_url, 
             headers=headers, 
             json=request_data,
@@ -185,14 +383,14 @@ class RunComfyService:
         
         # 3. 等待就绪
         print("等待实例就绪...")
-        status_url = f"https://api.runcomfy.net/prod/api/users/{RUNCOMFY_USER_ID}/servers/{server_id}"
+        status_url = f"{RUNCOMFY_API_BASE}/users/{RUNCOMFY_USER_ID}/servers/{server_id}"
         start_time = time.time()
         max_wait_time = 600  # 10分钟
         last_status = None
         
         while time.time() - start_time < max_wait_time:
             try:
-                response = requests.get(status_url, headers=headers, timeout=10)
+                response = http_session().get(status_url, headers=headers, timeout=10)
                 if response.status_code == 404:
                     print("实例状态查询返回404，可能实例未完全创建，等待5秒...")
                     time.sleep(5)
@@ -207,7 +405,7 @@ class RunComfyService:
                     last_status = current_status
                 
                 if current_status == "Ready" and status_data.get("main_service_url"):
-                    url = f"https://{server_id}-comfyui.runcomfy.com"
+                    url = COMFYUI_URL_TEMPLATE.format(server_id=server_id)
                     print(f"实例已就绪: {url}")
                     
                     # 更新实例信息
@@ -215,11 +413,19 @@ class RunComfyService:
                     self.instance_info = {
                         'url': url,
                         'status': current_status,
-                        'server_id': server_id
+                        'server_id': server_id,
+                        'server_type': server_type,
+                        'launched_at': launch_time,
+                        # 管理API提供的时间优先，没有时用本地观察到的时间
+                        'created_at': api_timestamp(status_data.get('created_at'), launch_time),
+                        'ready_at': api_timestamp(status_data.get('ready_at'), time.time())
                     }
+                    # 启动耗时供模拟器（child_book_s_simulate.py）使用
+                    log_event('instance_boot', url=url, server_id=server_id, server_type=server_type,
+                              seconds=round(self.instance_info['ready_at'] - self.instance_info['created_at'], 1))
                     
                     # 保存URL到文件
-                    self.save_url_to_file(url)
+                    self.save_url_to_file(url, server_id)
                     
                     return self.instance_info
                 
@@ -247,10 +453,11 @@ class RunComfyService:
         返回:
             bool: 操作是否成功
         """
+        RUNCOMFY_USER_ID, RUNCOMFY_API_TOKEN = get_credentials()
         if not RUNCOMFY_API_TOKEN or not RUNCOMFY_USER_ID:
             raise ValueError("请设置RUNCOMFY_API_TOKEN和RUNCOMFY_USER_ID")
         
-        headers = {'Authorization': f'Bearer {RUNCOMFY_API_TOKEN}'}
+        headers = auth_headers()
         
         # 如果没有提供server_id，尝试使用当前实例的ID
         if not server_id:
@@ -267,8 +474,8 @@ class RunComfyService:
         print(f"正在停止实例 (server_id={server_id})...")
         
         try:
-            stop_url = f"https://api.runcomfy.net/prod/api/users/{RUNCOMFY_USER_ID}/servers/{server_id}"
-            response = requests.delete(stop_url, headers=headers, timeout=15)
+            stop_url = f"{RUNCOMFY_API_BASE}/users/{RUNCOMFY_USER_ID}/servers/{server_id}"
+            response = http_session().delete(stop_url, headers=headers, timeout=15)
             
             if response.status_code in [200, 202, 204]:
                 print("停止请求已发送，实例将会停止")
@@ -294,7 +501,7 @@ class RunComfyService:
             print(f"停止实例失败: {e}")
             return False
             
-    def get_or_create_instance(self, manual_url=None, create_new_instance=True, server_type="medium", estimated_duration=1800):
+    def get_or_create_instance(self, manual_url=None, create_new_instance=True, server_type="medium", estimated_duration=1800, reuse_any=True):
         """获取现有实例或创建新实例
         
         参数:
@@ -307,6 +514,8 @@ class RunComfyService:
                 - "2xlarge": 80GB VRAM | 96GB RAM，适合超大工作流，SDXL 1024x1024/20步约3.5秒
                 - "2xlarge_plus": 80GB VRAM | 180GB RAM，适合内存密集型工作流，SDXL 1024x1024/20步约2.2秒
             estimated_duration (int): 预计运行时间(秒)
+            reuse_any (bool): 实例文件中的实例不可用时，是否通过管理API复用账号下任意可用实例；
+                额外的并行实例传 False，只复用自己实例文件里的实例，否则会拿到主实例
             
         返回:
             str: 实例URL
@@ -325,24 +534,21 @@ class RunComfyService:
         # 2. 尝试检查是否有现有可用实例
         try:
             print("检查现有实例...")
-            # 先尝试从文件获取URL
-            file_url = self.get_url_from_file()
+            # 先尝试从文件获取URL，直接探测 ComfyUI 确认是否仍然可用
+            file_url = self.get_cached_instance()
             if file_url:
-                # 确认这个实例是否仍然可用
-                instance_info = self.get_instance_info()
-                if instance_info and instance_info['url'] == file_url:
-                    instance_url = file_url
-                    print(f"使用现有实例: {instance_url}")
-                    return instance_url
+                instance_url = file_url
+                print(f"使用现有实例: {instance_url}")
+                return instance_url
             
-            # 如果没有从文件获取到URL，检查是否有可用实例
-            if not instance_url:
+            # 探测失败时才通过管理API查找可用实例
+            if not instance_url and reuse_any:
                 instance_info = self.get_instance_info()
                 if instance_info:
                     instance_url = instance_info['url']
                     print(f"使用可用实例: {instance_url}")
                     # 保存URL到文件
-                    self.save_url_to_file(instance_url)
+                    self.save_url_to_file(instance_url, instance_info['server_id'])
                     return instance_url
         except Exception as e:
             print(f"检查现有实例时出错: {e}")
@@ -367,7 +573,1019 @@ class RunComfyService:
 # 创建全局RunComfy服务实例
 runcomfy_service = RunComfyService()
 
-def runcomfy_workflow(workflow_json, inputs, instance_url, verify_ssl=False, max_retries=5):
+# 计费明细日志：每个任务一行
+COST_LOG_PATH = os.path.join(os.path.dirname(__file__), 'log', 'runcomfy-cost.csv')
+
+# 空闲计费超过总计费时长的该比例时在事件日志中提示
+BILLING_IDLE_WARN_RATIO = 0.2
+
+# {实例URL: BillingMeter}，任务完成时按URL找到对应的计费表
+_billing_meters = {}
+
+# 每个实例上已经执行过的任务类型 {实例URL: set(任务类型)}，用于标记实例上的第一个任务（需要加载模型）
+_instance_job_kinds = {}
+
+def api_timestamp(value, default=None):
+    """管理API返回的时间（epoch秒或ISO8601字符串）转为epoch秒，无法解析时返回default"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    return default
+
+def record_job(kind, instance_url, started, images=1, name=None, batch_size=1, queue_seconds=None, megapixels=None, transfer=None):
+    """记录一个完成的任务：写入事件日志（供模拟器使用），并交给该实例的计费表分摊费用
+
+    参数:
+        kind (str): 任务类型（watercolor/flat/upscale）
+        instance_url (str): 执行任务的实例
+        started (float): 提交时间（epoch秒），结束时间为当前时间
+        images (int): 任务产出的图片数
+        name (str): 输出文件名前缀，用于按场景汇总
+        batch_size (int): 批量
+        queue_seconds (float): 在 ComfyUI 队列中等待的秒数，未知时为None
+        megapixels (float): 输入图片的百万像素数（放大任务），用于拟合放大耗时模型
+        transfer (dict): runcomfy_download_outputs 填写的下载统计
+
+    每个实例上某类任务的第一个任务带 first_on_instance、cold（新建的实例）、warmed（之前做过该类预热），
+    用来比较预热是否划算；预热任务的类型为 warmup-模板名。
+    """
+    ended = time.time()
+    details = {'queue_seconds': round(queue_seconds, 1)} if queue_seconds is not None else {}
+    meter = _billing_meters.get(instance_url)
+    seen = _instance_job_kinds.setdefault(instance_url, set())
+    base_kind = kind if kind.startswith('warmup-') else kind.split('-')[0]
+    if base_kind not in seen and not kind.startswith('warmup-'):
+        server = meter.server_for_url(instance_url) if meter else None
+        details.update(first_on_instance=True, warmed=f'warmup-{base_kind}' in seen,
+                       cold=bool(server and not server['reused']),
+                       server_type=server['server_type'] if server else None)
+    seen.add(base_kind)
+    if name:
+        details['name'] = name
+    if megapixels is not None:
+        details['megapixels'] = round(megapixels, 3)
+    if transfer:
+        details['download_bytes'] = transfer.get('bytes', 0)
+        details['download_seconds'] = round(transfer.get('seconds', 0), 2)
+        details['decode_seconds'] = round(transfer.get('decode_seconds', 0), 2)
+    log_event('job_complete', kind=kind, url=instance_url, batch_size=batch_size, seconds=round(ended - started, 1), **details)
+    if meter:
+        meter.add_job(kind, instance_url, started, ended, images, name)
+
+class BillingMeter:
+    """计费表：按实例的创建/就绪/停止时间计算实际计费时长，并分摊到任务、场景和单张图片
+
+    - 新建的实例从创建时间开始计费，启动耗时单独统计
+    - 复用的实例（保温中或上次运行留下的）从本次获取时开始计费，之前的时间属于之前的运行
+    - 停机成功时到停机时间为止；停机失败、共享或进入保温时到释放时间为止，并在事件日志中标出
+    - 实例计费时长中没有任务在执行的部分（启动、空闲）按任务耗时比例分摊到各任务
+    """
+
+    def __init__(self, price_per_hour=0.0):
+        self.price_per_hour = price_per_hour
+        self.servers = {}
+        self.jobs = []
+        self._lock = threading.Lock()
+
+    def server_started(self, info, reused=False):
+        """登记一台实例
+
+        参数:
+            info (dict): RunComfyService.instance_info（url、server_id、created_at、ready_at）
+            reused (bool): 是否复用已在运行的实例
+        """
+        now = time.time()
+        created_at = api_timestamp(info.get('created_at'), now)
+        entry = {
+            'url': info.get('url'),
+            'server_type': info.get('server_type'),
+            'created_at': created_at,
+            'ready_at': api_timestamp(info.get('ready_at'), now),
+            'billed_from': now if reused else created_at,
+            'billed_until': None,
+            'reused': reused,
+            'note': None,
+        }
+        with self._lock:
+            self.servers[info.get('server_id') or info.get('url')] = entry
+        _billing_meters[entry['url']] = self
+        if reused and now - created_at > 60:
+            log_event('billing_reuse', url=entry['url'], earlier_seconds=round(now - created_at),
+                      earlier_cost=round((now - created_at) / 3600 * self.price_per_hour, 4),
+                      note='复用的实例此前已在计费，这部分不计入本次运行')
+
+    def server_stopped(self, server_id, ok=True, note=None):
+        """登记实例停止计费（对本次运行而言）
+
+        参数:
+            server_id (str): 实例ID
+            ok (bool): 停机请求是否成功，失败时实例仍在计费
+            note (str): 结束原因（stop/shared/keep_warm）
+        """
+        with self._lock:
+            entry = self.servers.get(server_id)
+            if not entry or entry['billed_until']:
+                return
+            entry['billed_until'] = time.time()
+            entry['note'] = note if ok else 'stop_failed'
+        if not ok:
+            log_event('billing_stop_failed', url=entry['url'], server_id=server_id,
+                      note='停机请求失败，实例仍在计费，请手动确认')
+
+    def server_for_url(self, instance_url):
+        """返回该实例的计费记录（server_type、reused 等），未登记时返回None"""
+        with self._lock:
+            for entry in self.servers.values():
+                if entry['url'] == instance_url:
+                    return dict(entry)
+        return None
+
+    def add_job(self, kind, instance_url, started, ended, images, name):
+        with self._lock:
+            self.jobs.append({'kind': kind, 'url': instance_url, 'started': started, 'ended': ended,
+                              'images': images, 'name': name})
+
+    def settle(self, script_type=None):
+        """结算本次运行：计算各实例的计费、启动、忙碌和空闲时长，把费用分摊到任务
+
+        返回:
+            dict: billed_seconds, boot_seconds, busy_seconds, idle_seconds, cost, images,
+                  cost_per_image, jobs（含 cost）, scenes（{场景: 费用}）
+        """
+        now = time.time()
+        report = {'billed_seconds': 0.0, 'boot_seconds': 0.0, 'busy_seconds': 0.0, 'idle_seconds': 0.0,
+                  'cost': 0.0, 'images': 0, 'cost_per_image': None, 'jobs': [], 'scenes': {}}
+        with self._lock:
+            servers = list(self.servers.values())
+            jobs = [dict(job) for job in self.jobs]
+
+        for server in servers:
+            start = server['billed_from']
+            end = server['billed_until'] or now
+            billed = max(0.0, end - start)
+            boot = 0.0 if server['reused'] else max(0.0, min(server['ready_at'], end) - start)
+            server_jobs = [job for job in jobs if job['url'] == server['url']]
+
+            # 忙碌时长：任务时间段的并集（同一实例上的任务可能排队重叠）
+            busy = 0.0
+            cursor = start
+            for job in sorted(server_jobs, key=lambda job: job['started']):
+                job_start, job_end = max(job['started'], cursor), min(job['ended'], end)
+                if job_end > job_start:
+                    busy += job_end - job_start
+                    cursor = job_end
+            idle = max(0.0, billed - boot - busy)
+
+            # 整台实例的费用按任务耗时比例分摊
+            cost = billed / 3600 * self.price_per_hour
+            job_seconds = sum(job['ended'] - job['started'] for job in server_jobs)
+            for job in server_jobs:
+                job['cost'] = cost * (job['ended'] - job['started']) / job_seconds if job_seconds else 0.0
+
+            report['billed_seconds'] += billed
+            report['boot_seconds'] += boot
+            report['busy_seconds'] += busy
+            report['idle_seconds'] += idle
+            report['cost'] += cost
+
+            if billed and idle > BILLING_IDLE_WARN_RATIO * billed:
+                log_event('billing_idle', url=server['url'], idle_seconds=round(idle), billed_seconds=round(billed),
+                          idle_cost=round(idle / 3600 * self.price_per_hour, 4),
+                          note='实例计费时间中空闲占比过高')
+
+        for job in jobs:
+            job.setdefault('cost', 0.0)
+            report['images'] += job['images']
+            scene = re.sub(r'_\d+$', '', job['name']) if job['name'] else job['kind']
+            report['scenes'][scene] = report['scenes'].get(scene, 0.0) + job['cost']
+        report['jobs'] = jobs
+        if report['images']:
+            report['cost_per_image'] = report['cost'] / report['images']
+
+        log_event('billing_settle', script=script_type, instances=len(servers),
+                  billed_seconds=round(report['billed_seconds']), boot_seconds=round(report['boot_seconds']),
+                  busy_seconds=round(report['busy_seconds']), idle_seconds=round(report['idle_seconds']),
+                  cost=round(report['cost'], 4), images=report['images'],
+                  cost_per_image=round(report['cost_per_image'], 4) if report['cost_per_image'] else None,
+                  endings=[server['note'] for server in servers])
+        self._write_cost_log(script_type, jobs)
+        return report
+
+    def _write_cost_log(self, script_type, jobs):
+        """把每个任务的耗时和分摊费用写入 COST_LOG_PATH"""
+        if not jobs:
+            return
+        try:
+            os.makedirs(os.path.dirname(COST_LOG_PATH), exist_ok=True)
+            file_exists = os.path.exists(COST_LOG_PATH)
+            with open(COST_LOG_PATH, 'a', newline='', encoding='utf-8') as csvfile:
+                csvwriter = csv.writer(csvfile)
+                if not file_exists:
+                    csvwriter.writerow(['记录时间', '脚本类型', '任务类型', '输出名', '图片数量', '耗时(秒)', '分摊成本($)', '单张成本($)'])
+                log_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                for job in jobs:
+                    csvwriter.writerow([
+                        log_time, script_type, job['kind'], job['name'], job['images'],
+                        f"{job['ended'] - job['started']:.1f}", f"{job['cost']:.4f}",
+                        f"{job['cost'] / job['images']:.4f}" if job['images'] else ''
+                    ])
+        except Exception as e:
+            print(f"写入计费明细失败: {e}")
+
+class InstanceLifecycleManager:
+    """实例生命周期管理：租约心跳、空闲自动停机、脚本之间保温
+    
+    租约写在实例文件的 leases 字段里（{持有者: 心跳时间}），只要有未过期的租约，
+    任何一方都不会停机；最后一个持有者释放时进入保温窗口，并启动一个独立的
+    守护进程，窗口结束仍无人接手才停机，保证实例不会被遗弃。
+    """
+    
+    def __init__(self, service=None, idle_timeout=600, keep_warm=900, heartbeat_interval=30, price_per_hour=0.0, meter=None):
+        """
+        参数:
+            service (RunComfyService): 实例服务，默认使用全局 runcomfy_service
+            idle_timeout (int): 持有期间无任何活动超过该秒数则停机，0 表示不检测
+            keep_warm (int): 释放后保温的秒数，0 表示释放时立即停机
+            heartbeat_interval (int): 心跳间隔(秒)，超过3个间隔未更新的租约视为失效
+            price_per_hour (float): 机器每小时价格，用于在日志中估算成本影响
+            meter (BillingMeter): 共用的计费表，一次运行使用多台实例时由主实例的计费表统一结算
+        """
+        self.service = service or runcomfy_service
+        self.idle_timeout = idle_timeout
+        self.keep_warm = keep_warm
+        self.heartbeat_interval = heartbeat_interval
+        self.price_per_hour = price_per_hour
+        self.meter = meter or BillingMeter(price_per_hour)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.instance_url = None
+        # 最近一次 acquire 是否新建了实例（新实例的模型还没加载，需要预热）
+        self.created = False
+        self._stop_event = threading.Event()
+        self._watchdog = None
+        self._released = True
+    
+    def _cost(self, seconds):
+        """按秒数估算成本（美元）"""
+        return round(seconds / 3600 * self.price_per_hour, 4)
+    
+    def _live_leases(self, data):
+        """返回实例文件中仍在心跳的其他持有者"""
+        stale_before = time.time() - 3 * self.heartbeat_interval
+        return {owner: beat for owner, beat in (data.get('leases') or {}).items()
+                if owner != self.owner and beat >= stale_before}
+    
+    def acquire(self, **instance_kwargs):
+        """获取实例并登记租约，参数透传给 get_or_create_instance
+        
+        返回:
+            str: 实例URL
+        """
+        warm_data = self.service.read_instance_file()
+        warm_until = warm_data.get('keep_warm_until')
+        
+        acquire_time = time.time()
+        self.instance_url = self.service.get_or_create_instance(**instance_kwargs)
+        info = dict(self.service.instance_info or {})
+        server_id = info.get('server_id') or warm_data.get('server_id')
+        info.update(url=self.instance_url, server_id=server_id)
+        # 本次调用中新建的实例从创建时开始计费，其余都是复用
+        self.created = (info.get('launched_at') or 0) >= acquire_time
+        self.meter.server_started(info, reused=not self.created)
+        
+        data = self.service.read_instance_file()
+        leases = self._live_leases(data)
+        leases[self.owner] = time.time()
+        self.service.update_instance_file(url=self.instance_url, server_id=server_id, leases=leases, keep_warm_until=None)
+        
+        if warm_until and data.get('url') == self.instance_url:
+            log_event('lifecycle_reuse_warm', url=self.instance_url, owner=self.owner,
+                      note='复用保温中的实例，省去一次启动等待')
+        else:
+            log_event('lifecycle_acquire', url=self.instance_url, owner=self.owner, shared_with=list(leases.keys() - {self.owner}))
+        
+        # 清理之前崩溃或被中断的运行留在队列里的任务
+        runcomfy_reconcile_queue(self.instance_url)
+        
+        mark_activity(self.instance_url)
+        self._released = False
+        self._stop_event.clear()
+        self._watchdog = threading.Thread(target=self._watch, name='instance-watchdog', daemon=True)
+        self._watchdog.start()
+        atexit.register(self.release)
+        return self.instance_url
+    
+    def touch(self):
+        """手动标记一次活动（长时间本地处理时调用，避免被判定为空闲）"""
+        mark_activity(self.instance_url)
+    
+    def _stop_server(self, server_id, reason):
+        """按 server_id 停机；实例文件里没有 server_id 时不停机，只记录事件
+        
+        stop_instance(None) 会回退到停止账号下任意一台 Ready 实例，可能停掉别的运行正在用的实例。
+        """
+        if not server_id:
+            log_event('lifecycle_stop_skipped', url=self.instance_url, reason=reason,
+                      note='实例文件中没有 server_id，跳过停机，请手动确认实例状态')
+            return False
+        return self.service.stop_instance(server_id)
+    
+    def _watch(self):
+        """后台看门狗：定时写心跳，空闲超时则停机"""
+        while not self._stop_event.wait(self.heartbeat_interval):
+            data = self.service.read_instance_file()
+            leases = dict(data.get('leases') or {})
+            leases[self.owner] = time.time()
+            self.service.update_instance_file(leases=leases)
+            
+            idle_seconds = time.time() - (get_last_activity(self.instance_url) or time.time())
+            if self.idle_timeout and idle_seconds > self.idle_timeout:
+                if self._live_leases(data):
+                    log_event('lifecycle_idle_shared', url=self.instance_url, idle_seconds=round(idle_seconds),
+                              note='空闲超时，但仍有其他持有者，保持运行')
+                    continue
+                log_event('lifecycle_idle_stop', url=self.instance_url, idle_seconds=round(idle_seconds),
+                          idle_cost=self._cost(idle_seconds), note='空闲超时自动停机，避免继续计费')
+                stopped = self._stop_server(data.get('server_id'), 'idle_stop')
+                self.meter.server_stopped(data.get('server_id'), ok=stopped, note='idle_stop')
+                self._released = True
+                return
+    
+    def release(self, keep_warm=None):
+        """释放租约；没有其他持有者时进入保温窗口或直接停机
+        
+        参数:
+            keep_warm (int): 覆盖构造时的保温秒数
+        """
+        if self._released:
+            return
+        self._released = True
+        self._stop_event.set()
+        atexit.unregister(self.release)
+        keep_warm = self.keep_warm if keep_warm is None else keep_warm
+        
+        data = self.service.read_instance_file()
+        leases = self._live_leases(data)
+        if leases:
+            self.service.update_instance_file(leases=leases)
+            self.meter.server_stopped(data.get('server_id'), note='shared')
+            log_event('lifecycle_release_shared', url=self.instance_url, remaining_owners=list(leases.keys()),
+                      note='仍有其他持有者，不停机')
+            return
+        
+        if not keep_warm:
+            log_event('lifecycle_stop', url=self.instance_url, note='释放时立即停机')
+            stopped = self._stop_server(data.get('server_id'), 'stop')
+            self.meter.server_stopped(data.get('server_id'), ok=stopped, note='stop')
+            return
+        
+        # 保温窗口的费用由保温守护进程记录（lifecycle_keep_warm_expired），本次运行计到释放为止
+        self.meter.server_stopped(data.get('server_id'), note='keep_warm')
+        
+        keep_warm_until = time.time() + keep_warm
+        self.service.update_instance_file(leases={}, keep_warm_since=time.time(), keep_warm_until=keep_warm_until)
+        log_event('lifecycle_keep_warm', url=self.instance_url, keep_warm_seconds=keep_warm,
+                  max_cost=self._cost(keep_warm), note='进入保温窗口，窗口内再次运行可跳过启动')
+        
+        # 独立进程负责保温结束后停机，当前脚本退出也不会遗弃实例
+        try:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'reap',
+                 os.path.basename(self.service.instance_file), str(self.price_per_hour)],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        except Exception as e:
+            log_event('lifecycle_reaper_failed', url=self.instance_url, error=str(e), note='无法启动保温守护进程，立即停机')
+            self._stop_server(data.get('server_id'), 'reaper_failed')
+
+def reap_idle_instance(instance_file=".runcomfy_instance", price_per_hour=0.0, poll_interval=30):
+    """保温守护进程：保温窗口结束且没有新的持有者时停机
+    
+    参数:
+        instance_file (str): 实例文件名
+        price_per_hour (float): 机器每小时价格
+        poll_interval (int): 检查间隔(秒)
+    """
+    service = RunComfyService(instance_file=instance_file)
+    manager = InstanceLifecycleManager(service=service, price_per_hour=price_per_hour)
+    while True:
+        data = service.read_instance_file()
+        keep_warm_until = data.get('keep_warm_until')
+        # 实例已停止、已被新的运行接手，或保温窗口被新的守护进程延长
+        if not data or not keep_warm_until or manager._live_leases(data):
+            return
+        remaining = keep_warm_until - time.time()
+        if remaining > 0:
+            time.sleep(min(poll_interval, remaining))
+            continue
+        warm_seconds = time.time() - data.get('keep_warm_since', keep_warm_until)
+        log_event('lifecycle_keep_warm_expired', url=data.get('url'), warm_seconds=round(warm_seconds),
+                  warm_cost=manager._cost(warm_seconds), note='保温窗口结束无人使用，停机')
+        manager.instance_url = data.get('url')
+        manager._stop_server(data.get('server_id'), 'keep_warm_expired')
+        return
+
+def apply_workflow_inputs(workflow, inputs):
+    """把输入配置写入工作流节点
+    
+    参数:
+        workflow (dict): 工作流JSON对象（会被修改）
+        inputs (dict): 输入配置，{节点ID: {"type": ..., "text"/"path"/"image_path": ...}}
+        
+    返回:
+        list: 需要上传的图片 [(节点ID, 图片路径, 上传文件名)]
+    """
+    uploads = []
+    for node_id, input_data in inputs.items():
+        if node_id not in workflow:
+            print(f"警告: 节点ID {node_id} 不在工作流中")
+            continue
+            
+        input_type = input_data.get('type')
+        
+        if input_type in ['image', 'text_and_image']:
+            image_path = input_data.get('image_path', input_data.get('path'))
+            upload_name = upload_slot_name(image_path)
+            workflow[node_id]['inputs']['image'] = upload_name
+            uploads.append((node_id, image_path, upload_name))
+            
+        if input_type in ['text', 'text_and_image', 'text_and_images']:
+            workflow[node_id]['inputs']['text'] = input_data['text']
+    return uploads
+
+# 提交时使用的 client_id 前缀，带上主机和进程号，用于启动时识别遗留的任务
+CLIENT_ID_PREFIX = "child-book"
+
+def make_client_id():
+    """生成本进程的 client_id: child-book:主机:进程号:随机串"""
+    return f"{CLIENT_ID_PREFIX}:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def _client_id_owner_alive(client_id):
+    """判断 client_id 对应的本机进程是否仍在运行；其他主机或无法识别的返回None"""
+    parts = (client_id or '').split(':')
+    if len(parts) < 4 or parts[0] != CLIENT_ID_PREFIX or parts[1] != socket.gethostname():
+        return None
+    try:
+        os.kill(int(parts[2]), 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except (ValueError, PermissionError, OSError):
+        return True
+
+def runcomfy_get_queue(instance_url, verify_ssl=False):
+    """获取实例队列
+
+    返回:
+        tuple: (运行中的队列项列表, 等待中的队列项列表)，队列项格式为 [序号, prompt_id, prompt, extra_data, outputs]
+    """
+    headers = auth_headers()
+    response = http_session().get(f"{instance_url}/queue", headers=headers, verify=verify_ssl, timeout=15)
+    response.raise_for_status()
+    queue = response.json()
+    return queue.get('queue_running', []), queue.get('queue_pending', [])
+
+def runcomfy_cancel_prompt(instance_url, prompt_id, verify_ssl=False, reason=''):
+    """取消一个已提交的任务：等待中的从队列删除，运行中的中断
+
+    参数:
+        instance_url (str): ComfyUI实例URL
+        prompt_id (str): 任务ID
+        verify_ssl (bool): SSL验证
+        reason (str): 取消原因，写入事件日志
+
+    返回:
+        str: 'deleted' / 'interrupted' / 'not_found'（已完成或已不在队列） / 'failed'
+    """
+    headers = auth_headers()
+    try:
+        running, pending = runcomfy_get_queue(instance_url, verify_ssl)
+        if any(item[1] == prompt_id for item in pending):
+            response = http_session().post(f"{instance_url}/queue", headers=headers, json={"delete": [prompt_id]},
+                                     verify=verify_ssl, timeout=15)
+            response.raise_for_status()
+            result = 'deleted'
+        elif any(item[1] == prompt_id for item in running):
+            # 新版 ComfyUI 按 prompt_id 中断，旧版忽略参数中断当前任务（已确认当前任务就是它）
+            response = http_session().post(f"{instance_url}/interrupt", headers=headers, json={"prompt_id": prompt_id},
+                                     verify=verify_ssl, timeout=15)
+            response.raise_for_status()
+            result = 'interrupted'
+        else:
+            result = 'not_found'
+    except Exception as e:
+        print(f"取消任务 {prompt_id} 失败: {e}")
+        result = 'failed'
+
+    if result != 'not_found':
+        log_event('prompt_cancel', url=instance_url, prompt_id=prompt_id, result=result, reason=reason)
+    return result
+
+def runcomfy_reconcile_queue(instance_url, verify_ssl=False):
+    """启动时清理队列：取消本机已退出进程留下的任务，避免GPU继续为它们计费
+
+    其他主机提交的任务无法判断是否存活，保持不动。
+
+    返回:
+        list: 被取消的 prompt_id
+    """
+    try:
+        running, pending = runcomfy_get_queue(instance_url, verify_ssl)
+    except Exception as e:
+        print(f"获取队列失败，跳过队列清理: {e}")
+        return []
+
+    orphaned = []
+    # 先删等待中的，再中断运行中的，避免中断后遗留任务立即开始执行
+    for item in pending + running:
+        client_id = (item[3] or {}).get('client_id') if len(item) > 3 else None
+        if _client_id_owner_alive(client_id) is False:
+            orphaned.append(item[1])
+
+    cancelled = [prompt_id for prompt_id in orphaned
+                 if runcomfy_cancel_prompt(instance_url, prompt_id, verify_ssl, reason='orphaned') in ('deleted', 'interrupted')]
+    if orphaned:
+        log_event('queue_reconcile', url=instance_url, orphaned=len(orphaned), cancelled=len(cancelled),
+                  queue_running=len(running), queue_pending=len(pending))
+    return cancelled
+
+# ---------- 实例侧清理 ----------
+
+# 生成和放大之间切换时按显存压力释放（ComfyUI /free）：空闲显存低于总显存的该比例才释放，0 表示不按显存释放。
+# 水彩和扁平共用 Flux UNET 和 CLIP，只差 LoRA，风格之间切换从不释放，否则每次都要重新加载约 12GB 权重
+HOUSEKEEPING_FREE_VRAM_RATIO = 0.1
+# 定时释放：距上次释放（或第一个任务）超过该秒数时，在下一次生成/放大切换时释放，0 表示不定时释放
+HOUSEKEEPING_FREE_INTERVAL = 0
+# 两次释放之间的最短间隔（秒），同一实例上交替执行生成和放大时避免反复卸载、加载模型
+HOUSEKEEPING_FREE_MIN_INTERVAL = 300
+# 结果下载完成后删除实例上该任务的 history 记录
+HOUSEKEEPING_DELETE_HISTORY = True
+# 每完成多少个任务记录一次实例的显存和队列状态，0 表示不记录
+HOUSEKEEPING_STATS_EVERY = 20
+# 上传图片轮流使用的文件名数量，实例 input 目录里本进程上传的图片最多这么多张；0 表示使用原文件名。
+# 必须大于同时在实例上的任务数，否则排队中的任务读到的可能是后面任务覆盖上传的图片
+UPLOAD_SLOTS = 16
+
+_upload_counter = 0
+_upload_counter_lock = threading.Lock()
+
+def upload_slot_name(image_path):
+    """按轮转的槽位生成上传文件名: child-book-进程号-槽位.扩展名，overwrite 上传覆盖旧图
+
+    LoadImage 按文件内容判断是否变化，同名覆盖后仍会重新执行。
+    """
+    global _upload_counter
+    if UPLOAD_SLOTS <= 0:
+        return os.path.basename(image_path)
+    with _upload_counter_lock:
+        slot = _upload_counter % UPLOAD_SLOTS
+        _upload_counter += 1
+    return f"{CLIENT_ID_PREFIX}-{os.getpid()}-{slot}{os.path.splitext(image_path)[1]}"
+
+def runcomfy_system_stats(instance_url, timeout=5, verify_ssl=False):
+    """从 /system_stats 和 /queue 读取实例的显存、内存和队列状态
+
+    返回:
+        dict: vram_total、vram_free、torch_vram_free、ram_free（字节）、queue_running、queue_pending，
+              /system_stats 不可用时返回None
+    """
+    headers = auth_headers()
+    try:
+        response = http_session().get(f"{instance_url}/system_stats", headers=headers, verify=verify_ssl, timeout=timeout)
+        response.raise_for_status()
+        system_stats = response.json()
+    except Exception as e:
+        print(f"获取实例状态失败: {e}")
+        return None
+
+    stats = {'vram_total': 0, 'vram_free': 0, 'torch_vram_free': 0,
+             'ram_free': (system_stats.get('system') or {}).get('ram_free', 0),
+             'queue_running': 0, 'queue_pending': 0}
+    for device in system_stats.get('devices', []):
+        stats['vram_total'] += device.get('vram_total', 0)
+        stats['vram_free'] += device.get('vram_free', 0)
+        stats['torch_vram_free'] += device.get('torch_vram_free', 0)
+    try:
+        running, pending = runcomfy_get_queue(instance_url, verify_ssl)
+        stats['queue_running'] = len(running)
+        stats['queue_pending'] = len(pending)
+    except Exception as e:
+        print(f"获取实例队列失败: {e}")
+    return stats
+
+def runcomfy_free_memory(instance_url, unload_models=True, free_memory=True, verify_ssl=False):
+    """请求 ComfyUI 卸载模型、释放缓存；正在执行的任务不受影响，ComfyUI 在任务之间处理
+
+    注意 ComfyUI 在只传 free_memory 时也会卸载全部模型，不想卸载模型时两者都不能传 True。
+
+    返回:
+        bool: 请求是否成功
+    """
+    headers = auth_headers()
+    try:
+        response = http_session().post(f"{instance_url}/free", headers=headers, verify=verify_ssl, timeout=15,
+                                       json={"unload_models": unload_models, "free_memory": free_memory})
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"释放实例显存失败: {e}")
+        return False
+
+def runcomfy_delete_history(instance_url, prompt_ids, verify_ssl=False):
+    """删除实例上已取回结果的 history 记录
+
+    返回:
+        bool: 请求是否成功
+    """
+    headers = auth_headers()
+    try:
+        response = http_session().post(f"{instance_url}/history", headers=headers, verify=verify_ssl, timeout=15,
+                                       json={"delete": list(prompt_ids)})
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"删除实例 history 失败: {e}")
+        return False
+
+class InstanceHousekeeper:
+    """单个实例的清理：生成和放大之间切换且显存紧张（或到了定时释放的时间）时释放显存，
+    取回结果后删除 history，定期记录显存和队列状态
+
+    同一进程内按实例共享（get_housekeeper），多个线程交替使用同一实例时按最短间隔限制释放次数。
+    """
+
+    def __init__(self, instance_url, free_vram_ratio=None, free_interval=None, free_min_interval=None, delete_history=None, stats_every=None):
+        self.instance_url = instance_url
+        self.free_vram_ratio = HOUSEKEEPING_FREE_VRAM_RATIO if free_vram_ratio is None else free_vram_ratio
+        self.free_interval = HOUSEKEEPING_FREE_INTERVAL if free_interval is None else free_interval
+        self.free_min_interval = HOUSEKEEPING_FREE_MIN_INTERVAL if free_min_interval is None else free_min_interval
+        self.delete_history = HOUSEKEEPING_DELETE_HISTORY if delete_history is None else delete_history
+        self.stats_every = HOUSEKEEPING_STATS_EVERY if stats_every is None else stats_every
+        self.last_workflow = None
+        self.last_free_at = None
+        self.started_at = time.time()
+        # 预热过、还没执行第一个正式任务的工作流
+        self.warmed = set()
+        self.jobs = 0
+        self.history_deleted = 0
+        self.output_bytes = 0
+        self._lock = threading.Lock()
+
+    def before_job(self, workflow):
+        """提交任务前调用：在生成和放大之间切换时，显存紧张或到了定时释放的时间就释放显存
+
+        参数:
+            workflow (str): 工作流类型（watercolor/flat/upscale），草稿与正式任务属于同一类型
+
+        返回:
+            bool: 是否请求了释放
+        """
+        with self._lock:
+            previous, self.last_workflow = self.last_workflow, workflow
+            # 切换到刚预热过的工作流时它的权重已经在显存里，释放会让预热白做
+            if workflow in self.warmed:
+                self.warmed.discard(workflow)
+                return False
+            # 风格之间切换只换 LoRA，释放只会让共用的 UNET/CLIP 重新加载
+            if previous is None or (previous == 'upscale') == (workflow == 'upscale'):
+                return False
+            now = time.time()
+            if self.last_free_at is not None and now - self.last_free_at < self.free_min_interval:
+                return False
+            interval_due = bool(self.free_interval) and now - (self.last_free_at or self.started_at) >= self.free_interval
+        stats = runcomfy_system_stats(self.instance_url) or {}
+        pressure = bool(self.free_vram_ratio and stats.get('vram_total')
+                        and stats['vram_free'] < self.free_vram_ratio * stats['vram_total'])
+        if not (pressure or interval_due):
+            return False
+        with self._lock:
+            self.last_free_at = time.time()
+            self.warmed.clear()
+        freed = runcomfy_free_memory(self.instance_url)
+        # 释放后预热的模型不在显存里了，之后的第一个任务不再算作预热过
+        for kind in [kind for kind in _instance_job_kinds.get(self.instance_url, ()) if kind.startswith('warmup-')]:
+            _instance_job_kinds[self.instance_url].discard(kind)
+        log_event('housekeeping_free', url=self.instance_url, previous=previous, workflow=workflow, ok=freed,
+                  reason='vram' if pressure else 'interval',
+                  vram_free=stats.get('vram_free'), vram_total=stats.get('vram_total'),
+                  queue_pending=stats.get('queue_pending'))
+        return freed
+
+    def warmed_up(self, workflows, first):
+        """预热后登记已加载的工作流：切换到它们时不释放，预热后 free_min_interval 秒内也不释放
+
+        参数:
+            workflows (list): 预热成功的工作流
+            first (str): 第一个要用的工作流，视为当前工作流
+        """
+        with self._lock:
+            self.warmed = set(workflows)
+            self.last_workflow = first
+            self.last_free_at = time.time()
+
+    def after_job(self, prompt_id=None, transfer=None):
+        """取回结果后调用：删除该任务的 history，每 stats_every 个任务记录一次实例状态"""
+        if prompt_id and self.delete_history and runcomfy_delete_history(self.instance_url, [prompt_id]):
+            with self._lock:
+                self.history_deleted += 1
+        with self._lock:
+            self.jobs += 1
+            self.output_bytes += (transfer or {}).get('bytes', 0)
+            due = self.stats_every and self.jobs % self.stats_every == 0
+        if due:
+            self.log_stats()
+
+    def log_stats(self):
+        """记录实例的显存、内存、队列状态，以及本进程删除的 history 数和在实例上留下的输出大小"""
+        stats = runcomfy_system_stats(self.instance_url)
+        if stats is None:
+            return None
+        log_event('instance_stats', url=self.instance_url, jobs=self.jobs, history_deleted=self.history_deleted,
+                  output_mb=round(self.output_bytes / 1024 / 1024, 1), **stats)
+        return stats
+
+_housekeepers = {}
+_housekeepers_lock = threading.Lock()
+
+def get_housekeeper(instance_url):
+    """返回实例对应的清理器（同一进程内共享）"""
+    with _housekeepers_lock:
+        if instance_url not in _housekeepers:
+            _housekeepers[instance_url] = InstanceHousekeeper(instance_url)
+        return _housekeepers[instance_url]
+
+# 失败类别
+ERROR_TRANSIENT = 'transient'            # 网络抖动、超时、5xx，退避后重试有意义
+ERROR_TIMEOUT = 'timeout'                # 工作流超时，取消后重提一次
+ERROR_EXECUTION = 'execution_error'      # ComfyUI 执行出错（显存不足等），立即重提一次
+ERROR_VALIDATION = 'validation'          # 400、节点ID错误、缺少模型、本地文件缺失，重试没有意义
+ERROR_INSTANCE_GONE = 'instance_gone'    # 实例已停止或不可达，重试没有意义，直接熔断
+ERROR_CIRCUIT_OPEN = 'circuit_open'      # 熔断中，未发出请求
+
+class RunComfyError(Exception):
+    """RunComfy 调用失败，kind 为失败类别"""
+
+    def __init__(self, message, kind=ERROR_TRANSIENT, prompt_id=None, details=None):
+        super().__init__(message)
+        self.kind = kind
+        self.prompt_id = prompt_id
+        self.details = details or {}
+
+class CircuitBreaker:
+    """单个实例的熔断器
+
+    连续失败达到阈值（或确认实例已不可达）时打开，打开期间直接拒绝请求；
+    经过 reset_timeout 秒后进入半开状态放行一次试探，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, instance_url, failure_threshold=3, reset_timeout=120):
+        self.instance_url = instance_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.time() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        """是否允许发出请求"""
+        return self.state != 'open'
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                log_event('circuit_close', url=self.instance_url, note='试探成功，恢复正常')
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, kind):
+        """记录一次失败；校验类失败说明请求本身有问题，不计入实例健康"""
+        if kind == ERROR_VALIDATION:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and (kind == ERROR_INSTANCE_GONE or self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                log_event('circuit_open', url=self.instance_url, kind=kind, failures=self.failures,
+                          reset_timeout=self.reset_timeout, note='实例持续失败，暂停向其提交')
+            elif self.opened_at is not None:
+                # 半开试探失败，重新计时
+                self.opened_at = time.time()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(instance_url):
+    """返回实例对应的熔断器（同一进程内共享）"""
+    with _circuit_breakers_lock:
+        if instance_url not in _circuit_breakers:
+            _circuit_breakers[instance_url] = CircuitBreaker(instance_url)
+        return _circuit_breakers[instance_url]
+
+def _http_status(exc):
+    """从 requests 的异常中取出HTTP状态码"""
+    response = getattr(exc, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return response.status_code
+    return None
+
+def _http_path(exc, instance_url=None):
+    """出错请求的URL：管理API返回 ('api', 路径)，实例上的请求返回 ('instance', 路径)，取不到时返回 (None, None)"""
+    response = getattr(exc, 'response', None)
+    url = getattr(response, 'url', None) or getattr(getattr(exc, 'request', None), 'url', None)
+    if not url:
+        return None, None
+    if url.startswith(RUNCOMFY_API_BASE):
+        return 'api', url[len(RUNCOMFY_API_BASE):]
+    if instance_url and url.startswith(instance_url):
+        return 'instance', urllib.parse.urlparse(url).path
+    return None, urllib.parse.urlparse(url).path
+
+# 单个资源的 404：实例还在时按这些路径重试（history 和输出文件可能晚于执行完成才可见），其余视为请求错误
+RETRYABLE_NOT_FOUND = ('/history', '/view')
+
+def classify_error(exc, instance_url=None, probe=True):
+    """把异常归入失败类别
+
+    404/410 只有来自管理API或实例根路径时才说明实例不在了；
+    /view、/history 等单个资源的 404 先探测实例，实例还在时按资源类型归为瞬时故障或请求错误。
+
+    参数:
+        exc (Exception): 异常
+        instance_url (str): 出错的实例，连接失败或资源 404 时用于探测实例是否还在
+        probe (bool): 是否探测 /system_stats 区分网络抖动/资源缺失和实例已停止
+
+    返回:
+        str: 失败类别 ERROR_*
+    """
+    if isinstance(exc, RunComfyError):
+        return exc.kind
+    if isinstance(exc, (FileNotFoundError, ValueError, KeyError, json.JSONDecodeError)):
+        return ERROR_VALIDATION
+
+    status = _http_status(exc)
+    if status:
+        if status in (408, 429) or status >= 500:
+            return ERROR_TRANSIENT
+        if status in (404, 410):
+            source, path = _http_path(exc, instance_url)
+            if source == 'api' or path in ('', '/', '/system_stats'):
+                return ERROR_INSTANCE_GONE
+            if probe and instance_url and runcomfy_service.check_health(instance_url, timeout=5) is None:
+                return ERROR_INSTANCE_GONE
+            if path and path.startswith(RETRYABLE_NOT_FOUND):
+                return ERROR_TRANSIENT
+        return ERROR_VALIDATION
+
+    if isinstance(exc, (requests.Timeout, TimeoutError)):
+        return ERROR_TRANSIENT
+    if isinstance(exc, (requests.ConnectionError, ConnectionError, OSError)):
+        if probe and instance_url and runcomfy_service.check_health(instance_url, timeout=5) is None:
+            return ERROR_INSTANCE_GONE
+        return ERROR_TRANSIENT
+    return ERROR_TRANSIENT
+
+class RetryPolicy:
+    """统一的重试策略：按失败类别决定是否重试、等多久，并配合实例熔断器
+
+    - transient: 指数退避 + 抖动，最多 max_attempts 次
+    - timeout / execution_error: 不等待，最多再提交一次
+    - validation / instance_gone: 不重试
+    """
+
+    def __init__(self, max_attempts=4, base_delay=5, max_delay=60, jitter=0.5, retry_limits=None):
+        """
+        参数:
+            max_attempts (int): 总尝试次数上限（含第一次）
+            base_delay (float): 退避基数(秒)，第n次重试等待 base_delay·2^(n-1)
+            max_delay (float): 单次等待上限(秒)
+            jitter (float): 抖动比例，实际等待在 [1-jitter, 1] 倍之间随机
+            retry_limits (dict): 覆盖各类别允许的重试次数
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_limits = {
+            ERROR_TRANSIENT: max_attempts - 1,
+            ERROR_TIMEOUT: 1,
+            ERROR_EXECUTION: 1,
+            ERROR_VALIDATION: 0,
+            ERROR_INSTANCE_GONE: 0,
+            ERROR_CIRCUIT_OPEN: 0,
+        }
+        self.retry_limits.update(retry_limits or {})
+
+    def backoff(self, kind, retries):
+        """第 retries 次重试前的等待秒数；只有瞬时故障需要退避"""
+        if kind != ERROR_TRANSIENT:
+            return 0
+        delay = min(self.max_delay, self.base_delay * (2 ** (retries - 1)))
+        return delay * (1 - self.jitter * random.random())
+
+    def decide(self, kind, attempt, retries_by_kind):
+        """决定是否重试
+
+        参数:
+            kind (str): 失败类别
+            attempt (int): 已完成的尝试次数
+            retries_by_kind (dict): 各类别已重试次数（会被更新）
+
+        返回:
+            float: 重试前等待的秒数；不再重试时返回None
+        """
+        retries = retries_by_kind.get(kind, 0)
+        if attempt >= self.max_attempts or retries >= self.retry_limits.get(kind, 0):
+            return None
+        retries_by_kind[kind] = retries + 1
+        return self.backoff(kind, retries + 1)
+
+    def check_breaker(self, breaker, instance_url, description, attempt):
+        """每次尝试前检查熔断器，熔断中直接放弃"""
+        if not breaker.allow():
+            log_event('retry_give_up', url=instance_url, operation=description, kind=ERROR_CIRCUIT_OPEN, attempt=attempt)
+            raise RunComfyError(f"实例熔断中，跳过{description}: {instance_url}", kind=ERROR_CIRCUIT_OPEN)
+
+    def after_failure(self, exc, kind, breaker, attempt, retries_by_kind, instance_url, description):
+        """记录一次失败并决定是否重试
+
+        返回:
+            float: 重试前等待的秒数；放弃时抛出 RunComfyError
+        """
+        breaker.record_failure(kind)
+        delay = self.decide(kind, attempt, retries_by_kind)
+        if delay is None:
+            log_event('retry_give_up', url=instance_url, operation=description, kind=kind, attempt=attempt, error=str(exc))
+            if isinstance(exc, RunComfyError):
+                raise exc
+            raise RunComfyError(f"{description}失败 ({kind}): {exc}", kind=kind) from exc
+        log_event('retry', url=instance_url, operation=description, kind=kind, attempt=attempt,
+                  delay=round(delay, 1), error=str(exc))
+        return delay
+
+    def call(self, func, instance_url, description='', probe=True):
+        """按策略执行 func(attempt)，返回其结果；放弃时抛出 RunComfyError
+
+        异步版本见 runcomfy_async.retry_async，两者共用 check_breaker / after_failure。
+
+        参数:
+            func (callable): 接收尝试序号(从1开始)的函数
+            instance_url (str): 目标实例，用于熔断
+            description (str): 操作描述，写入事件日志
+            probe (bool): 连接失败时是否探测实例
+        """
+        breaker = get_circuit_breaker(instance_url)
+        retries_by_kind = {}
+        attempt = 0
+        while True:
+            attempt += 1
+            self.check_breaker(breaker, instance_url, description, attempt)
+            try:
+                result = func(attempt)
+                breaker.record_success()
+                return result
+            except Exception as e:
+                kind = classify_error(e, instance_url, probe=probe)
+                delay = self.after_failure(e, kind, breaker, attempt, retries_by_kind, instance_url, description)
+                if delay:
+                    time.sleep(delay)
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+def _execution_error_message(entry):
+    """从 history 记录的状态消息中取出执行错误描述"""
+    for message_type, data in (entry.get('status') or {}).get('messages', []):
+        if message_type == 'execution_error':
+            return f"{data.get('node_type', '')}#{data.get('node_id', '')}: {data.get('exception_message', '').strip()}"
+        if message_type == 'execution_interrupted':
+            return "执行被中断"
+    return "执行失败，没有输出"
+
+def _execution_start_time(entry):
+    """history 记录中 execution_start 消息的时间（epoch秒），没有时返回None"""
+    for message_type, data in (entry.get('status') or {}).get('messages', []):
+        if message_type == 'execution_start' and data.get('timestamp'):
+            return data['timestamp'] / 1000
+    return None
+
+def run_async(coro):
+    """在同步代码中执行 runcomfy_async 的协程
+
+    每次调用使用一个新的事件循环，线程池的工作线程里也可以直接调用；已在事件循环中的代码应直接 await。
+    """
+    import asyncio
+    return asyncio.run(coro)
+
+def runcomfy_workflow(workflow_json, inputs, instance_url, verify_ssl=False, max_retries=None, retry_policy=None, timeout=600, front=False):
     """执行RunComfy工作流
     
     参数:
@@ -375,170 +1593,90 @@ def runcomfy_workflow(workflow_json, inputs, instance_url, verify_ssl=False, max
         inputs (dict): 输入配置
         instance_url (str): ComfyUI实例URL
         verify_ssl (bool): SSL验证
-        max_retries (int): 最大重试次数
+        max_retries (int): 最大尝试次数，未指定 retry_policy 时使用
+        retry_policy (RetryPolicy): 重试策略，默认 DEFAULT_RETRY_POLICY
+        timeout (int): 单次执行的超时时间(秒)
+        front (bool): 插到 ComfyUI 队列最前面（加急任务），不影响正在执行的任务
         
     返回:
-        dict: 包含生成文件信息的字典
+        dict: outputs 生成文件信息；prompt_id 任务ID；queue_seconds 在 ComfyUI 队列中等待的秒数（history 有 execution_start 时）
     """
-    headers = {'Authorization': f'Bearer {RUNCOMFY_API_TOKEN}'}
-    
-    # 加载工作流
-    if isinstance(workflow_json, str):
-        with open(workflow_json, 'r', encoding='utf-8') as f:
-            workflow = json.load(f)
-    else:
-        workflow = workflow_json
-    
-    for attempt in range(max_retries):
-        try:
-            print(f"执行工作流 (第 {attempt + 1}/{max_retries} 次尝试)...")
-            client_id = str(uuid.uuid4())
-            
-            # 处理输入
-            if inputs:
-                print("正在处理工作流输入...")
-                for node_id, input_data in inputs.items():
-                    if node_id not in workflow:
-                        print(f"警告: 节点ID {node_id} 不在工作流中")
-                        continue
-                        
-                    input_type = input_data.get('type')
-                    
-                    if input_type in ['image', 'text_and_image']:
-                        # 上传图片
-                        image_path = input_data.get('image_path', input_data.get('path'))
-                        print(f"上传图片: {os.path.basename(image_path)}")
-                        upload_url = f"{instance_url}/upload/image"
-                        files = [('image', (os.path.basename(image_path), 
-                                open(image_path, 'rb'), 
-                                'application/octet-stream'))]
-                        
-                        try:
-                            upload_response = requests.post(
-                                upload_url, 
-                                headers=headers, 
-                                data={'overwrite': 'true'}, 
-                                files=files, 
-                                verify=verify_ssl,
-                                timeout=60
-                            )
-                            upload_response.raise_for_status()
-                            print(f"图片上传成功")
-                        except Exception as e:
-                            print(f"图片上传失败: {e}")
-                            raise
-                            
-                        workflow[node_id]['inputs']['image'] = os.path.basename(image_path)
-                        
-                    if input_type in ['text', 'text_and_image', 'text_and_images']:
-                        workflow[node_id]['inputs']['text'] = input_data['text']
-            
-            # 提交工作流
-            print("正在提交工作流...")
-            prompt_url = f"{instance_url}/prompt"
-            try:
-                response = requests.post(
-                    prompt_url,
-                    headers=headers,
-                    json={"prompt": workflow, "client_id": client_id},
-                    verify=verify_ssl,
-                    timeout=30
-                )
-                response.raise_for_status()
-                prompt_id = response.json()['prompt_id']
-                print(f"工作流提交成功，prompt_id={prompt_id}")
-            except Exception as e:
-                print(f"工作流提交失败: {e}")
-                raise
-            
-            # 等待执行完成
-            print("等待工作流执行完成...")
-            history_url = f"{instance_url}/history/{prompt_id}"
-            start_time = time.time()
-            
-            while time.time() - start_time < 600:  # 10分钟超时
-                try:
-                    response = requests.get(history_url, headers=headers, verify=verify_ssl, timeout=15)
-                    response.raise_for_status()
-                    history_data = response.json()
-                    
-                    if prompt_id in history_data:
-                        outputs = history_data[prompt_id].get('outputs')
-                        if outputs:
-                            print(f"工作流执行完成，用时 {time.time() - start_time:.1f} 秒")
-                            return {'outputs': outputs}
-                    
-                    print("工作流正在执行中...")
-                    time.sleep(3)
-                        
-                except Exception as e:
-                    print(f"检查工作流状态失败: {e}")
-                    time.sleep(5)
-            
-            raise Exception("工作流执行超时 (10分钟)")
-            
-        except Exception as e:
-            print(f"执行失败: {e}")
-            if attempt < max_retries - 1:
-                wait_time = 5 * (2 ** attempt)  # 5, 10, 20...
-                print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
-            else:
-                print("达到最大重试次数，操作失败")
-                raise
+    from runcomfy_async import AsyncRunComfyClient
+    client = AsyncRunComfyClient(instance_url, verify_ssl)
+    return run_async(client.run_workflow(workflow_json, inputs, max_retries=max_retries, retry_policy=retry_policy,
+                                         timeout=timeout, front=front))
+
+def runcomfy_upload_image(instance_url, image_path, upload_name=None, verify_ssl=False):
+    """上传图片到实例（覆盖同名文件），返回实例上的文件名；AsyncRunComfyClient.upload_image 的同步包装"""
+    from runcomfy_async import AsyncRunComfyClient
+    return run_async(AsyncRunComfyClient(instance_url, verify_ssl).upload_image(image_path, upload_name))
+
+def output_file_path(save_dir, output_name, idx, count, filename):
+    """按下载序号生成输出文件路径，多张图时追加 _序号"""
+    ext = filename.split('.')[-1]
+    return os.path.join(
+        save_dir, 
+        f"{output_name}_{idx + 1}.{ext}" if count > 1 
+        else f"{output_name}.{ext}"
+    )
+
+# WebP 输出每帧的时长（毫秒）。编码器会把相同的相邻帧合并成一帧、时长加倍，解码时按时长还原张数
+WEBP_FRAME_MS = 1000
+
+def webp_outputs(workflow, node_ids, lossless=True, quality=100):
+    """把工作流中声明的 SaveImage 输出节点换成 SaveAnimatedWEBP，在实例上直接保存无损 WebP
+
+    单张图就是普通 WebP，批量时每张图是一帧；无损模式下像素与 PNG 完全一致，文件约小一半，
+    下载后由 runcomfy_download_outputs 在本地解码回 PNG（不再带 ComfyUI 写在 PNG 里的工作流元数据）。
+    """
+    for node_id in node_ids:
+        node = workflow.get(node_id)
+        if not node or node.get('class_type') != 'SaveImage':
+            continue
+        workflow[node_id] = dict(node, class_type='SaveAnimatedWEBP', inputs={
+            'images': node['inputs']['images'],
+            'filename_prefix': node['inputs'].get('filename_prefix', 'ComfyUI'),
+            'fps': 1000 / WEBP_FRAME_MS,
+            'lossless': lossless,
+            'quality': quality,
+            'method': 'default',
+        })
+    return workflow
 
-def runcomfy_download_outputs(outputs, instance_url, save_dir, output_name, verify_ssl=False):
+def decode_webp_frames(content):
+    """把下载的 WebP（可能是多帧）解码成 RGB 图片列表，被合并的相同帧按帧时长还原"""
+    frames = []
+    with Image.open(io.BytesIO(content)) as image:
+        frame_count = getattr(image, 'n_frames', 1)
+        for index in range(frame_count):
+            image.seek(index)
+            repeat = max(1, round(image.info.get('duration', WEBP_FRAME_MS) / WEBP_FRAME_MS))
+            frames.extend([image.convert('RGB')] * repeat)
+    return frames
+
+def runcomfy_download_outputs(outputs, instance_url, save_dir, output_name, verify_ssl=False, retry_policy=None, output_nodes=None, stats=None):
     """下载RunComfy工作流的输出文件
     
+    只下载 output_nodes 中声明的节点，type 为 temp 的预览图一律跳过；文件按下载顺序统一编号，
+    多个节点有输出时也不会重名。WebP 输出（webp_outputs）在本地解码成 PNG 保存。
+    
     参数:
         outputs (dict): 工作流输出数据
         instance_url (str): ComfyUI实例URL
         save_dir (str): 保存目录
         output_name (str): 输出文件名前缀
         verify_ssl (bool): SSL验证
+        retry_policy (RetryPolicy): 单个文件下载的重试策略，默认 DEFAULT_RETRY_POLICY
+        output_nodes (list): 真正的输出节点ID，None 表示所有节点
+        stats (dict): 传入时填入 bytes（下载字节数）、seconds（下载耗时）、decode_seconds（本地解码耗时）、skipped（跳过的图片数）
         
     返回:
         list: 保存的文件路径列表
     """
-    headers = {'Authorization': f'Bearer {RUNCOMFY_API_TOKEN}'}
-    os.makedirs(save_dir, exist_ok=True)
-    saved_files = []
-    
-    for node_id, node_output in outputs.items():
-        if 'images' in node_output:
-            for idx, image in enumerate(node_output['images']):
-                params = {
-                    "filename": image['filename'],
-                    "subfolder": image.get('subfolder', ''),
-                    "type": image.get('type', 'output')
-                }
-                url = f"{instance_url}/view?{urllib.parse.urlencode(params)}"
-                
-                try:
-                    print(f"下载文件 {idx+1}/{len(node_output['images'])}: {image['filename']}")
-                    response = requests.get(url, headers=headers, verify=verify_ssl, timeout=30)
-                    response.raise_for_status()
-                    
-                    ext = image['filename'].split('.')[-1]
-                    file_path = os.path.join(
-                        save_dir, 
-                        f"{output_name}_{idx + 1}.{ext}" if len(node_output['images']) > 1 
-                        else f"{output_name}.{ext}"
-                    )
-                    
-                    with open(file_path, "wb") as f:
-                        f.write(response.content)
-                    saved_files.append(file_path)
-                    print(f"文件已保存: {file_path}")
-                except Exception as e:
-                    print(f"下载文件失败: {e}")
-                    raise
-                    
-    if not saved_files:
-        raise Exception("没有生成任何文件")
-        
-    print(f"成功下载了 {len(saved_files)} 个文件")
-    return saved_files
+    from runcomfy_async import AsyncRunComfyClient
+    client = AsyncRunComfyClient(instance_url, verify_ssl)
+    return run_async(client.download_outputs(outputs, save_dir, output_name, retry_policy=retry_policy,
+                                             output_nodes=output_nodes, stats=stats))
 
 def calculate_billable_minutes(duration_minutes, startup_time=5):
     """计算实际计费时间（扣除机器启动时间）
@@ -551,3 +1689,10 @@ def calculate_billable_minutes(duration_minutes, startup_time=5):
     - 实际计费时间（分钟）
     """
     return max(0, duration_minutes - startup_time)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'reap':
+        reap_idle_instance(
+            instance_file=sys.argv[2] if len(sys.argv) > 2 else ".runcomfy_instance",
+            price_per_hour=float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+        )
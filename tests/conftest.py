@@ -0,0 +1,68 @@
+'''
+File: tests/conftest.py
+Project: green
+Created: 2026-10-19 23:05:12
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 测试公共配置：启动本地模拟服务器并让 runcomfy_utils 指向它，事件日志和计费明细写到临时目录
+'''
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from runcomfy_fake_server import start_fake_server, fake_server_env
+
+# 模拟参数：耗时和输出尺寸都缩小，整套测试几十秒内跑完
+FAKE_CONFIG = {
+    'boot_seconds': 0.2,
+    'gen_seconds': 0.2,
+    'upscale_seconds': 0.3,
+    'model_upscale_seconds': 0.1,
+    'load_seconds': 0.05,
+    'gen_size': (256, 256),
+    'upscale_size': (512, 512),
+}
+
+# 必须在导入 runcomfy_utils 之前设置环境变量，它在导入时读取API地址
+_server, _state, _base_url = start_fake_server(**FAKE_CONFIG)
+os.environ.update(fake_server_env(_base_url))
+
+import runcomfy_utils
+import child_book_utils
+
+@pytest.fixture(scope='session')
+def fake_server():
+    """整个测试会话共用的模拟服务器: (server, state, base_url)"""
+    yield _server, _state, _base_url
+    _server.shutdown()
+
+@pytest.fixture
+def start_server():
+    """按需启动额外的模拟服务器（例如全部执行出错的实例），测试结束后停止"""
+    servers = []
+
+    def start(**config):
+        server, state, base_url = start_fake_server(**dict(FAKE_CONFIG, **config))
+        servers.append(server)
+        return server, state, base_url
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture(autouse=True)
+def isolated_logs(tmp_path, monkeypatch):
+    """事件日志、计费明细和实例文件写到临时目录，熔断器每个测试重新开始"""
+    event_log = str(tmp_path / 'runcomfy-events.csv')
+    monkeypatch.setattr(runcomfy_utils, 'EVENT_LOG_PATH', event_log)
+    monkeypatch.setattr(child_book_utils, 'EVENT_LOG_PATH', event_log)
+    monkeypatch.setattr(runcomfy_utils, 'COST_LOG_PATH', str(tmp_path / 'runcomfy-cost.csv'))
+    monkeypatch.setattr(runcomfy_utils.runcomfy_service, 'instance_file', str(tmp_path / '.runcomfy_instance'))
+    runcomfy_utils._circuit_breakers.clear()
+    yield event_log
+    runcomfy_utils._circuit_breakers.clear()
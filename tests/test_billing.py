@@ -0,0 +1,76 @@
+'''
+File: tests/test_billing.py
+Project: green
+Created: 2026-10-19 23:26:31
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 计费表结算：启动耗时、任务时间段并集、空闲时长、按耗时分摊费用和场景汇总、复用实例
+'''
+
+import csv
+import os
+import time
+
+import pytest
+
+import runcomfy_utils
+from runcomfy_utils import BillingMeter
+
+@pytest.fixture
+def meter():
+    meter = BillingMeter(price_per_hour=3.6)
+    yield meter
+    for server in meter.servers.values():
+        runcomfy_utils._billing_meters.pop(server['url'], None)
+
+def test_settle_new_instance(meter, isolated_logs):
+    now = time.time()
+    url = 'http://billing-new'
+    meter.server_started({'url': url, 'server_id': 's1', 'created_at': now - 1000, 'ready_at': now - 900})
+    # 两个任务重叠 100 秒，忙碌时长取并集 500 秒
+    meter.add_job('watercolor', url, now - 800, now - 500, 4, 'P01_scene_1')
+    meter.add_job('watercolor', url, now - 600, now - 300, 4, 'P01_scene_2')
+    meter.add_job('upscale', url, now - 200, now - 100, 1, 'P02_other')
+    meter.server_stopped('s1', ok=True, note='stop')
+
+    report = meter.settle('gen')
+    assert report['billed_seconds'] == pytest.approx(1000, abs=1)
+    assert report['boot_seconds'] == pytest.approx(100, abs=1)
+    assert report['busy_seconds'] == pytest.approx(600, abs=1)
+    assert report['idle_seconds'] == pytest.approx(300, abs=1)
+    assert report['cost'] == pytest.approx(1.0, rel=1e-3)
+    assert report['images'] == 9
+    assert report['cost_per_image'] == pytest.approx(1.0 / 9, rel=1e-3)
+
+    # 费用按任务耗时（300/300/100）分摊，同一场景的候选合并
+    assert [job['cost'] for job in report['jobs']] == pytest.approx([3 / 7, 3 / 7, 1 / 7], rel=1e-3)
+    assert report['scenes'] == pytest.approx({'P01_scene': 6 / 7, 'P02_other': 1 / 7}, rel=1e-3)
+
+    with open(runcomfy_utils.COST_LOG_PATH, encoding='utf-8') as f:
+        assert len(list(csv.reader(f))) == 4
+    with open(isolated_logs, encoding='utf-8') as f:
+        events = f.read()
+    assert 'billing_settle' in events
+    assert 'billing_idle' in events
+
+def test_settle_reused_instance_bills_from_acquire(meter):
+    now = time.time()
+    url = 'http://billing-reused'
+    meter.server_started({'url': url, 'server_id': 's2', 'created_at': now - 7200, 'ready_at': now - 7100}, reused=True)
+    time.sleep(0.05)
+    meter.add_job('upscale', url, time.time() - 0.04, time.time(), 1, 'P03')
+    meter.server_stopped('s2', ok=False)
+
+    report = meter.settle('upscale')
+    assert report['boot_seconds'] == 0
+    assert report['billed_seconds'] < 5
+    assert meter.servers['s2']['note'] == 'stop_failed'
+
+def test_settle_without_jobs(meter):
+    now = time.time()
+    meter.server_started({'url': 'http://billing-idle', 'server_id': 's3', 'created_at': now - 60, 'ready_at': now - 30})
+    report = meter.settle('queue')
+    assert report['jobs'] == [] and report['images'] == 0
+    assert report['cost_per_image'] is None
+    assert report['idle_seconds'] == pytest.approx(30, abs=1)
+    assert not os.path.exists(runcomfy_utils.COST_LOG_PATH)
@@ -0,0 +1,133 @@
+'''
+File: tests/test_queue.py
+Project: green
+Created: 2026-10-19 23:38:22
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 多项目任务队列：优先级、按权重公平分配、失败重排，以及扫描工作区后在模拟服务器上跑完整个队列
+'''
+
+import os
+import threading
+import time
+
+from PIL import Image
+
+import child_book_utils
+import child_book_q_queue as q
+from child_book_q_queue import FairShareQueue, QUEUE_MAX_ATTEMPTS
+
+def take(job_queue, seconds=0.0, ok=True):
+    """取一个任务并立即按给定GPU秒数结束，返回任务"""
+    job = job_queue.next(timeout=0)
+    job_queue.done(job, seconds, ok=ok)
+    return job
+
+def test_higher_priority_class_always_first():
+    job_queue = FairShareQueue()
+    job_queue.add('a', 'upscale', 'A_1', None, 'bulk')
+    job_queue.add('b', 'gen', 'B', None, 'interactive')
+    job_queue.add('a', 'retry', 'A', None, 'urgent')
+    assert [take(job_queue)['name'] for _ in range(3)] == ['A', 'B', 'A_1']
+    assert job_queue.next(timeout=0) is None
+    assert job_queue.idle()
+
+def test_add_deduplicates():
+    job_queue = FairShareQueue()
+    assert job_queue.add('a', 'gen', 'P01', None)
+    assert not job_queue.add('a', 'gen', 'P01', None)
+    assert job_queue.add('a', 'retry', 'P01', None)
+    assert job_queue.progress['a']['total'] == 2
+
+def test_fair_share_follows_weights():
+    job_queue = FairShareQueue({'big': 2})
+    for index in range(6):
+        job_queue.add('big', 'gen', f'big{index}', None, 'interactive')
+        job_queue.add('small', 'gen', f'small{index}', None, 'interactive')
+    order = [take(job_queue, seconds=10)['project'] for _ in range(6)]
+    # 权重 2 的项目分到约两倍的GPU时间
+    assert order.count('big') == 4 and order.count('small') == 2
+    assert job_queue.usage == {'big': 40, 'small': 20}
+
+def test_running_job_counts_toward_share():
+    job_queue = FairShareQueue()
+    for name in ('a1', 'a2'):
+        job_queue.add('a', 'gen', name, None, 'interactive')
+    job_queue.add('b', 'gen', 'b1', None, 'interactive')
+    first = job_queue.next(timeout=0)
+    time.sleep(0.01)
+    # a 的任务还在执行，下一个任务给 b
+    assert first['project'] == 'a'
+    assert job_queue.next(timeout=0)['project'] == 'b'
+
+def test_failed_job_is_requeued_then_counted_failed():
+    job_queue = FairShareQueue()
+    job_queue.add('a', 'gen', 'P01', None, 'interactive')
+    job_queue.add('a', 'gen', 'P02', None, 'interactive')
+    job = take(job_queue, seconds=5, ok=False)
+    assert job['name'] == 'P01' and job['requeued']
+    assert job_queue.progress['a']['failed'] == 0
+
+    # 重排到本项目队尾
+    assert take(job_queue)['name'] == 'P02'
+    job = take(job_queue, ok=False)
+    assert job['name'] == 'P01' and job['attempts'] == QUEUE_MAX_ATTEMPTS and not job['requeued']
+    assert job_queue.progress['a'] == {'total': 2, 'done': 1, 'failed': 1, 'images': 0, 'seconds': 5}
+    # 排队时间只在第一次开始时统计
+    assert job_queue.class_stats['interactive']['jobs'] == 2
+    assert job_queue.idle()
+
+def test_next_waits_for_new_job():
+    job_queue = FairShareQueue()
+    threading.Timer(0.1, job_queue.add, args=('a', 'gen', 'late', None)).start()
+    assert job_queue.next(timeout=0.05) is None
+    assert job_queue.next(timeout=2)['name'] == 'late'
+
+def write_workspace(workspace):
+    """一本书：Gen 表两个场景（一个已有候选图并被挑中），Retry 表一个返工场景"""
+    os.makedirs(workspace['gen_dir'])
+    with open(workspace['gen_csv'], 'w', encoding='utf-8-sig') as f:
+        f.write('file name,style,final prompt,pick\nP01,watercolor,a fox,2\nP02,flat,a bear,\n')
+    with open(workspace['retry_csv'], 'w', encoding='utf-8-sig') as f:
+        f.write('file name,style,final prompt\nP03,flat,a cat\n')
+    for index in (1, 2):
+        Image.new('RGB', (64, 64), (30, 90, 160)).save(os.path.join(workspace['gen_dir'], f'P01_{index}.png'))
+
+def test_queue_runs_workspace_on_fake_server(fake_server, tmp_path, monkeypatch):
+    _, state, base_url = fake_server
+    monkeypatch.setattr(child_book_utils, 'WORKSPACES_PATH', str(tmp_path / 'projects'))
+    workspace = child_book_utils.get_workspace('book')
+    write_workspace(workspace)
+
+    job_queue = FairShareQueue()
+    assert q.scan_workspace(workspace, job_queue) == 3
+    assert q.scan_workspace(workspace, job_queue) == 0
+
+    prompts = []
+    submit = state.submit
+
+    def record_submit(prompt, client_id, front=False):
+        prompts.append(front)
+        return submit(prompt, client_id, front)
+    monkeypatch.setattr(state, 'submit', record_submit)
+
+    stop_event = threading.Event()
+    thread = threading.Thread(target=q.worker, args=('实例1', lambda: base_url, job_queue, {'book': workspace}, stop_event))
+    thread.start()
+    try:
+        deadline = time.time() + 120
+        while not job_queue.idle() and time.time() < deadline:
+            time.sleep(0.2)
+    finally:
+        stop_event.set()
+        thread.join()
+
+    progress = job_queue.progress['book']
+    assert progress['done'] == 3 and progress['failed'] == 0
+    # 返工和新场景插队提交，批量放大按顺序排队
+    assert prompts == [True, True, False]
+    assert sorted(os.listdir(workspace['retry_dir'])) == ['P03_1.png', 'P03_2.png']
+    assert sorted(os.listdir(workspace['gen_dir'])) == ['P01_1.png', 'P01_2.png', 'P02_1.png', 'P02_2.png']
+    assert os.listdir(workspace['upscale_dir']) == ['P01_2.png']
+    # 放大完成后不再重复加入
+    assert q.scan_workspace(workspace, FairShareQueue()) == 0
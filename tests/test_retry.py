@@ -0,0 +1,128 @@
+'''
+File: tests/test_retry.py
+Project: green
+Created: 2026-10-19 23:20:05
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 失败分类、熔断器和重试策略：资源 404 与实例已停止的区分、按类别的重试次数、熔断的打开和半开
+'''
+
+import time
+
+import pytest
+import requests
+
+import runcomfy_utils
+from runcomfy_utils import (RunComfyError, CircuitBreaker, RetryPolicy, classify_error, get_circuit_breaker,
+                            ERROR_TRANSIENT, ERROR_TIMEOUT, ERROR_EXECUTION, ERROR_VALIDATION,
+                            ERROR_INSTANCE_GONE, ERROR_CIRCUIT_OPEN)
+
+def http_error(url):
+    """对 url 发请求并返回 raise_for_status 抛出的异常"""
+    response = requests.get(url, timeout=5)
+    with pytest.raises(requests.HTTPError) as excinfo:
+        response.raise_for_status()
+    return excinfo.value
+
+def test_missing_output_file_on_live_instance_is_transient(fake_server):
+    _, _, base_url = fake_server
+    exc = http_error(f"{base_url}/view?filename=missing.png&type=output")
+    assert exc.response.status_code == 404
+    assert classify_error(exc, base_url) == ERROR_TRANSIENT
+
+def test_missing_server_in_management_api_is_gone(fake_server):
+    _, _, base_url = fake_server
+    exc = http_error(f"{runcomfy_utils.RUNCOMFY_API_BASE}/users/fake-user/servers/no-such-server")
+    assert classify_error(exc, base_url, probe=False) == ERROR_INSTANCE_GONE
+
+def test_connection_error_to_stopped_instance_is_gone(start_server):
+    server, _, base_url = start_server()
+    server.shutdown()
+    server.server_close()
+    with pytest.raises(requests.ConnectionError) as excinfo:
+        requests.get(f"{base_url}/history/abc", timeout=5)
+    assert classify_error(excinfo.value, base_url) == ERROR_INSTANCE_GONE
+    assert classify_error(excinfo.value, base_url, probe=False) == ERROR_TRANSIENT
+
+@pytest.mark.parametrize('exc, kind', [
+    (RunComfyError('boom', kind=ERROR_EXECUTION), ERROR_EXECUTION),
+    (ValueError('bad input'), ERROR_VALIDATION),
+    (FileNotFoundError('x.png'), ERROR_VALIDATION),
+    (requests.Timeout('slow'), ERROR_TRANSIENT),
+])
+def test_classify_without_http_response(exc, kind):
+    assert classify_error(exc, probe=False) == kind
+
+def test_breaker_opens_after_threshold_and_half_opens():
+    breaker = CircuitBreaker('http://instance', failure_threshold=3, reset_timeout=0.2)
+    breaker.record_failure(ERROR_TRANSIENT)
+    breaker.record_failure(ERROR_TRANSIENT)
+    assert breaker.state == 'closed'
+    breaker.record_failure(ERROR_TRANSIENT)
+    assert breaker.state == 'open' and not breaker.allow()
+
+    time.sleep(0.25)
+    assert breaker.state == 'half_open' and breaker.allow()
+    # 半开试探失败重新打开，成功则关闭
+    breaker.record_failure(ERROR_TRANSIENT)
+    assert breaker.state == 'open'
+    time.sleep(0.25)
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+def test_breaker_opens_immediately_when_instance_gone_and_ignores_validation():
+    breaker = CircuitBreaker('http://instance')
+    for _ in range(5):
+        breaker.record_failure(ERROR_VALIDATION)
+    assert breaker.state == 'closed' and breaker.failures == 0
+    breaker.record_failure(ERROR_INSTANCE_GONE)
+    assert breaker.state == 'open'
+
+def test_decide_limits_retries_by_kind():
+    policy = RetryPolicy(max_attempts=4, base_delay=1, max_delay=60, jitter=0)
+    retries = {}
+    assert policy.decide(ERROR_TRANSIENT, 1, retries) == 1
+    assert policy.decide(ERROR_TRANSIENT, 2, retries) == 2
+    assert policy.decide(ERROR_TRANSIENT, 3, retries) == 4
+    assert policy.decide(ERROR_TRANSIENT, 4, retries) is None
+
+    retries = {}
+    assert policy.decide(ERROR_TIMEOUT, 1, retries) == 0
+    assert policy.decide(ERROR_TIMEOUT, 2, retries) is None
+    assert policy.decide(ERROR_EXECUTION, 2, retries) == 0
+    assert policy.decide(ERROR_VALIDATION, 1, {}) is None
+    assert policy.decide(ERROR_INSTANCE_GONE, 1, {}) is None
+
+def test_call_retries_transient_then_succeeds():
+    policy = RetryPolicy(max_attempts=4, base_delay=0.01, max_delay=0.01)
+    attempts = []
+
+    def flaky(attempt):
+        attempts.append(attempt)
+        if attempt < 3:
+            raise requests.Timeout('slow')
+        return 'ok'
+    assert policy.call(flaky, 'http://flaky', 'test', probe=False) == 'ok'
+    assert attempts == [1, 2, 3]
+    assert get_circuit_breaker('http://flaky').state == 'closed'
+
+def test_call_gives_up_on_validation_without_retry():
+    policy = RetryPolicy(max_attempts=4, base_delay=0.01)
+    attempts = []
+
+    def invalid(attempt):
+        attempts.append(attempt)
+        raise ValueError('node 999 missing')
+    with pytest.raises(RunComfyError) as excinfo:
+        policy.call(invalid, 'http://invalid', 'test', probe=False)
+    assert excinfo.value.kind == ERROR_VALIDATION
+    assert attempts == [1]
+
+def test_call_rejects_while_breaker_open():
+    breaker = get_circuit_breaker('http://down')
+    breaker.record_failure(ERROR_INSTANCE_GONE)
+    calls = []
+    with pytest.raises(RunComfyError) as excinfo:
+        RetryPolicy().call(calls.append, 'http://down', 'test', probe=False)
+    assert excinfo.value.kind == ERROR_CIRCUIT_OPEN
+    assert calls == []
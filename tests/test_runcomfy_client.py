@@ -0,0 +1,116 @@
+'''
+File: tests/test_runcomfy_client.py
+Project: green
+Created: 2026-10-19 23:12:40
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 对着模拟服务器跑工作流：提交、等待、下载（WebP解码、输出节点过滤）、并发、执行出错和校验失败
+'''
+
+import asyncio
+import copy
+import os
+
+import pytest
+from PIL import Image
+
+import runcomfy_utils
+from runcomfy_utils import (RunComfyError, RetryPolicy, ERROR_EXECUTION, ERROR_VALIDATION,
+                            runcomfy_workflow, runcomfy_download_outputs, runcomfy_upload_image, webp_outputs)
+from runcomfy_async import AsyncRunComfyClient
+from child_book_utils import (load_workflow_template, runcomfy_watercolor, runcomfy_upscale,
+                              GEN_OUTPUT_NODES, UPSCALE_OUTPUT_NODES)
+
+# 测试用的重试策略：不等待，执行出错只重提一次
+FAST_POLICY = RetryPolicy(max_attempts=2, base_delay=0.01, max_delay=0.01)
+
+def small_gen_workflow():
+    """一步、单张 64x64 的生图工作流，保留 SaveImage 输出节点"""
+    workflow = load_workflow_template('runcomfy_watercolor_api.json')
+    workflow["202"]["inputs"]["steps"] = 1
+    workflow["101"]["inputs"]["width_override"] = workflow["101"]["inputs"]["height_override"] = 64
+    workflow["101"]["inputs"]["batch_size"] = workflow["140"]["inputs"]["batch_size"] = 1
+    return workflow
+
+def make_image(path, size=(96, 64)):
+    Image.new('RGB', size, (200, 120, 40)).save(path)
+    return str(path)
+
+def test_workflow_returns_outputs_and_queue_seconds(fake_server):
+    _, _, base_url = fake_server
+    result = runcomfy_workflow(small_gen_workflow(), {}, base_url, retry_policy=FAST_POLICY)
+    assert result['prompt_id']
+    assert set(GEN_OUTPUT_NODES) <= set(result['outputs'])
+    assert result['queue_seconds'] >= 0
+
+def test_download_filters_output_nodes_and_decodes_webp(fake_server, tmp_path):
+    _, _, base_url = fake_server
+    workflow = webp_outputs(small_gen_workflow(), GEN_OUTPUT_NODES)
+    result = runcomfy_workflow(workflow, {}, base_url, retry_policy=FAST_POLICY)
+
+    # 混入一个不在 output_nodes 里的节点和一张 temp 预览图，都不应下载
+    outputs = copy.deepcopy(result['outputs'])
+    images = outputs[GEN_OUTPUT_NODES[0]]['images']
+    outputs['999'] = {'images': [dict(images[0])]}
+    outputs[GEN_OUTPUT_NODES[0]]['images'] = images + [dict(images[0], type='temp')]
+
+    stats = {}
+    saved = runcomfy_download_outputs(outputs, base_url, str(tmp_path), 'scene', output_nodes=GEN_OUTPUT_NODES, stats=stats)
+    assert saved == [str(tmp_path / 'scene.png')]
+    with Image.open(saved[0]) as image:
+        assert image.format == 'PNG'
+    assert stats['bytes'] > 0
+    assert stats['skipped'] == 2
+
+def test_concurrent_async_workflows(fake_server):
+    _, state, base_url = fake_server
+    before = state.stats['completed']
+    client = AsyncRunComfyClient(base_url)
+
+    async def run_all():
+        return await asyncio.gather(*(client.run_workflow(small_gen_workflow(), {}, retry_policy=FAST_POLICY)
+                                      for _ in range(3)))
+    results = asyncio.run(run_all())
+    assert len({result['prompt_id'] for result in results}) == 3
+    assert state.stats['completed'] - before == 3
+
+def test_execution_error_is_retried_once_then_raised(start_server):
+    _, state, base_url = start_server(error_rate=1.0)
+    with pytest.raises(RunComfyError) as excinfo:
+        runcomfy_workflow(small_gen_workflow(), {}, base_url, retry_policy=FAST_POLICY)
+    assert excinfo.value.kind == ERROR_EXECUTION
+    assert state.stats['failed'] == 2
+
+def test_broken_node_link_is_validation_error(fake_server):
+    _, state, base_url = fake_server
+    workflow = small_gen_workflow()
+    workflow[GEN_OUTPUT_NODES[0]]['inputs']['images'] = ['missing-node', 0]
+    prompts = state.stats['prompts']
+    with pytest.raises(RunComfyError) as excinfo:
+        runcomfy_workflow(workflow, {}, base_url, retry_policy=FAST_POLICY)
+    assert excinfo.value.kind == ERROR_VALIDATION
+    # 校验失败不重试，熔断器也不计数
+    assert state.stats['prompts'] == prompts
+    assert runcomfy_utils.get_circuit_breaker(base_url).failures == 0
+
+def test_upload_image(fake_server, tmp_path):
+    _, state, base_url = fake_server
+    image_path = make_image(tmp_path / 'input.png')
+    assert runcomfy_upload_image(base_url, image_path, 'slot_1.png') == 'slot_1.png'
+    assert 'slot_1.png' in state.uploads
+
+def test_watercolor_and_upscale_save_files(fake_server, tmp_path):
+    _, _, base_url = fake_server
+    gen_dir = tmp_path / 'gen'
+    saved = runcomfy_watercolor('a fox in the snow', base_url, batch_size=2, save_dir=str(gen_dir),
+                                output_name='P01_scene', steps=1, size=(64, 64))
+    assert sorted(os.path.basename(path) for path in saved) == ['P01_scene_1.png', 'P01_scene_2.png']
+
+    upscaled = runcomfy_upscale(saved[0], base_url, save_dir=str(tmp_path / 'upscaled'))
+    assert os.path.basename(upscaled) == 'P01_scene_1.png'
+    with Image.open(upscaled) as image:
+        assert image.size == (512, 512)
+
+def test_upscale_template_declares_output_node():
+    workflow = load_workflow_template('runcomfy_upscale_api.json')
+    assert all(workflow[node_id]['class_type'] == 'SaveImage' for node_id in UPSCALE_OUTPUT_NODES)
@@ -0,0 +1,87 @@
+'''
+File: tests/test_sheet.py
+Project: green
+Created: 2026-10-19 23:31:47
+Author: Victor Cheng
+Email: greenzorromail@gmail.com
+Description: 表格读取的边界情况，以及放大挑选（挑选文件和 Gen 表挑选列）与放大任务规划
+'''
+
+import os
+
+import pytest
+
+from child_book_utils import SheetError, read_sheet, load_picks, plan_upscale
+
+def write_text(path, text, encoding='utf-8'):
+    path.write_text(text, encoding=encoding)
+    return str(path)
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+    return str(path)
+
+def test_read_sheet_skips_bad_rows(tmp_path):
+    csv_path = write_text(tmp_path / 'gen.csv', (
+        ' file name ,style, final prompt ,seed\n'
+        'P01,watercolor, a fox ,12.0\n'
+        ',,,\n'
+        'P02,,a bear,3\n'
+        'P03,flat,a cat,abc\n'
+        'P01,flat,duplicate,4\n'
+        'P04,flat,"two\nlines",5\n'
+    ), encoding='utf-8-sig')
+    records = list(read_sheet(csv_path, ['file name', 'style', 'final prompt'], int_columns=['seed']))
+    assert [record['file name'] for record in records] == ['P01', 'P04']
+    assert records[0] == {'file name': 'P01', 'style': 'watercolor', 'final prompt': 'a fox', 'seed': 12, '_row': 2}
+    # 单元格内换行时行号按文件行计算
+    assert records[1]['_row'] == 8
+
+def test_read_sheet_short_rows_and_no_key_check(tmp_path):
+    csv_path = write_text(tmp_path / 'fix.csv', 'file name,note\nP01\nP01,again\n')
+    records = list(read_sheet(csv_path, ['file name'], key_columns=()))
+    assert [record['note'] for record in records] == ['', 'again']
+
+@pytest.mark.parametrize('content, message', [
+    (None, '未找到'),
+    ('', '为空'),
+    ('file name,style\nP01,flat\n', '缺少必需的列'),
+])
+def test_read_sheet_rejects_unusable_files(tmp_path, content, message):
+    csv_path = tmp_path / 'sheet.csv'
+    if content is not None:
+        write_text(csv_path, content)
+    # 表头问题在调用时立即抛出，不必等到迭代
+    with pytest.raises(SheetError, match=message):
+        read_sheet(str(csv_path), ['file name', 'final prompt'])
+
+def test_load_picks_merges_file_and_sheet(tmp_path):
+    picks_path = write_text(tmp_path / 'picks.txt', '# 第一轮\nP01_2.png\n\n  P05_1  \nP06_3.WEBP\n')
+    csv_path = write_text(tmp_path / 'gen.csv', 'file name,pick\nP01,"1，3"\nP02,P02_4 7\nP03,\n')
+    assert load_picks(picks_path, csv_path) == {'P01_2', 'P05_1', 'P06_3', 'P01_1', 'P01_3', 'P02_4', 'P02_7'}
+
+def test_load_picks_without_inputs(tmp_path):
+    csv_path = write_text(tmp_path / 'gen.csv', 'file name,style\nP01,flat\n')
+    # 没有挑选文件、表格也没有挑选列：None 表示全部放大
+    assert load_picks(str(tmp_path / 'missing.txt'), csv_path) is None
+    assert load_picks(str(tmp_path / 'missing.txt'), str(tmp_path / 'missing.csv')) is None
+    # 挑选文件存在但为空：一张都不放大
+    assert load_picks(write_text(tmp_path / 'empty.txt', '# 还没挑\n'), csv_path) == set()
+
+def test_plan_upscale(tmp_path):
+    src_dir, save_dir = tmp_path / 'gen', tmp_path / 'upscaled'
+    for name in ('P01_1.png', 'P01_2.png', 'P02_1.webp', 'notes.txt'):
+        touch(src_dir / name)
+    touch(save_dir / 'P01_2.png')
+
+    plan = plan_upscale(str(src_dir), str(save_dir), {'P01_1', 'P01_2', 'P09_1'})
+    assert plan['todo'] == [str(src_dir / 'P01_1.png')]
+    assert plan['existing'] == [str(src_dir / 'P01_2.png')]
+    assert plan['rejected'] == [str(src_dir / 'P02_1.webp')]
+    assert plan['missing'] == ['P09_1']
+
+    # 不挑选时全部放大，已放大的除外；放大目录还不存在也可以
+    plan = plan_upscale(str(src_dir), str(tmp_path / 'new'), None)
+    assert [os.path.basename(path) for path in plan['todo']] == ['P01_1.png', 'P01_2.png', 'P02_1.webp']
+    assert plan['rejected'] == [] and plan['missing'] == []